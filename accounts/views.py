@@ -3,9 +3,13 @@ from .models import User
 from django.contrib.auth import authenticate,login
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView as BaseLoginView, LogoutView as BaseLogoutView
-from django.shortcuts import render
+from django.db.models import OuterRef,Subquery
+from django.http import Http404
+from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 from django.views.generic import CreateView,DetailView,TemplateView
+from utakais.models import Event,Tanka,UserTankaSummary
+from utakais.pagination import keyset_page
 
 class IndexView(LoginRequiredMixin,TemplateView):
     template_name = 'accounts/index.html'
@@ -38,15 +42,43 @@ class ProfileView(DetailView):
     model = User
     template_name= 'accounts/profile.html'
     context_object_name = 'viewed_user'
+    paginate_by = 20
 
     def get_queryset(self):
         return User.objects.filter(is_active=True) 
     
     def get_object(self, queryset=None):
         queryset = self.get_queryset()
-        return queryset.get(account_id=self.kwargs['account_id'])
-    
+        return get_object_or_404(queryset,account_id=self.kwargs['account_id'])
+
+    def get_tankas(self):
+        """
+        閲覧者が見られる詠草を新しい順に、提出先の歌会(閲覧者が見られるもの)と1クエリで取得する
+        ?cursor=でその続きを取得する
+        """
+        viewer = self.request.user
+        events = Event.objects.visible_to(viewer).filter(participant__tanka=OuterRef('pk'))
+        tankas = Tanka.objects.visible_to(viewer).filter(author=self.object).annotate(
+            event_pk=Subquery(events.values('pk')[:1]),
+            event_title=Subquery(events.values('title')[:1]),
+        )
+        try:
+            return keyset_page(
+                tankas,
+                'created_at',
+                cursor=self.request.GET.get('cursor'),
+                per_page=self.paginate_by,
+                descending=True,
+            )
+        except ValueError:
+            raise Http404('ページが見つかりません。')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['tankas'] = self.objects.order_by('-created_at')
+        page = self.get_tankas()
+        context['tankas'] = page.object_list
+        context['page'] = page
+        # 非公開の詠草も数え、活動日時から提出の時期が分かるため、本人にだけ見せる
+        if self.request.user == self.object:
+            context['summary'] = UserTankaSummary.summary_for(self.object)
         return context
\ No newline at end of file
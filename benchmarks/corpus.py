@@ -0,0 +1,65 @@
+"""
+テストとベンチマーク(bench_*コマンド)で共有するデータと比較用の実装
+本番では使わないため、アプリ(utakais)の外に置く
+"""
+
+import random
+import re
+
+from poegrass.utils import make_normal_run, make_ruby_run
+
+RUBY_WORDS = [
+    ("春雨", "はるさめ"),
+    ("君", "きみ"),
+    ("言の葉", "ことのは"),
+    ("紫陽花", "あじさい"),
+    ("夕月夜", "ゆふづくよ"),
+    ("鴨川", "かもがは"),
+    ("硝子", "がらす"),
+    ("向日葵", "ひまはり"),
+]
+PLAIN_WORDS = ["の", "に", "を", "降る日に", "思ふ", "ひとつ", "胸に抱きて", "、"]
+
+
+def legacy_make_ruby_whole_sentence(paragraph, text, basePoint=11.0, rubyPoint=6.0):
+    """置き換え前のmake_ruby_whole_sentence(比較用)"""
+    run_list = []
+    cursor_A = 0
+    for match_A in re.finditer(r"<ruby>(.*?)</ruby>", text):
+        run_list.append(
+            make_normal_run(text[cursor_A : match_A.start()], point=basePoint)
+        )
+        cursor_B = 0
+        group_text = match_A.group(1)
+        for match_B in re.finditer(r"<rt>(.*?)</rt>", group_text):
+            run_list.append(
+                make_ruby_run(
+                    group_text[cursor_B : match_B.start()],
+                    match_B.group(1),
+                    basePoint=basePoint,
+                    rubyPoint=rubyPoint,
+                )
+            )
+            cursor_B = match_B.end()
+        cursor_A = match_A.end()
+    run_list.append(make_normal_run(text[cursor_A:]))
+    for run_item in run_list:
+        run = paragraph.add_run()
+        run._r.append(run_item)
+    return paragraph
+
+
+def make_corpus(count, seed=0):
+    """ルビの多い詠草をcount首作る"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        parts = []
+        for _ in range(12):
+            if rng.random() < 0.5:
+                base, ruby = rng.choice(RUBY_WORDS)
+                parts.append(f"<ruby>{base}<rt>{ruby}</rt></ruby>")
+            else:
+                parts.append(rng.choice(PLAIN_WORDS))
+        corpus.append("".join(parts))
+    return corpus
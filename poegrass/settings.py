@@ -79,10 +79,41 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'TEST': {
+            # 同時実行のテストで複数の接続から書き込むため、メモリ上ではなくファイルに作る
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
 
+# Cache
+# CACHE_BACKENDから選ぶ。歌会ページのキャッシュ(utakais.caching)などに使う
+# locmemは開発用(1プロセス)のみ。歌会の版がプロセスごとに分かれるため、
+# 複数のワーカーで動かす本番ではredisかfileにする(check --deployで確かめる)
+
+CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    },
+    # Redis互換のサーバー(Redis, Valkeyなど)。redis-pyが必要
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379',
+    },
+}
+CACHE_BACKEND = 'locmem'
+CACHES = {
+    'default': CACHE_BACKENDS[CACHE_BACKEND],
+}
+
+EVENT_PAGE_CACHE_TIMEOUT = 60 * 60  # 歌会ページのキャッシュの有効期間(秒)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -133,4 +164,47 @@ LOGOUT_REDIRECT_URL = "accounts:login"
 # Media files
 
 MEDIA_ROOT = BASE_DIR / 'media'
-MEDIA_URL = '/media/'
\ No newline at end of file
+MEDIA_URL = '/media/'
+
+# 詠草一覧の雛形(MEDIA_ROOTからの相対パス)。Event.eisou_templateで選ぶ
+
+EISOU_DOCX_TEMPLATES = {
+    'default': 'events/samples/utakai_sample.docx',
+}
+
+# 詠草一覧のPDFの作り方
+# "converter": docxを下の変換エンジンでpdfにする
+# "reportlab": docxを経由せずReportLabで直接描画する
+
+EISOU_PDF_RENDERER = 'converter'
+
+# ReportLabで埋め込む日本語フォント(TrueType .ttf/.ttc)のパス
+# EISOU_PDF_RENDERER = 'reportlab'では必須(utakais.E001)。未設定ならeisou.pdfは404になる(utakais.W001)
+
+EISOU_PDF_FONT = None
+
+# 詠草一覧のPDF変換エンジン
+# Wordのある環境では "utakais.converters.Docx2PdfConverter" も使える
+
+EISOU_PDF_CONVERTER = {
+    'BACKEND': 'utakais.converters.LibreOfficePoolConverter',
+    'OPTIONS': {
+        'soffice': 'soffice',
+        'workers': 2,  # 同時に変換できる数
+        'max_jobs': 50,  # この回数変換したら作り直す
+        'timeout': 60,  # 1回の変換の制限時間(秒)
+    },
+}
+
+# 詠草一覧の古い版の掃除(manage.py gc_eisou、ワーカーから定期実行)
+
+EISOU_KEEP_VERSIONS = 3  # 歌会ごとに残す版の数
+EISOU_GC_INTERVAL = 60 * 60 * 24  # ワーカーが掃除する間隔(秒)。0で行わない
+
+# 詠草一覧のファイルの配信方法
+# "django": Djangoが返す(開発環境向け)
+# "x-accel-redirect": nginxに返させる。EISOU_FILE_ACCEL_PREFIXはMEDIA_ROOTを指すinternalなlocation
+# "x-sendfile": Apache(mod_xsendfile)などに返させる
+
+EISOU_FILE_DELIVERY = 'django'
+EISOU_FILE_ACCEL_PREFIX = '/protected/'
@@ -1,7 +1,11 @@
 import datetime
+import hashlib
+import html
+import os
+from copy import deepcopy
+from functools import lru_cache
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
-import re
 
 def japanese_strftime(date,format_str):
 
@@ -17,6 +21,21 @@ def japanese_strftime(date,format_str):
 
     return date.strftime(format_str)
 
+@lru_cache(maxsize=256)
+def _cached_sha256(path, mtime_ns, size):
+    """更新時刻とサイズごとにsha256を覚えておく関数．版を重ねても古いものから捨てる"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_sha256(path):
+    """ファイルのsha256を返す関数．更新時刻とサイズが変わらない限りキャッシュを使う"""
+    path = os.fspath(path)
+    stat = os.stat(path)
+    return _cached_sha256(path, stat.st_mtime_ns, stat.st_size)
+
 def make_ruby_run(baseText, rubyText, basePoint=11.0, rubyPoint=6.0):
     """ルビ付きのrunを生成する関数"""
     # 本文ランの作成
@@ -76,37 +95,115 @@ def make_normal_run(text, point=11.0):
 
     return new_run
 
+RUBY_OPEN, RUBY_CLOSE = "<ruby>", "</ruby>" # タグA．baseTextとrubyTextを囲む
+RT_OPEN, RT_CLOSE = "<rt>", "</rt>" # タグB．rubyTextを囲む
+
+def tokenize_ruby(text):
+    """
+    ルビのマークアップを1回の走査で(本文, ルビ)のリストに分解する関数．ルビのない部分のルビはNone
+    空の本文は含めない．<ruby>～</ruby>が改行をまたぐ場合はルビとみなさない
+    """
+    tokens = []
+    cursor = 0  # まだトークンにしていない位置
+    search = 0  # 次に<ruby>を探す位置
+    while True:
+        start = text.find(RUBY_OPEN, search)
+        if start < 0:
+            break
+        group_start = start + len(RUBY_OPEN)
+        end = text.find(RUBY_CLOSE, group_start)
+        if end < 0:
+            break
+        if text.find("\n", group_start, end) >= 0:
+            search = start + 1
+            continue
+
+        # タグAの前の部分
+        if start > cursor:
+            tokens.append((text[cursor:start], None))
+
+        # タグAの中身をタグBで分解
+        cursor_B = group_start
+        while True:
+            rt_start = text.find(RT_OPEN, cursor_B, end)
+            if rt_start < 0:
+                break
+            rt_end = text.find(RT_CLOSE, rt_start + len(RT_OPEN), end)
+            if rt_end < 0:
+                break
+            tokens.append(
+                (text[cursor_B:rt_start], text[rt_start + len(RT_OPEN):rt_end])
+            )
+            cursor_B = rt_end + len(RT_CLOSE)
+
+        cursor = search = end + len(RUBY_CLOSE)
+
+    # タグAの後の部分
+    if cursor < len(text):
+        tokens.append((text[cursor:], None))
+
+    return tokens
+
+def ruby_tokens_to_html(tokens):
+    """トークンをHTMLにする関数．ルビ以外のタグはエスケープし，改行は<br>にする"""
+    parts = []
+    for baseText, rubyText in tokens:
+        base = html.escape(baseText).replace("\n", "<br>")
+        if rubyText is None:
+            parts.append(base)
+        else:
+            parts.append(f"<ruby>{base}<rt>{html.escape(rubyText)}</rt></ruby>")
+    return "".join(parts)
+
+def ruby_tokens_to_text(tokens):
+    """トークンからルビを除いた本文を返す関数"""
+    return "".join(baseText for baseText, _ in tokens)
+
+def ruby_tokens_to_reading(tokens):
+    """トークンの本文をルビに置き換えた読みを返す関数．ルビのない部分は本文のまま"""
+    return "".join(rubyText or baseText for baseText, rubyText in tokens)
+
+class RubyRunBuilder:
+    """
+    トークンからrunを作るクラス．
+    文字の大きさごとにrunの雛形を一度だけ作り，そのコピーに文字列を入れていく
+    """
+
+    def __init__(self, basePoint=11.0, rubyPoint=6.0):
+        self.normal_template = make_normal_run("", point=basePoint)
+        self.ruby_template = make_ruby_run("", "", basePoint=basePoint, rubyPoint=rubyPoint)
+
+    def normal_run(self, text):
+        run = deepcopy(self.normal_template)
+        run[1].text = text # w:r/w:t
+        return run
+
+    def ruby_run(self, baseText, rubyText):
+        run = deepcopy(self.ruby_template)
+        ruby = run[0]
+        ruby[0][0][1].text = rubyText # w:ruby/w:rt/w:r/w:t
+        ruby[1][0][1].text = baseText # w:ruby/w:rubyBase/w:r/w:t
+        return run
+
+    def runs(self, tokens):
+        for baseText, rubyText in tokens:
+            if rubyText is None:
+                yield self.normal_run(baseText)
+            else:
+                yield self.ruby_run(baseText, rubyText)
+
+@lru_cache(maxsize=None)
+def get_ruby_run_builder(basePoint=11.0, rubyPoint=6.0):
+    return RubyRunBuilder(basePoint=basePoint, rubyPoint=rubyPoint)
+
 def make_ruby_whole_sentence(paragraph,text,basePoint=11.0,rubyPoint=6.0):
     """ルビ付きのrunを生成しparagraphに格納する関数"""
-    tagA_pattern = r"<ruby>(.*?)</ruby>" # タグA．baseTextとrubyTextを囲む
-    tagB_pattern = r"<rt>(.*?)</rt>" # タグB．rubyTextを囲む
-    
-    run_list = []
-    
-    # タグAで分割
-    cursor_A = 0
-    for match_A in re.finditer(tagA_pattern, text):
-        # タグAの前の部分を追加
-        run = make_normal_run(text[cursor_A:match_A.start()],point=basePoint)
-        run_list.append(run)
-
-        # タグAの中身をタグBで処理
-        cursor_B = 0
-        group_text = match_A.group(1)
-        for match_B in re.finditer(tagB_pattern, group_text):
-            baseText = group_text[cursor_B:match_B.start()]
-            rubyText = match_B.group(1)
-            run = make_ruby_run(baseText, rubyText, basePoint=basePoint, rubyPoint=rubyPoint)
-            run_list.append(run)
-            cursor_B = match_B.end()
-        
-        cursor_A = match_A.end()
-
-    # タグAの後の部分を追加
-    run_list.append(make_normal_run(text[cursor_A:]))
-
-    for run_item in run_list:
-        run = paragraph.add_run()
-        run._r.append(run_item)
-
-    return paragraph
\ No newline at end of file
+    builder = get_ruby_run_builder(basePoint, rubyPoint)
+    wrapper = OxmlElement('w:r') # paragraph.add_run()で作られる空のrunに相当
+    p = paragraph._p
+    for run_item in builder.runs(tokenize_ruby(text)):
+        run = deepcopy(wrapper)
+        run.append(run_item)
+        p.append(run)
+
+    return paragraph
@@ -1,4 +1,4 @@
-from .models import Event,Participant,Tanka,TankaList
+from .models import Event,EventJob,Participant,Tanka,TankaList
 from django.contrib import admin
 
 class EventAdmin(admin.ModelAdmin):
@@ -10,6 +10,7 @@ class EventAdmin(admin.ModelAdmin):
         'deadline',
         'ann_desc',
         'ann_status',
+        'eisou_template',
     ]
 
 class TankaAdmin(admin.ModelAdmin):
@@ -27,6 +28,16 @@ class TankaListAdmin(admin.ModelAdmin):
         'is_public',
     ]
 
+class EventJobAdmin(admin.ModelAdmin):
+    list_display=[
+        'event',
+        'method_name',
+        'status',
+        'created_at',
+        'finished_at',
+    ]
+    list_filter=['status']
+
 class ParticipantInline(admin.TabularInline):
     model = Participant
     extra = 1
@@ -35,3 +46,4 @@ admin.site.register(Event,EventAdmin)
 admin.site.register(Tanka,TankaAdmin)
 admin.site.register(TankaList, TankaListAdmin)
 admin.site.register(Participant)
+admin.site.register(EventJob,EventJobAdmin)
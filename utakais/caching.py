@@ -0,0 +1,181 @@
+"""
+歌会ページのキャッシュ
+キャッシュキーは歌会のid・閲覧者の区分(anonymous/member/organizer)・歌会ごとの版からなる
+版はEvent・Participant・Tankaの変更時にsignalsで上がり、古いキャッシュは参照されなくなる
+歌会一覧の版(get_index_version)も同時に上がり、一覧のETagに使う
+    - 非ログインの閲覧者にはページ全体をキャッシュから返す(DBに問い合わせない)
+    - 会員にはテンプレートの断片({% cache %})をキャッシュする
+    - 司会者には常にキャッシュを使わない
+あわせて、ETag・Last-Modifiedによる条件付きGET(304)の処理もここで行う
+版はプロセスをまたいで共有するため、本番ではlocmem(プロセスごと)のキャッシュは使えない
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core import checks
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+
+# ページ全体をキャッシュするビュー(フォームやユーザーごとの内容を含まないもの)
+PAGE_CACHEABLE_VIEWS = {"EventRecordView", "EventOngoingView"}
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_cache_backend(app_configs, **kwargs):
+    """
+    本番(check --deploy)でlocmemのキャッシュを使っていれば知らせる
+    locmemでは版の更新がほかのプロセスに届かず、古いページを返し続ける
+    """
+    backend = settings.CACHES.get("default", {}).get("BACKEND", "")
+    if backend != "django.core.cache.backends.locmem.LocMemCache":
+        return []
+    return [
+        checks.Error(
+            "locmemのキャッシュは開発用です(プロセスごとに歌会の版が分かれます)。",
+            hint="CACHE_BACKENDに'redis'か'file'を設定してください。",
+            id="utakais.E002",
+        )
+    ]
+
+
+# 歌会一覧の版。いずれかの歌会の版が上がると上がる
+INDEX_VERSION_KEY = "utakais:event_index_version"
+
+
+def _version_key(event_id):
+    return f"utakais:event_version:{event_id}"
+
+
+def _get_version(key):
+    """
+    版がキャッシュから消えていれば現在時刻(ns)から始め、消える前の版と重ならないようにする
+    """
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def get_event_version(event_id):
+    """歌会の版を返す"""
+    return _get_version(_version_key(event_id))
+
+
+def get_index_version():
+    """歌会一覧の版を返す"""
+    return _get_version(INDEX_VERSION_KEY)
+
+
+def bump_event_versions(*event_ids):
+    event_ids = set(event_ids)
+    for event_id in event_ids:
+        _bump_version(_version_key(event_id))
+    if event_ids:
+        _bump_version(INDEX_VERSION_KEY)
+
+
+def visibility_tier(user, event=None):
+    if not user.is_authenticated:
+        return "anonymous"
+    if event is not None and event.organizer_id == user.pk:
+        return "organizer"
+    return "member" if user.is_member else "anonymous"
+
+
+def page_timeout():
+    return getattr(settings, "EVENT_PAGE_CACHE_TIMEOUT", 60 * 60)
+
+
+def _page_key(request, event_id):
+    version = get_event_version(event_id)
+    return f"utakais:page:{event_id}:{version}:anonymous:{request.path}"
+
+
+def page_cache_applies(request):
+    """ページ全体のキャッシュを使うリクエストか(非ログインのGET)"""
+    return request.method in ("GET", "HEAD") and not request.user.is_authenticated
+
+
+def get_cached_page(request, event_id):
+    if not page_cache_applies(request):
+        return None
+    return cache.get(_page_key(request, event_id))
+
+
+def cache_page(request, event_id, view, response):
+    """
+    レスポンスをキャッシュする。次の場合はキャッシュしない
+    フォームなどを含むビュー、生成中の詠草一覧、メッセージを表示したページ、Cookieを設定するレスポンス
+    """
+    if not page_cache_applies(request) or response.status_code != 200:
+        return response
+    if view.__name__ not in PAGE_CACHEABLE_VIEWS or request.GET:
+        return response
+    context = getattr(response, "context_data", None) or {}
+    if context.get("files_ready") is False:
+        return response
+    if hasattr(response, "render"):
+        response.render()
+    if get_messages(request).used or response.cookies:
+        return response
+    cache.set(_page_key(request, event_id), response, page_timeout())
+    return response
+
+
+def make_etag(*parts):
+    """partsから弱いETagを作る(テンプレートから描画したページは意味的に同じなら同じとみなす)"""
+    digest = hashlib.sha1("|".join(map(str, parts)).encode("utf-8")).hexdigest()
+    return f'W/"{digest}"'
+
+
+def not_modified(request, etag, last_modified):
+    """
+    If-None-Match,If-Modified-Sinceが現在のページと一致すれば304のレスポンスを返す。一致しなければNone
+    表示していないメッセージがあれば、ページを描画し直させるため比較しない
+    last_modified: datetime
+    """
+    if request.method not in ("GET", "HEAD") or len(get_messages(request)):
+        return None
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        return None
+    return set_validators(response, etag, last_modified)
+
+
+def set_validators(response, etag, last_modified):
+    response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(int(last_modified.timestamp()))
+    # キャッシュしてよいが、使う前に毎回確認させる
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def revalidate_cached_page(request, response):
+    """キャッシュしたページに付けたETag,Last-Modifiedで条件付きGETに答える"""
+    if "ETag" not in response:
+        return response
+    last_modified = parse_http_date_safe(response.get("Last-Modified", ""))
+    matched = get_conditional_response(
+        request, etag=response["ETag"], last_modified=last_modified
+    )
+    if matched is None or len(get_messages(request)):
+        return response
+    for header in ("ETag", "Last-Modified", "Cache-Control"):
+        if header in response:
+            matched[header] = response[header]
+    return matched
@@ -0,0 +1,315 @@
+"""
+docxからpdfへの変換エンジン
+settings.EISOU_PDF_CONVERTER の "BACKEND" で使うクラスを選び、"OPTIONS" を渡す
+
+    EISOU_PDF_CONVERTER = {
+        "BACKEND": "utakais.converters.LibreOfficePoolConverter",
+        "OPTIONS": {"workers": 2, "max_jobs": 50, "timeout": 60},
+    }
+"""
+
+import atexit
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+DEFAULT_CONVERTER = {
+    "BACKEND": "utakais.converters.Docx2PdfConverter",
+    "OPTIONS": {},
+}
+
+
+class ConversionError(Exception):
+    pass
+
+
+class BaseConverter:
+    """変換エンジンの基底クラス。convertを実装する"""
+
+    def __init__(self, **options):
+        self.options = options
+
+    def convert(self, doc_path, pdf_path):
+        """doc_pathのdocxをpdf_pathへpdfとして書き出す"""
+        raise NotImplementedError
+
+    def close(self):
+        """保持しているプロセスなどを解放する"""
+        pass
+
+
+class Docx2PdfConverter(BaseConverter):
+    """docx2pdfを使う変換。Microsoft Wordが必要(Windows/macOSのみ)"""
+
+    def convert(self, doc_path, pdf_path):
+        from docx2pdf import convert
+
+        convert(doc_path, pdf_path)
+
+
+class LibreOfficeConverter(BaseConverter):
+    """変換のたびにsofficeを起動する変換。遅いが依存が少ない"""
+
+    def __init__(self, soffice="soffice", timeout=120, **options):
+        super().__init__(**options)
+        self.soffice = soffice
+        self.timeout = timeout
+
+    def convert(self, doc_path, pdf_path):
+        doc_path, pdf_path = Path(doc_path), Path(pdf_path)
+        with tempfile.TemporaryDirectory() as outdir:
+            try:
+                subprocess.run(
+                    [
+                        self.soffice,
+                        "--headless",
+                        "--convert-to",
+                        "pdf",
+                        str(doc_path),
+                        "--outdir",
+                        outdir,
+                    ],
+                    check=True,
+                    capture_output=True,
+                    timeout=self.timeout,
+                )
+            except (subprocess.SubprocessError, OSError) as e:
+                raise ConversionError(f"sofficeでの変換に失敗しました: {e}") from e
+            shutil.move(Path(outdir) / f"{doc_path.stem}.pdf", pdf_path)
+
+
+class _SofficeWorker:
+    """
+    常駐するheadlessのLibreOfficeプロセス1つ分
+    UNOのpipe(ローカルのUNIXソケット)で接続し、文書の読み込みとpdf書き出しを指示する
+    """
+
+    def __init__(self, soffice, name, startup_timeout):
+        self.soffice = soffice
+        self.name = name
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.desktop = None
+        self.jobs = 0
+        self.profile_dir = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        import uno
+
+        # プロファイルを共有すると複数プロセスが同時に起動できないため、ワーカーごとに分ける
+        self.profile_dir = tempfile.mkdtemp(prefix="poegrass-soffice-")
+        self.process = subprocess.Popen(
+            [
+                self.soffice,
+                "--headless",
+                "--invisible",
+                "--nologo",
+                "--nodefault",
+                "--norestore",
+                "--nolockcheck",
+                f"-env:UserInstallation={Path(self.profile_dir).as_uri()}",
+                f"--accept=pipe,name={self.name};urp;StarOffice.ComponentContext",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local
+        )
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            try:
+                context = resolver.resolve(
+                    f"uno:pipe,name={self.name};urp;StarOffice.ComponentContext"
+                )
+                break
+            except Exception as e:
+                if not self.alive or time.monotonic() > deadline:
+                    self.stop()
+                    raise ConversionError("LibreOfficeを起動できませんでした。") from e
+                time.sleep(0.2)
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", context
+        )
+        self.jobs = 0
+
+    def stop(self):
+        if self.process is not None:
+            if self.alive:
+                self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.desktop = None
+        if self.profile_dir:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+    def convert(self, doc_path, pdf_path):
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def properties(**kwargs):
+            values = []
+            for key, value in kwargs.items():
+                prop = PropertyValue()
+                prop.Name = key
+                prop.Value = value
+                values.append(prop)
+            return tuple(values)
+
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(str(Path(doc_path).resolve())),
+            "_blank",
+            0,
+            properties(Hidden=True, ReadOnly=True),
+        )
+        if document is None:
+            raise ConversionError(f"{doc_path}を読み込めませんでした。")
+        try:
+            document.storeToURL(
+                uno.systemPathToFileUrl(str(Path(pdf_path).resolve())),
+                properties(FilterName="writer_pdf_Export"),
+            )
+        finally:
+            document.close(True)
+        self.jobs += 1
+
+
+class LibreOfficePoolConverter(BaseConverter):
+    """
+    常駐するheadlessのLibreOfficeを複数保持して変換する
+    workers: 同時に変換できる数(プロセス数)
+    max_jobs: この回数変換したプロセスは作り直す
+    timeout: 1回の変換の制限時間(秒)。超えたらプロセスを落として作り直す
+    acquire_timeout: 空きプロセスを待つ時間(秒)
+    """
+
+    def __init__(
+        self,
+        soffice="soffice",
+        workers=2,
+        max_jobs=50,
+        timeout=60,
+        acquire_timeout=300,
+        startup_timeout=30,
+        **options,
+    ):
+        super().__init__(**options)
+        try:
+            import uno  # noqa: F401
+        except ImportError as e:
+            raise ImproperlyConfigured(
+                "LibreOfficePoolConverterにはLibreOfficeのpython-unoが必要です。"
+            ) from e
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.acquire_timeout = acquire_timeout
+        self._idle = queue.LifoQueue()
+        for i in range(workers):
+            name = f"poegrass_soffice_{os.getpid()}_{i}"
+            self._idle.put(_SofficeWorker(soffice, name, startup_timeout))
+        self._workers = list(self._idle.queue)
+        atexit.register(self.close)
+
+    def convert(self, doc_path, pdf_path):
+        try:
+            worker = self._idle.get(timeout=self.acquire_timeout)
+        except queue.Empty:
+            raise ConversionError("空いているLibreOfficeがありません。")
+        try:
+            if not worker.alive:
+                worker.start()
+            self._convert_with_timeout(worker, doc_path, pdf_path)
+        except Exception:
+            # 状態が分からなくなったプロセスは捨てて、次回起動し直す
+            worker.stop()
+            raise
+        else:
+            if worker.jobs >= self.max_jobs:
+                worker.stop()
+        finally:
+            self._idle.put(worker)
+
+    def _convert_with_timeout(self, worker, doc_path, pdf_path):
+        errors = []
+
+        def target():
+            try:
+                worker.convert(doc_path, pdf_path)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            # プロセスを落とすとUNOの呼び出しも中断される
+            worker.stop()
+            thread.join(5)
+            raise ConversionError(f"{self.timeout}秒以内に変換が終わりませんでした。")
+        if errors:
+            raise ConversionError(f"{doc_path}の変換に失敗しました。") from errors[0]
+
+    def close(self):
+        for worker in self._workers:
+            worker.stop()
+
+
+_converter = None
+_converter_lock = threading.Lock()
+_option_overrides = {}
+
+
+def get_converter():
+    """設定された変換エンジンを返す。プロセス内で1つだけ作り、使い回す"""
+    global _converter
+    if _converter is None:
+        with _converter_lock:
+            if _converter is None:
+                config = getattr(settings, "EISOU_PDF_CONVERTER", DEFAULT_CONVERTER)
+                try:
+                    backend = import_string(config["BACKEND"])
+                except ImportError as e:
+                    raise ImproperlyConfigured(
+                        f"変換エンジン{config['BACKEND']}を読み込めません。"
+                    ) from e
+                options = {**config.get("OPTIONS", {}), **_option_overrides}
+                _converter = backend(**options)
+    return _converter
+
+
+def reset_converter(**overrides):
+    """
+    forkした子プロセスで、親から引き継いだ変換エンジンを捨て、次のget_converterで作り直させる
+    親のプロセス(soffice)を落とさないよう、closeは呼ばない
+    overrides: 作り直すときにOPTIONSを上書きする値(例: workers=1)
+    """
+    global _converter
+    with _converter_lock:
+        _converter = None
+        _option_overrides.clear()
+        _option_overrides.update(overrides)
+
+
+def close_converter():
+    """このプロセスで作った変換エンジンを閉じる"""
+    global _converter
+    with _converter_lock:
+        if _converter is not None:
+            _converter.close()
+            _converter = None
@@ -0,0 +1,158 @@
+"""
+生成したファイル(詠草一覧など)の配信
+settings.EISOU_FILE_DELIVERYで配信方法を選ぶ
+    "django": Djangoが返す。ETag・Last-Modifiedによる304とRangeによる部分取得に対応する
+    "x-accel-redirect": nginxに返させる(X-Accel-Redirect)
+    "x-sendfile": Apache(mod_xsendfile)などに返させる(X-Sendfile)
+いずれの場合もETag・Last-Modified・Cache-Controlを付け、条件付きリクエストにはDjangoで304を返す
+"""
+
+import mimetypes
+import os
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+from poegrass.utils import file_sha256
+
+# 版(?v=)が一致するときのキャッシュ期間。版が変わればURLが変わるので、内容は変わらない
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+_range_pattern = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """
+    Rangeヘッダーを(開始, 終了)に解釈する(終了を含む)
+    Rangeがない・解釈できない(開始が終了より後など)・複数の範囲の場合はNone(全体を返す)
+    満たせない範囲(開始がファイルの末尾より後)の場合はValueErrorを送出する
+    """
+    if not header:
+        return None
+    match = _range_pattern.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start:
+        start = int(start)
+        if end and int(end) < start:
+            # 構文として不正な範囲は無視する(RFC 9110 14.1.1)
+            return None
+        if start >= size:
+            raise ValueError(header)
+        end = min(int(end), size - 1) if end else size - 1
+    elif end:
+        # bytes=-N は末尾のNバイト
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        start = max(size - length, 0)
+        end = size - 1
+    else:
+        return None
+    return start, end
+
+
+def _iter_range(path, start, length, chunk_size=64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _if_range_matches(request, etag, last_modified):
+    """If-Rangeがない、または現在のファイルと一致する場合にTrue"""
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _offload_response(path, mode):
+    response = HttpResponse()
+    if mode == "x-accel-redirect":
+        prefix = getattr(settings, "EISOU_FILE_ACCEL_PREFIX", "/protected/")
+        # nginxはX-Accel-RedirectのURIを復号する
+        relative = Path(path).relative_to(settings.MEDIA_ROOT).as_posix()
+        response["X-Accel-Redirect"] = quote(prefix.rstrip("/") + "/" + relative)
+    elif mode == "x-sendfile":
+        # 日本語のファイル名をヘッダーに載せるため、URLエンコードする(mod_xsendfileは復号する)
+        response["X-Sendfile"] = quote(os.fspath(path))
+    else:
+        raise ValueError(f"EISOU_FILE_DELIVERYの値が不正です: {mode}")
+    # 本文はプロキシが付ける。Content-Typeはserve_fileがファイル名から付ける
+    return response
+
+
+def serve_file(request, path, filename=None, version=None, as_attachment=False):
+    """
+    pathのファイルを配信するレスポンスを返す
+    version: 現在の版。リクエストの?v=と一致すれば、長期間キャッシュさせる
+    """
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        raise Http404("ファイルが存在しません。")
+
+    etag = f'"{file_sha256(path)}"'
+    last_modified = int(stat.st_mtime)
+    if version is not None and request.GET.get("v") == str(version):
+        cache_control = f"private, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        # 版の指定がなければ、毎回ETagで確認させる
+        cache_control = "private, no-cache"
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if response is None:
+        mode = getattr(settings, "EISOU_FILE_DELIVERY", "django")
+        if mode == "django":
+            response = _django_response(request, path, stat.st_size, etag, last_modified)
+        else:
+            response = _offload_response(path, mode)
+        filename = filename or path.name
+        if response.status_code in (200, 206):
+            content_type = mimetypes.guess_type(filename)[0]
+            response["Content-Type"] = content_type or "application/octet-stream"
+            response["Content-Disposition"] = content_disposition_header(
+                as_attachment, filename
+            )
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = cache_control
+    return response
+
+
+def _django_response(request, path, size, etag, last_modified):
+    byte_range = None
+    # If-Rangeが一致しなければ(ファイルが変わっていれば)Rangeを無視して全体を返す
+    if _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(request.headers.get("Range"), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+    if byte_range is None:
+        response = FileResponse(open(path, "rb"))
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(_iter_range(path, start, length), status=206)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(length)
+    response["Accept-Ranges"] = "bytes"
+    return response
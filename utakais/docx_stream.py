@@ -0,0 +1,119 @@
+"""
+詠草一覧のdocxをストリーミングで書き出す
+雛形のdocument.xml以外の部品はzipのまま写し、document.xmlは詠草を1首ずつ書き足していく
+詠草の数によらず、保持するのは雛形と1首分のrunだけになる
+
+Event.build_eisou_document(python-docxで組み立てる実装)と同じレイアウトになる
+"""
+
+import re
+import zipfile
+from copy import deepcopy
+
+from docx.oxml import OxmlElement
+from lxml import etree
+
+from poegrass.utils import get_ruby_run_builder, tokenize_ruby
+
+# 書き出し時に置き換える目印(私用領域の文字)
+BASE_MARK = "\ue000"
+RUBY_MARK = "\ue001"
+BODY_MARK = "\ue002"
+
+_xmlns_pattern = re.compile(r' xmlns:\w+="[^"]*"')
+
+
+def _serialize_run(element):
+    """
+    runを文字列にする
+    単独でシリアライズすると名前空間の宣言が付くため、文書中と同じになるよう取り除く
+    """
+    return _xmlns_pattern.sub("", etree.tostring(element, encoding="unicode"))
+
+
+def _escape(text):
+    """lxmlがテキストノードに施すのと同じエスケープ"""
+    return (
+        text.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace("\r", "&#13;")
+    )
+
+
+class RunSerializer:
+    """トークンをdocument.xmlのrunの文字列にする。雛形の文字列を文字の大きさごとに一度だけ作る"""
+
+    def __init__(self, basePoint=11.0, rubyPoint=6.0):
+        builder = get_ruby_run_builder(basePoint, rubyPoint)
+        wrapper = OxmlElement("w:r")  # paragraph.add_run()で作られる空のrunに相当
+
+        normal = deepcopy(wrapper)
+        normal.append(builder.normal_run(BASE_MARK))
+        self.normal_parts = _serialize_run(normal).split(BASE_MARK)
+
+        ruby = deepcopy(wrapper)
+        ruby.append(builder.ruby_run(BASE_MARK, RUBY_MARK))
+        head, rest = _serialize_run(ruby).split(RUBY_MARK)
+        middle, tail = rest.split(BASE_MARK)
+        self.ruby_parts = (head, middle, tail)
+
+        # paragraph.add_run("\n")で作られる改行
+        line_break = OxmlElement("w:r")
+        line_break.append(OxmlElement("w:br"))
+        self.line_break = _serialize_run(line_break)
+
+    def runs(self, tokens):
+        for baseText, rubyText in tokens:
+            if rubyText is None:
+                head, tail = self.normal_parts
+                yield f"{head}{_escape(baseText)}{tail}"
+            else:
+                head, middle, tail = self.ruby_parts
+                yield f"{head}{_escape(rubyText)}{middle}{_escape(baseText)}{tail}"
+
+
+def write_eisou_docx(
+    out,
+    template_path,
+    head_document,
+    tankas,
+    basePoint=11.0,
+    rubyPoint=6.0,
+    line_spacing=4.0,
+):
+    """
+    詠草一覧のdocxをoutに書き出す
+    head_document: 雛形にタイトルと参加者情報を追加済みのpython-docxのDocument
+    tankas: 詠草(ルビのマークアップを含む)を並べたい順に返すイテラブル。ジェネレーターでよい
+    """
+    # 詠草の段落を目印入りで作り、document.xmlを目印の前後に分ける
+    body = head_document.add_paragraph()
+    body.paragraph_format.line_spacing = line_spacing
+    body.add_run(BODY_MARK)
+    document_xml = etree.tostring(
+        head_document.element, encoding="UTF-8", standalone=True
+    ).decode("utf-8")
+    marker_run = _serialize_run(body.runs[0]._r)
+    prefix, suffix = document_xml.split(marker_run)
+
+    serializer = RunSerializer(basePoint, rubyPoint)
+    with zipfile.ZipFile(template_path) as template, zipfile.ZipFile(
+        out, "w", compression=zipfile.ZIP_DEFLATED
+    ) as docx:
+        for item in template.infolist():
+            if item.filename == "word/document.xml":
+                continue
+            # 変更しない部品はそのまま写す
+            docx.writestr(item, template.read(item.filename))
+
+        with docx.open("word/document.xml", "w") as document:
+            document.write(prefix.encode("utf-8"))
+            for i, tanka in enumerate(tankas):
+                # 最初以外改行する
+                if i != 0:
+                    document.write(serializer.line_break.encode("utf-8"))
+                chunk = "".join(serializer.runs(tokenize_ruby(f"{i + 1}．{tanka}")))
+                document.write(chunk.encode("utf-8"))
+            document.write(suffix.encode("utf-8"))
+    return out
@@ -0,0 +1,92 @@
+"""
+詠草一覧の雛形(docx)の登録簿
+雛形はプロセスごとに一度だけ読み込んで解析し、生成のたびにそのコピーを渡す
+雛形ファイルの更新時刻が変わったら読み込み直す
+登録されていない名前(設定から外された雛形など)は、警告を記録して"default"を使う
+
+    EISOU_DOCX_TEMPLATES = {
+        "default": "events/samples/utakai_sample.docx",  # MEDIA_ROOTからの相対パス
+    }
+"""
+
+import copy
+import logging
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from docx import Document
+
+DEFAULT_TEMPLATES = {
+    "default": "events/samples/utakai_sample.docx",
+}
+DEFAULT_NAME = "default"
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateRegistry:
+    def __init__(self):
+        self._cache = {}  # name -> (path, mtime_ns, size, Document)
+        self._lock = threading.Lock()
+
+    def names(self):
+        """登録されている雛形の名前"""
+        return list(getattr(settings, "EISOU_DOCX_TEMPLATES", DEFAULT_TEMPLATES))
+
+    def resolve(self, name):
+        """使う雛形の名前。登録されていなければ警告を記録して既定の雛形にする"""
+        if name in self.names():
+            return name
+        logger.warning("雛形%sは登録されていないため、%sを使います。", name, DEFAULT_NAME)
+        return DEFAULT_NAME
+
+    def path(self, name=DEFAULT_NAME):
+        """雛形のパス。相対パスはMEDIA_ROOTからのものとみなす"""
+        templates = getattr(settings, "EISOU_DOCX_TEMPLATES", DEFAULT_TEMPLATES)
+        name = self.resolve(name)
+        try:
+            path = Path(templates[name])
+        except KeyError:
+            raise KeyError(f"雛形{name}は登録されていません。")
+        if not path.is_absolute():
+            path = Path(settings.MEDIA_ROOT) / path
+        return path
+
+    def _load(self, name):
+        name = self.resolve(name)
+        path = self.path(name)
+        stat = path.stat()
+        cached = self._cache.get(name)
+        if (
+            cached is not None
+            and cached[0] == path
+            and cached[1] == stat.st_mtime_ns
+            and cached[2] == stat.st_size
+        ):
+            return cached[3]
+        with self._lock:
+            document = Document(path)
+            self._cache[name] = (path, stat.st_mtime_ns, stat.st_size, document)
+        return document
+
+    def get(self, name=DEFAULT_NAME):
+        """雛形のコピーを返す。返したDocumentは自由に書き換えてよい"""
+        document = self._load(name)
+        with self._lock:
+            return copy.deepcopy(document)
+
+    def invalidate(self, name=None):
+        """キャッシュを破棄する。nameを省略するとすべて"""
+        with self._lock:
+            if name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(name, None)
+
+
+registry = TemplateRegistry()
+
+
+def get_template(name=DEFAULT_NAME):
+    return registry.get(name)
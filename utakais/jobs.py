@@ -0,0 +1,116 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import EventJob
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(event, method_name="generate_files"):
+    """
+    Eventのメソッドをジョブとして積む
+    同じイベント・メソッドの待機中のジョブがあれば、新しく積まずにそれを返す
+    同時に呼ばれても、待機中のジョブは制約(unique_queued_eventjob)により1つしか作られない
+    実行中のジョブがある場合は、その後に実行するジョブを積む(変更がなければ生成は省かれる)
+    """
+    queued = EventJob.objects.filter(
+        event=event,
+        method_name=method_name,
+        status="queued",
+    )
+    for _ in range(3):
+        job = queued.first()
+        if job is not None:
+            return job
+        try:
+            with transaction.atomic():
+                return EventJob.objects.create(event=event, method_name=method_name)
+        except IntegrityError:
+            # 他の呼び出しが先に積んだ
+            continue
+    return queued.first()
+
+
+def latest_job(event, method_name="generate_files"):
+    """イベントの最新のジョブを返す。なければNone"""
+    return (
+        EventJob.objects.filter(event=event, method_name=method_name)
+        .order_by("-created_at")
+        .first()
+    )
+
+
+def claim_next():
+    """
+    待機中のジョブを1件取得し、実行中にする
+    複数のワーカーが同時に動いても同じジョブを二重に取らないよう、
+    status="queued"を条件にupdateして取得できたものだけを返す
+    """
+    candidates = EventJob.objects.filter(status="queued").order_by("created_at")
+    for job in candidates[:10]:
+        now = timezone.now()
+        claimed = EventJob.objects.filter(pk=job.pk, status="queued").update(
+            status="running", started_at=now
+        )
+        if claimed:
+            job.status = "running"
+            job.started_at = now
+            return job
+    return None
+
+
+def run_job(job):
+    """ジョブを実行し、結果に応じてdone/failedにする"""
+    try:
+        method = getattr(job.event, job.method_name)
+        method()
+    except Exception:
+        logger.exception("ジョブ%sの実行に失敗しました。", job.pk)
+        job.status = "failed"
+        job.error = traceback.format_exc()
+    else:
+        job.status = "done"
+        job.error = ""
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "error", "finished_at"])
+    return job
+
+
+def run_pending(limit=None):
+    """待機中のジョブがなくなるまで(最大limit件)実行し、実行件数を返す"""
+    count = 0
+    while limit is None or count < limit:
+        close_old_connections()
+        job = claim_next()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def requeue_stale(stale_after=timedelta(minutes=30)):
+    """
+    ワーカーが落ちるなどして実行中のまま残ったジョブを待機中に戻す
+    同じジョブがすでに待機中なら、戻さずに失敗扱いにする
+    """
+    threshold = timezone.now() - stale_after
+    count = 0
+    for job in EventJob.objects.filter(status="running", started_at__lt=threshold):
+        try:
+            with transaction.atomic():
+                EventJob.objects.filter(pk=job.pk).update(
+                    status="queued", started_at=None
+                )
+            count += 1
+        except IntegrityError:
+            EventJob.objects.filter(pk=job.pk).update(
+                status="failed",
+                error="実行中のまま中断されました。",
+                finished_at=timezone.now(),
+            )
+    return count
@@ -0,0 +1,20 @@
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windowsではファイルロックを使わない
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    """pathのファイルに排他ロックをかける。同じホストのプロセス間で有効"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,64 @@
+import io
+import time
+from collections import namedtuple
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from docx import Document
+
+from utakais.docx_templates import registry
+from utakais.models import Event
+
+BenchParticipant = namedtuple("BenchParticipant", ["name"])
+
+SAMPLE_TANKA = (
+    "<ruby>春雨<rt>はるさめ</rt></ruby>の降る日に<ruby>君<rt>きみ</rt></ruby>を"
+    "思ふ<ruby>言の葉<rt>ことのは</rt></ruby>ひとつ胸に抱きて"
+)
+
+
+class Command(BaseCommand):
+    help = "雛形を毎回読み込む場合(cold)と、登録簿のコピーを使う場合(warm)の詠草一覧生成時間を比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--template", default="default", help="雛形の名前")
+        parser.add_argument("--iterations", type=int, default=50, help="繰り返し回数")
+        parser.add_argument("--tankas", type=int, default=30, help="1回あたりの詠草数")
+
+    def handle(self, *args, **options):
+        name = options["template"]
+        iterations = options["iterations"]
+        event = Event(title="ベンチマーク", start_time=timezone.now(), eisou_seed=0)
+        participants = [BenchParticipant(f"歌人{i}") for i in range(options["tankas"])]
+        tankas = [SAMPLE_TANKA] * options["tankas"]
+        path = registry.path(name)
+
+        def build(doc):
+            doc = event.add_title(doc, event.title)
+            doc = event.add_info(doc, "2025年1月1日（水）", "司会者", participants)
+            doc = event.add_tankas(doc, list(tankas), seed=0)
+            doc.save(io.BytesIO())
+
+        def measure(load):
+            # 初回の読み込みは計測から除く
+            load()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                load()
+            load_time = (time.perf_counter() - start) / iterations
+            start = time.perf_counter()
+            for _ in range(iterations):
+                build(load())
+            total_time = (time.perf_counter() - start) / iterations
+            return load_time, total_time
+
+        cold = measure(lambda: Document(path))
+        warm = measure(lambda: registry.get(name))
+
+        self.stdout.write(f"雛形: {path}  繰り返し: {iterations}回  詠草: {len(tankas)}首")
+        self.stdout.write(f"{'':6}{'読み込み(ms)':>14}{'生成全体(ms)':>14}")
+        for label, (load_time, total_time) in (("cold", cold), ("warm", warm)):
+            self.stdout.write(
+                f"{label:6}{load_time * 1000:14.2f}{total_time * 1000:14.2f}"
+            )
+        self.stdout.write(f"読み込みの高速化: {cold[0] / warm[0]:.1f}倍")
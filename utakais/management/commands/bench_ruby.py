@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from docx import Document
+
+from benchmarks.corpus import legacy_make_ruby_whole_sentence, make_corpus
+from poegrass.utils import make_ruby_whole_sentence, tokenize_ruby
+
+
+class Command(BaseCommand):
+    help = "ルビの分解とrun生成を、置き換え前の実装と比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tankas", type=int, default=500, help="詠草数")
+        parser.add_argument("--repeat", type=int, default=5, help="繰り返し回数")
+
+    def handle(self, *args, **options):
+        corpus = make_corpus(options["tankas"])
+        repeat = options["repeat"]
+
+        def measure(func):
+            best = None
+            for _ in range(repeat):
+                paragraph = Document().add_paragraph()
+                start = time.perf_counter()
+                for tanka in corpus:
+                    func(paragraph, tanka)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best, len(paragraph._p)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for tanka in corpus:
+                tokenize_ruby(tanka)
+        tokenize_time = (time.perf_counter() - start) / repeat
+
+        legacy_time, legacy_runs = measure(legacy_make_ruby_whole_sentence)
+        new_time, new_runs = measure(make_ruby_whole_sentence)
+
+        self.stdout.write(f"詠草: {len(corpus)}首  繰り返し: {repeat}回(最速値)")
+        self.stdout.write(f"分解のみ          {tokenize_time * 1000:8.2f} ms")
+        self.stdout.write(f"置き換え前        {legacy_time * 1000:8.2f} ms  run数 {legacy_runs}")
+        self.stdout.write(f"現在              {new_time * 1000:8.2f} ms  run数 {new_runs}")
+        self.stdout.write(f"高速化: {legacy_time / new_time:.1f}倍")
@@ -0,0 +1,97 @@
+import random
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand
+
+from benchmarks.corpus import make_corpus
+from poegrass.utils import ruby_tokens_to_text, tokenize_ruby
+from utakais.search import CREATE_TABLE_SQL, TABLE, index_text, match_expression
+
+QUERIES = ["君", "紫陽花", "降る日に思ふ", "ＡＢＣ", "ｶﾞﾗｽ", "鴨川 硝子"]
+# コーパスにない語を混ぜた詠草(ヒット数の少ない検索のため)
+RARE_WORDS = ["abc", "ガラス", "蛍火"]
+
+
+def make_texts(count, seed=0):
+    rng = random.Random(seed)
+    texts = [ruby_tokens_to_text(tokenize_ruby(tanka)) for tanka in make_corpus(count)]
+    for i in rng.sample(range(count), min(count, 100)):
+        texts[i] += rng.choice(RARE_WORDS)
+    return texts
+
+
+class Command(BaseCommand):
+    help = "詠草の全文検索(FTS5)を、本文の部分一致(LIKE)による全件走査と比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tankas", type=int, default=100_000, help="詠草数")
+        parser.add_argument("--repeat", type=int, default=5, help="繰り返し回数")
+        parser.add_argument("--limit", type=int, default=20, help="1回に取得する件数")
+
+    def handle(self, *args, **options):
+        texts = make_texts(options["tankas"])
+        repeat = options["repeat"]
+        limit = options["limit"]
+
+        # 本番のDBを汚さないよう、メモリ上のSQLiteで測る
+        db = sqlite3.connect(":memory:")
+        db.execute(
+            "CREATE TABLE tanka (id INTEGER PRIMARY KEY, content_text TEXT NOT NULL)"
+        )
+        db.executemany(
+            "INSERT INTO tanka (id, content_text) VALUES (?, ?)",
+            enumerate(texts, start=1),
+        )
+        start = time.perf_counter()
+        db.execute(CREATE_TABLE_SQL)
+        db.executemany(
+            f"INSERT INTO {TABLE} (rowid, body) VALUES (?, ?)",
+            ((pk, index_text(text)) for pk, text in enumerate(texts, start=1)),
+        )
+        db.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+        db.commit()
+        build_time = time.perf_counter() - start
+
+        def measure(sql, params):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                rows = db.execute(sql, params).fetchall()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best, rows
+
+        self.stdout.write(f"詠草: {len(texts)}首  繰り返し: {repeat}回(最速値)")
+        self.stdout.write(f"索引の作成 {build_time:8.2f} s")
+        self.stdout.write(
+            "LIKEは新しい順にlimit件、FTS5は関連の高い順(全件の順位付け)にlimit件を取得する"
+        )
+        self.stdout.write(
+            f"{'検索語':<12}{'LIKE':>12}{'件数':>8}{'FTS5':>12}{'件数':>8}"
+        )
+        for query in QUERIES:
+            terms = query.split()
+            condition = " AND ".join(["content_text LIKE ?"] * len(terms))
+            like_params = [f"%{term}%" for term in terms]
+            like_time, _ = measure(
+                f"SELECT id FROM tanka WHERE {condition} ORDER BY id DESC LIMIT ?",
+                like_params + [limit],
+            )
+            # LIKEは全角・半角の違いをそろえないため、件数が少なくなる
+            (like_hits,) = db.execute(
+                f"SELECT count(*) FROM tanka WHERE {condition}", like_params
+            ).fetchone()
+            match = match_expression(query)
+            fts_time, _ = measure(
+                f"SELECT t.id FROM tanka t JOIN {TABLE} f ON f.rowid = t.id "
+                f"WHERE {TABLE} MATCH ? ORDER BY bm25({TABLE}) LIMIT ?",
+                [match, limit],
+            )
+            (hits,) = db.execute(
+                f"SELECT count(*) FROM {TABLE} WHERE {TABLE} MATCH ?", [match]
+            ).fetchone()
+            self.stdout.write(
+                f"{query:<12}{like_time * 1000:9.2f} ms{like_hits:>8}"
+                f"{fts_time * 1000:9.2f} ms{hits:>8}"
+            )
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from utakais.retention import collect_eisou_garbage
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}B"
+        size /= 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "詠草一覧の古い版、短歌リストの古い書き出し、"
+        "削除された歌会・短歌リストのディレクトリ、中断された生成の作業用ディレクトリ、"
+        "重複ファイルを掃除する"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep",
+            type=int,
+            default=None,
+            help="歌会ごとに残す版の数(既定: settings.EISOU_KEEP_VERSIONS)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="削除せず、削除されるものと解放される容量を表示する",
+        )
+        parser.add_argument(
+            "--grace-minutes",
+            type=int,
+            default=60,
+            help="この時間内に更新されたファイルには触れない(分)",
+        )
+
+    def handle(self, *args, **options):
+        report = collect_eisou_garbage(
+            keep=options["keep"],
+            dry_run=options["dry_run"],
+            grace_seconds=options["grace_minutes"] * 60,
+        )
+        prefix = "[dry-run] " if options["dry_run"] else ""
+        for path, size, reason in report.deleted:
+            self.stdout.write(f"{prefix}削除 ({reason}) {path} {format_bytes(size)}")
+        for path, original, size in report.linked:
+            self.stdout.write(f"{prefix}リンク {path} -> {original} {format_bytes(size)}")
+        self.stdout.write(
+            f"{prefix}削除 {len(report.deleted)}件、リンク {len(report.linked)}件、"
+            f"解放 {format_bytes(report.reclaimed_bytes)}"
+        )
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from tqdm import tqdm
+
+from utakais.models import Tanka
+from utakais.similarity import backfill
+
+
+class Command(BaseCommand):
+    help = "詠草のMinHashの署名とLSHのバケットを計算し直す(よく似た詠草の検出に使う)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="1回に計算して保存する詠草の数",
+        )
+        parser.add_argument(
+            "--only-missing",
+            action="store_true",
+            help="署名がない詠草に限る",
+        )
+
+    def handle(self, *args, **options):
+        tankas = Tanka.objects.all()
+        if options["only_missing"]:
+            tankas = tankas.filter(minhash__isnull=True)
+        with tqdm(total=tankas.count(), unit="tanka") as progress:
+            count = backfill(
+                tankas, batch_size=options["batch_size"], progress=progress.update
+            )
+        self.stdout.write(f"{count}首の詠草の署名を計算しました。")
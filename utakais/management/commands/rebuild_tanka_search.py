@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from tqdm import tqdm
+
+from utakais.models import Tanka
+from utakais.search import rebuild_index, search_available
+
+
+class Command(BaseCommand):
+    help = "詠草の全文検索の索引を作り直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="1回に索引へ入れる詠草の数",
+        )
+
+    def handle(self, *args, **options):
+        if not search_available():
+            raise CommandError("全文検索の索引はSQLiteでのみ使えます。")
+        with tqdm(total=Tanka.objects.count(), unit="tanka") as progress:
+            count = rebuild_index(
+                Tanka.objects.all(),
+                batch_size=options["batch_size"],
+                progress=progress.update,
+            )
+        self.stdout.write(f"{count}首の詠草を索引しました。")
@@ -0,0 +1,146 @@
+import json
+import os
+import time
+from datetime import datetime, time as dtime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from tqdm import tqdm
+
+from utakais.models import Event
+from utakais.regenerate import regenerate_events
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError(f"日付はYYYY-MM-DDで指定してください: {value}")
+
+
+class Command(BaseCommand):
+    help = "締切を過ぎた歌会の詠草一覧を、プロセスプールで並列に作り直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            type=parse_date,
+            help="この日以降に開始した歌会に限る(YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--until",
+            type=parse_date,
+            help="この日までに開始した歌会に限る(YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--ids",
+            type=int,
+            nargs="+",
+            help="対象の歌会のid",
+        )
+        parser.add_argument(
+            "--only-missing",
+            action="store_true",
+            help="詠草一覧のファイルがない歌会に限る",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="内容が変わっていなくても作り直す",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="プロセス数。1ならこのプロセスで順に行う(既定: CPU数)",
+        )
+        parser.add_argument(
+            "--summary",
+            help="歌会ごとの結果と所要時間をJSONで書き出すパス",
+        )
+
+    def get_events(self, options):
+        events = Event.objects.filter(deadline__lte=timezone.now())
+        if options["since"]:
+            events = events.filter(
+                start_time__gte=timezone.make_aware(
+                    datetime.combine(options["since"], dtime.min)
+                )
+            )
+        if options["until"]:
+            events = events.filter(
+                start_time__lte=timezone.make_aware(
+                    datetime.combine(options["until"], dtime.max)
+                )
+            )
+        if options["ids"]:
+            events = events.filter(pk__in=options["ids"])
+        pks = list(events.order_by("start_time").values_list("pk", flat=True))
+        if options["only_missing"]:
+            pks = [
+                event.pk
+                for event in Event.objects.filter(pk__in=pks).order_by("start_time")
+                if not self.files_exist(event)
+            ]
+        return pks
+
+    @staticmethod
+    def files_exist(event):
+        """DBに記録されたファイルが実際に存在するか"""
+        return (
+            event.eisou_files_exist
+            and event.eisou_doc.storage.exists(event.eisou_doc.name)
+            and event.eisou_pdf.storage.exists(event.eisou_pdf.name)
+        )
+
+    def handle(self, *args, **options):
+        pks = self.get_events(options)
+        if not pks:
+            self.stdout.write("対象の歌会がありません。")
+            return
+        workers = max(1, min(options["workers"] or 1, len(pks)))
+        self.stdout.write(f"{len(pks)}件の歌会を{workers}プロセスで作り直します。")
+
+        results = []
+        started = time.perf_counter()
+        with tqdm(total=len(pks), unit="event") as progress:
+            for result in regenerate_events(pks, workers, options["force"]):
+                results.append(result)
+                progress.update()
+                if result.status == "failed":
+                    progress.write(f"歌会{result.event_id}の生成に失敗しました。")
+        wall = time.perf_counter() - started
+
+        counts = {
+            status: sum(result.status == status for result in results)
+            for status in ("generated", "unchanged", "failed")
+        }
+        busy = sum(result.seconds for result in results)
+        summary = {
+            "workers": workers,
+            "events": len(results),
+            **counts,
+            "wall_seconds": round(wall, 3),
+            # 1件ずつの所要時間の合計。wall_seconds * workersに近いほど並列化が効いている
+            "busy_seconds": round(busy, 3),
+            "events_per_second": round(len(results) / wall, 3) if wall else None,
+            "results": [
+                result.as_dict()
+                for result in sorted(results, key=lambda result: result.event_id)
+            ],
+        }
+        if options["summary"]:
+            with open(options["summary"], "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+
+        self.stdout.write(
+            f"生成 {counts['generated']}件、変更なし {counts['unchanged']}件、"
+            f"失敗 {counts['failed']}件"
+        )
+        self.stdout.write(
+            f"所要時間 {wall:.1f}秒({summary['events_per_second']}件/秒)、"
+            f"処理時間の合計 {busy:.1f}秒"
+        )
+        for result in results:
+            if result.status == "failed":
+                self.stderr.write(f"歌会{result.event_id}:\n{result.error}")
@@ -0,0 +1,71 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utakais import jobs
+from utakais.retention import collect_eisou_garbage
+
+
+class Command(BaseCommand):
+    help = "詠草一覧生成などのEventJobを処理するワーカーを起動する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="待機中のジョブを処理したら終了する",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2.0,
+            help="ジョブがないときのポーリング間隔(秒)",
+        )
+        parser.add_argument(
+            "--stale-minutes",
+            type=int,
+            default=30,
+            help="この時間以上実行中のままのジョブを待機中に戻す(分)",
+        )
+        parser.add_argument(
+            "--gc-interval",
+            type=float,
+            default=None,
+            help="古い版の掃除(gc_eisou)を行う間隔(秒)。0で行わない"
+            "(既定: settings.EISOU_GC_INTERVAL)",
+        )
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(minutes=options["stale_minutes"])
+        requeued = jobs.requeue_stale(stale_after)
+        if requeued:
+            self.stdout.write(f"{requeued}件の中断されたジョブを再投入しました。")
+
+        if options["once"]:
+            count = jobs.run_pending()
+            self.stdout.write(f"{count}件のジョブを処理しました。")
+            return
+
+        gc_interval = options["gc_interval"]
+        if gc_interval is None:
+            gc_interval = getattr(settings, "EISOU_GC_INTERVAL", 0)
+        last_gc = time.monotonic()
+
+        self.stdout.write("ワーカーを起動しました。Ctrl+Cで終了します。")
+        try:
+            while True:
+                count = jobs.run_pending()
+                if count:
+                    self.stdout.write(f"{count}件のジョブを処理しました。")
+                else:
+                    time.sleep(options["interval"])
+                if gc_interval and time.monotonic() - last_gc >= gc_interval:
+                    report = collect_eisou_garbage()
+                    self.stdout.write(
+                        f"古い版を掃除しました。({report.reclaimed_bytes}バイト解放)"
+                    )
+                    last_gc = time.monotonic()
+        except KeyboardInterrupt:
+            self.stdout.write("ワーカーを終了しました。")
@@ -0,0 +1,86 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from utakais import jobs
+from utakais.scheduler import DeadlineScheduler
+
+
+class Command(BaseCommand):
+    help = "締切を過ぎた歌会の詠草一覧の生成を、締切と同時に積むスケジューラを起動する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="過ぎた締切を拾い直したら終了する",
+        )
+        parser.add_argument(
+            "--catch-up-days",
+            type=float,
+            default=30,
+            help="起動時に、この日数前までの締切を拾い直す",
+        )
+        parser.add_argument(
+            "--coalesce-seconds",
+            type=float,
+            default=60,
+            help="この時間内に続く締切はまとめて積む(秒)",
+        )
+        parser.add_argument(
+            "--refresh-interval",
+            type=float,
+            default=300,
+            help="締切の索引を載せ直す間隔(秒)",
+        )
+        parser.add_argument(
+            "--with-worker",
+            action="store_true",
+            help="積んだジョブをこのプロセスで実行する(run_eisou_workerを別に起動しない場合)",
+        )
+
+    def handle(self, *args, **options):
+        scheduler = DeadlineScheduler(
+            coalesce=timedelta(seconds=options["coalesce_seconds"]),
+            horizon=timedelta(seconds=options["refresh_interval"] * 2),
+        )
+        now = timezone.now()
+        caught_up = scheduler.catch_up(
+            since=now - timedelta(days=options["catch_up_days"]), now=now
+        )
+        self.stdout.write(f"過ぎた締切の詠草一覧を{len(caught_up)}件積みました。")
+        self.run_jobs(options)
+        if options["once"]:
+            return
+
+        refresh_interval = options["refresh_interval"]
+        self.stdout.write("スケジューラを起動しました。Ctrl+Cで終了します。")
+        try:
+            while True:
+                scheduler.refresh()
+                refreshed_at = time.monotonic()
+                while time.monotonic() - refreshed_at < refresh_interval:
+                    wakeup = scheduler.next_wakeup()
+                    remaining = refresh_interval - (time.monotonic() - refreshed_at)
+                    if wakeup is not None:
+                        remaining = min(
+                            remaining, (wakeup - timezone.now()).total_seconds()
+                        )
+                    if remaining > 0:
+                        time.sleep(remaining)
+                    enqueued = scheduler.run_due()
+                    if enqueued:
+                        self.stdout.write(
+                            f"締切を過ぎた詠草一覧を{len(enqueued)}件積みました。"
+                        )
+                        self.run_jobs(options)
+        except KeyboardInterrupt:
+            self.stdout.write("スケジューラを終了しました。")
+
+    def run_jobs(self, options):
+        if options["with_worker"]:
+            count = jobs.run_pending()
+            if count:
+                self.stdout.write(f"{count}件のジョブを処理しました。")
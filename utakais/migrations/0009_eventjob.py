@@ -0,0 +1,60 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:28
+
+import django.core.validators
+import django.db.models.deletion
+import utakais.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0008_alter_tanka_guest_author'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='event',
+            name='eisou_doc',
+            field=models.FileField(blank=True, null=True, upload_to=utakais.models.Event.file_path, validators=[django.core.validators.FileExtensionValidator(['docx'])]),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='eisou_pdf',
+            field=models.FileField(blank=True, null=True, upload_to=utakais.models.Event.file_path, validators=[django.core.validators.FileExtensionValidator(['pdf'])]),
+        ),
+        migrations.AlterField(
+            model_name='participant',
+            name='guest_user',
+            field=models.CharField(blank=True, max_length=63, verbose_name='名前'),
+        ),
+        migrations.AlterField(
+            model_name='participant',
+            name='message',
+            field=models.TextField(blank=True, default='', max_length=200, verbose_name='備考欄'),
+        ),
+        migrations.AlterField(
+            model_name='participant',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='名前'),
+        ),
+        migrations.CreateModel(
+            name='EventJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method_name', models.CharField(default='generate_files', max_length=63, verbose_name='実行メソッド')),
+                ('status', models.CharField(choices=[('queued', '待機中'), ('running', '実行中'), ('done', '完了'), ('failed', '失敗')], default='queued', max_length=7, verbose_name='状態')),
+                ('error', models.TextField(blank=True, default='', verbose_name='エラー内容')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='開始日時')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='終了日時')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='utakais.event', verbose_name='対象イベント')),
+            ],
+            options={
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='eventjob_status_created')],
+            },
+        ),
+    ]
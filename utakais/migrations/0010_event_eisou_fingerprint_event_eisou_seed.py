@@ -0,0 +1,24 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:28
+
+import utakais.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0009_eventjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='eisou_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='詠草一覧フィンガープリント'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='eisou_seed',
+            field=models.PositiveIntegerField(default=utakais.models.make_eisou_seed, verbose_name='詠草シャッフルのシード'),
+        ),
+    ]
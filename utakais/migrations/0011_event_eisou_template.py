@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0010_event_eisou_fingerprint_event_eisou_seed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='eisou_template',
+            field=models.CharField(default='default', max_length=31, verbose_name='詠草一覧の雛形'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0011_event_eisou_template'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=63, verbose_name='処理名')),
+                ('owner', models.CharField(max_length=32, verbose_name='保持者')),
+                ('expires_at', models.DateTimeField(verbose_name='期限')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='eventjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'queued')), fields=('event', 'method_name'), name='unique_queued_eventjob'),
+        ),
+        migrations.AddField(
+            model_name='eventlease',
+            name='event',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leases', to='utakais.event', verbose_name='対象イベント'),
+        ),
+        migrations.AddConstraint(
+            model_name='eventlease',
+            constraint=models.UniqueConstraint(fields=('event', 'name'), name='unique_event_lease'),
+        ),
+    ]
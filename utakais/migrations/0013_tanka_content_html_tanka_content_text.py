@@ -0,0 +1,95 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:46
+
+import html
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+# 以下はこのマイグレーションを作った時点のpoegrass.utilsの写し
+# アプリのコードが変わっても、このマイグレーションの結果は変えない
+def tokenize_ruby(text):
+    """ルビのマークアップを(本文, ルビ)のリストに分解する。ルビのない部分のルビはNone"""
+    tokens = []
+    cursor = 0
+    search = 0
+    while True:
+        start = text.find('<ruby>', search)
+        if start < 0:
+            break
+        group_start = start + len('<ruby>')
+        end = text.find('</ruby>', group_start)
+        if end < 0:
+            break
+        if text.find('\n', group_start, end) >= 0:
+            search = start + 1
+            continue
+        if start > cursor:
+            tokens.append((text[cursor:start], None))
+        cursor_B = group_start
+        while True:
+            rt_start = text.find('<rt>', cursor_B, end)
+            if rt_start < 0:
+                break
+            rt_end = text.find('</rt>', rt_start + len('<rt>'), end)
+            if rt_end < 0:
+                break
+            tokens.append((text[cursor_B:rt_start], text[rt_start + len('<rt>'):rt_end]))
+            cursor_B = rt_end + len('</rt>')
+        cursor = search = end + len('</ruby>')
+    if cursor < len(text):
+        tokens.append((text[cursor:], None))
+    return tokens
+
+
+def ruby_tokens_to_html(tokens):
+    parts = []
+    for baseText, rubyText in tokens:
+        base = html.escape(baseText).replace('\n', '<br>')
+        if rubyText is None:
+            parts.append(base)
+        else:
+            parts.append(f'<ruby>{base}<rt>{html.escape(rubyText)}</rt></ruby>')
+    return ''.join(parts)
+
+
+def ruby_tokens_to_text(tokens):
+    return ''.join(baseText for baseText, _ in tokens)
+
+
+def render_contents(apps, schema_editor):
+    """既存の詠草のcontent_html,content_textを、BATCH_SIZE件ずつ埋める"""
+    Tanka = apps.get_model('utakais', 'Tanka')
+    batch = []
+    for tanka in Tanka.objects.only('pk', 'content').iterator(chunk_size=BATCH_SIZE):
+        tokens = tokenize_ruby(tanka.content)
+        tanka.content_html = ruby_tokens_to_html(tokens)
+        tanka.content_text = ruby_tokens_to_text(tokens)
+        batch.append(tanka)
+        if len(batch) >= BATCH_SIZE:
+            Tanka.objects.bulk_update(batch, ['content_html', 'content_text'])
+            batch = []
+    if batch:
+        Tanka.objects.bulk_update(batch, ['content_html', 'content_text'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0012_eventlease_eventjob_unique_queued_eventjob_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tanka',
+            name='content_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='詠草(HTML)'),
+        ),
+        migrations.AddField(
+            model_name='tanka',
+            name='content_text',
+            field=models.TextField(blank=True, editable=False, verbose_name='詠草(ルビなし)'),
+        ),
+        migrations.RunPython(render_contents, migrations.RunPython.noop),
+    ]
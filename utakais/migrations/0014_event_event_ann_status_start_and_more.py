@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0013_tanka_content_html_tanka_content_text'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['ann_status', 'start_time'], name='event_ann_status_start'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['rec_status', 'start_time'], name='event_rec_status_start'),
+        ),
+        migrations.AddIndex(
+            model_name='tanka',
+            index=models.Index(fields=['status', 'created_at'], name='tanka_status_created'),
+        ),
+    ]
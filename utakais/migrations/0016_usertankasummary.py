@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0015_event_updated_at_event_content_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTankaSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tanka_count', models.PositiveIntegerField(default=0, verbose_name='詠草数')),
+                ('event_count', models.PositiveIntegerField(default=0, verbose_name='参加した歌会の数')),
+                ('first_activity_at', models.DateTimeField(blank=True, null=True, verbose_name='最初の詠草の作成日時')),
+                ('last_activity_at', models.DateTimeField(blank=True, null=True, verbose_name='最後の詠草の作成日時')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tanka_summary', to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+        ),
+    ]
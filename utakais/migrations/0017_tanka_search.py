@@ -0,0 +1,68 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:20
+
+import unicodedata
+
+import mojimoji
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+# 以下はこのマイグレーションを作った時点のutakais.searchの写し
+# アプリのコードが変わっても、このマイグレーションの結果は変えない
+TABLE = 'utakais_tanka_fts'
+CREATE_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} "
+    "USING fts5(body, tokenize = 'unicode61 remove_diacritics 0')"
+)
+DROP_TABLE_SQL = f'DROP TABLE IF EXISTS {TABLE}'
+
+
+def normalize(text):
+    """全角英数字を半角に、半角カナを全角にし、小文字にそろえ、文字・数字以外を除く"""
+    text = mojimoji.zen_to_han(text, kana=False)
+    text = mojimoji.han_to_zen(text, ascii=False, digit=False)
+    return ''.join(char for char in text.lower() if unicodedata.category(char)[0] in 'LN')
+
+
+def index_text(text):
+    """索引に入れる文字列(2文字ずつのトークンと末尾の1文字を空白で区切ったもの)"""
+    chars = normalize(text)
+    if not chars:
+        return ''
+    return ' '.join([*(chars[i:i + 2] for i in range(len(chars) - 1)), chars[-1]])
+
+
+def create_index(apps, schema_editor):
+    """詠草の全文検索の索引(FTS5)を作り、既存の詠草を入れる(SQLiteのときのみ)"""
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE_TABLE_SQL)
+    Tanka = apps.get_model('utakais', 'Tanka')
+    rows = Tanka.objects.order_by('pk').values_list('pk', 'content_text')
+    batch = []
+    with connection.cursor() as cursor:
+        for pk, text in rows.iterator(chunk_size=BATCH_SIZE):
+            batch.append((pk, index_text(text)))
+            if len(batch) >= BATCH_SIZE:
+                cursor.executemany(f'INSERT INTO {TABLE} (rowid, body) VALUES (%s, %s)', batch)
+                batch = []
+        if batch:
+            cursor.executemany(f'INSERT INTO {TABLE} (rowid, body) VALUES (%s, %s)', batch)
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(DROP_TABLE_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0016_usertankasummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
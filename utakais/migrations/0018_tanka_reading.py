@@ -0,0 +1,97 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:11
+
+import unicodedata
+
+import mojimoji
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+# 以下はこのマイグレーションを作った時点のpoegrass.utils・utakais.searchの写し
+# アプリのコードが変わっても、このマイグレーションの結果は変えない
+def tokenize_ruby(text):
+    """ルビのマークアップを(本文, ルビ)のリストに分解する。ルビのない部分のルビはNone"""
+    tokens = []
+    cursor = 0
+    search = 0
+    while True:
+        start = text.find('<ruby>', search)
+        if start < 0:
+            break
+        group_start = start + len('<ruby>')
+        end = text.find('</ruby>', group_start)
+        if end < 0:
+            break
+        if text.find('\n', group_start, end) >= 0:
+            search = start + 1
+            continue
+        if start > cursor:
+            tokens.append((text[cursor:start], None))
+        cursor_B = group_start
+        while True:
+            rt_start = text.find('<rt>', cursor_B, end)
+            if rt_start < 0:
+                break
+            rt_end = text.find('</rt>', rt_start + len('<rt>'), end)
+            if rt_end < 0:
+                break
+            tokens.append((text[cursor_B:rt_start], text[rt_start + len('<rt>'):rt_end]))
+            cursor_B = rt_end + len('</rt>')
+        cursor = search = end + len('</ruby>')
+    if cursor < len(text):
+        tokens.append((text[cursor:], None))
+    return tokens
+
+
+def ruby_tokens_to_reading(tokens):
+    return ''.join(rubyText or baseText for baseText, rubyText in tokens)
+
+
+# ァ(U+30A1)～ヶ(U+30F6)をぁ(U+3041)～ゖ(U+3096)に
+KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+
+def normalize_reading(text):
+    """全角英数字を半角に、半角カナを全角に、カタカナをひらがなにし、文字・数字以外を除く"""
+    text = mojimoji.zen_to_han(text, kana=False)
+    text = mojimoji.han_to_zen(text, ascii=False, digit=False)
+    return ''.join(
+        char for char in text.lower() if unicodedata.category(char)[0] in 'LN'
+    ).translate(KATAKANA_TO_HIRAGANA)
+
+
+def fill_readings(apps, schema_editor):
+    """既存の詠草のreadingを、BATCH_SIZE件ずつ埋める"""
+    Tanka = apps.get_model('utakais', 'Tanka')
+    batch = []
+    for tanka in Tanka.objects.only('pk', 'content').iterator(chunk_size=BATCH_SIZE):
+        tanka.reading = normalize_reading(ruby_tokens_to_reading(tokenize_ruby(tanka.content)))
+        batch.append(tanka)
+        if len(batch) >= BATCH_SIZE:
+            Tanka.objects.bulk_update(batch, ['reading'])
+            batch = []
+    if batch:
+        Tanka.objects.bulk_update(batch, ['reading'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0017_tanka_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tanka',
+            name='reading',
+            field=models.TextField(blank=True, editable=False, verbose_name='読み'),
+        ),
+        migrations.RunPython(fill_readings, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='tanka',
+            index=models.Index(fields=['reading'], name='tanka_reading'),
+        ),
+    ]
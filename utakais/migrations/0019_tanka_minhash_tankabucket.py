@@ -0,0 +1,117 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:14
+
+import hashlib
+import random
+import struct
+import unicodedata
+
+import django.db.models.deletion
+import mojimoji
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+# 以下はこのマイグレーションを作った時点のutakais.similarity・utakais.searchの写し
+# アプリのコードが変わっても、このマイグレーションの結果は変えない
+# (署名の作り方を変えたときは、index_tanka_similarityで作り直す)
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(20241018)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+_format = struct.Struct(f'<{NUM_PERM}I')
+
+
+def normalize(text):
+    """全角英数字を半角に、半角カナを全角にし、小文字にそろえ、文字・数字以外を除く"""
+    text = mojimoji.zen_to_han(text, kana=False)
+    text = mojimoji.han_to_zen(text, ascii=False, digit=False)
+    return ''.join(char for char in text.lower() if unicodedata.category(char)[0] in 'LN')
+
+
+def shingles(text):
+    chars = normalize(text)
+    if len(chars) <= SHINGLE_SIZE:
+        return {chars} if chars else set()
+    return {chars[i:i + SHINGLE_SIZE] for i in range(len(chars) - SHINGLE_SIZE + 1)}
+
+
+def _permuted(shingle):
+    value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little')
+    return [(a * value + b) % _PRIME & _MAX_HASH for a, b in _PERMUTATIONS]
+
+
+def signature(text):
+    """MinHashの署名(NUM_PERM個の整数のタプル)。文字がなければNone"""
+    rows = [_permuted(shingle) for shingle in shingles(text)]
+    return tuple(map(min, zip(*rows))) if rows else None
+
+
+def band_buckets(data):
+    """(帯の番号, バケット)のリスト。バケットは帯の値のハッシュ(符号付き64bit)"""
+    size = ROWS * 4
+    return [
+        (band, int.from_bytes(hashlib.blake2b(data[band * size:(band + 1) * size], digest_size=8).digest(), 'little', signed=True))
+        for band in range(BANDS)
+    ]
+
+
+def fill_signatures(apps, schema_editor):
+    """既存の詠草の署名とバケットを、BATCH_SIZE件ずつ計算して保存する"""
+    Tanka = apps.get_model('utakais', 'Tanka')
+    TankaBucket = apps.get_model('utakais', 'TankaBucket')
+    batch = []
+
+    def flush():
+        buckets = []
+        for tanka in batch:
+            sig = signature(tanka.content_text)
+            tanka.minhash = None if sig is None else _format.pack(*sig)
+            if tanka.minhash is not None:
+                buckets.extend(
+                    TankaBucket(tanka_id=tanka.pk, band=band, bucket=bucket)
+                    for band, bucket in band_buckets(tanka.minhash)
+                )
+        Tanka.objects.bulk_update(batch, ['minhash'])
+        TankaBucket.objects.filter(tanka__in=[tanka.pk for tanka in batch]).delete()
+        TankaBucket.objects.bulk_create(buckets)
+
+    for tanka in Tanka.objects.only('pk', 'content_text').order_by('pk').iterator(chunk_size=BATCH_SIZE):
+        batch.append(tanka)
+        if len(batch) >= BATCH_SIZE:
+            flush()
+            batch = []
+    if batch:
+        flush()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0018_tanka_reading'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tanka',
+            name='minhash',
+            field=models.BinaryField(null=True, verbose_name='MinHash'),
+        ),
+        migrations.CreateModel(
+            name='TankaBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('band', models.PositiveSmallIntegerField()),
+                ('bucket', models.BigIntegerField()),
+                ('tanka', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lsh_buckets', to='utakais.tanka')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['band', 'bucket'], name='tankabucket_band_bucket')],
+                'constraints': [models.UniqueConstraint(fields=('tanka', 'band'), name='unique_tankabucket_band')],
+            },
+        ),
+        migrations.RunPython(fill_signatures, migrations.RunPython.noop),
+    ]
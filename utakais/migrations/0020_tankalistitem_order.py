@@ -0,0 +1,37 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:17
+
+from django.db import migrations, models
+
+ORDER_GAP = 1024
+BATCH_SIZE = 500
+
+
+def spread_orders(apps, schema_editor):
+    """既存のリストの順序を、ORDER_GAPおきに付け直す(1, 2, 3, ... → 1024, 2048, 3072, ...)"""
+    TankaListItem = apps.get_model('utakais', 'TankaListItem')
+    batch = []
+    position = {}
+    for item in TankaListItem.objects.order_by('tanka_list', 'order', 'pk').iterator(chunk_size=BATCH_SIZE):
+        position[item.tanka_list_id] = position.get(item.tanka_list_id, 0) + 1
+        item.order = position[item.tanka_list_id] * ORDER_GAP
+        batch.append(item)
+        if len(batch) >= BATCH_SIZE:
+            TankaListItem.objects.bulk_update(batch, ['order'])
+            batch = []
+    if batch:
+        TankaListItem.objects.bulk_update(batch, ['order'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utakais', '0019_tanka_minhash_tankabucket'),
+    ]
+
+    operations = [
+        migrations.RunPython(spread_orders, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='tankalistitem',
+            index=models.Index(fields=['tanka_list', 'order'], name='tankalistitem_order'),
+        ),
+    ]
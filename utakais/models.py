@@ -1,4 +1,12 @@
+import bisect
+import hashlib
+import json
+import os
 import random
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import timedelta
 from pathlib import Path
 
@@ -6,15 +14,66 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.core.validators import FileExtensionValidator
-from django.db import models
-from django.db.models import UniqueConstraint
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q, UniqueConstraint, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone
-from docx import Document
 from docx.shared import Pt
-from docx2pdf import convert
 
 from accounts.models import User
-from poegrass.utils import japanese_strftime, make_ruby_whole_sentence
+from poegrass.utils import (
+    file_sha256,
+    japanese_strftime,
+    make_ruby_whole_sentence,
+    ruby_tokens_to_html,
+    ruby_tokens_to_reading,
+    ruby_tokens_to_text,
+    tokenize_ruby,
+)
+
+from . import docx_templates, similarity
+from .converters import get_converter
+from .docx_stream import write_eisou_docx
+from .locks import file_lock
+from .pdf import render_eisou_pdf, render_tankas_pdf
+from .search import normalize_reading
+
+# 詠草一覧のレイアウト(生成処理)を変更したら上げる。フィンガープリントに含まれる
+EISOU_LAYOUT_VERSION = 2
+# 短歌リストの書き出しのレイアウトを変更したら上げる
+ANTHOLOGY_LAYOUT_VERSION = 1
+
+
+def make_eisou_seed():
+    """詠草の並び順を決めるシード"""
+    return random.randrange(2**31)
+
+
+def visible_statuses(user):
+    """userが見られる公開設定。会員は限定公開も見られる"""
+    if user is not None and user.is_authenticated and user.is_member:
+        return ["public", "limited"]
+    return ["public"]
+
+
+class EventQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """
+        userが開ける歌会
+        記録公開前(rec_status="private")は告知の公開設定、記録公開後は記録の公開設定による
+        """
+        statuses = visible_statuses(user)
+        return self.filter(
+            Q(rec_status__in=statuses) | Q(rec_status="private", ann_status__in=statuses)
+        )
+
+    def announcing(self):
+        """記録公開前の歌会"""
+        return self.filter(rec_status="private")
+
+    def recorded(self):
+        """記録公開後の歌会"""
+        return self.exclude(rec_status="private")
 
 
 class Event(models.Model):
@@ -25,6 +84,13 @@ class Event(models.Model):
     )
     # generate_files内で使うメソッドadd_titleなどで呼び出すために設定
     default_title = "%Y年%m月%d日（%a）の歌会"
+    # 詠草一覧の文字の大きさ(pt)と詠草の行間
+    # 行間の設定．8首以下なら等間隔に，9首以上なら4.0．
+    eisou_base_point = 11.0
+    eisou_ruby_point = 6.0
+    eisou_line_spacing = 8.0  # float(32 / len(tankas)) if len(tankas) <= 8 else 4.0
+    # その場で描画したpdf(get_rendered_eisou_pdf)を置く、歌会のディレクトリ内のディレクトリ
+    eisou_rendered_dir = "rendered"
     start_time = models.DateTimeField(
         verbose_name="開始時刻",
         default=timezone.now,
@@ -103,6 +169,45 @@ class Event(models.Model):
         verbose_name="詠草一覧版数",
         default=0,
     )
+    eisou_fingerprint = models.CharField(
+        verbose_name="詠草一覧フィンガープリント",
+        max_length=64,
+        default="",
+        blank=True,
+    )
+    eisou_template = models.CharField(
+        verbose_name="詠草一覧の雛形",
+        max_length=31,
+        default="default",
+    )
+    eisou_seed = models.PositiveIntegerField(
+        verbose_name="詠草シャッフルのシード",
+        default=make_eisou_seed,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name="更新日時",
+        auto_now=True,
+    )
+    # 歌会・参加者・詠草のいずれかが最後に変更された日時。ページのLast-Modified,ETagに使う
+    # 参加者・詠草の変更はsignalsで反映する
+    content_updated_at = models.DateTimeField(
+        verbose_name="内容の更新日時",
+        default=timezone.now,
+        editable=False,
+    )
+
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["ann_status", "start_time"], name="event_ann_status_start"
+            ),
+            models.Index(
+                fields=["rec_status", "start_time"], name="event_rec_status_start"
+            ),
+            models.Index(fields=["start_time"], name="event_start_time"),
+        ]
 
     @property
     def ann_is_public(self):
@@ -144,36 +249,182 @@ class Event(models.Model):
                 raise ValidationError(
                     {"end_time": "終了時刻は開始時刻よりも前にはできません。"}
                 )
+        if self.eisou_template not in docx_templates.registry.names():
+            raise ValidationError(
+                {"eisou_template": "登録されていない雛形です。"}
+            )
         if self.end_time and not self.rec_is_private:
             if self.end_time > timezone.now():
                 raise ValidationError(
                     {"rec_status": "終了時刻より前には記録は公開できません。"}
                 )
 
-    def generate_files(self):
+    # リクエスト中に実行せず、EventJobとしてワーカーに任せるメソッド
+    deferred_methods = ["generate_files"]
+
+    def generate_files(self, force=False):
         """
         詠草一覧のdocx,pdfファイルを生成する
+        リクエスト中ではなく、ワーカー(run_eisou_worker)から呼び出すこと
+        内容(フィンガープリント)が前回の生成時から変わっていなければ、生成せずに既存のファイルを返す
+        同じ歌会の生成は同時に1つしか行わない。生成中に呼ばれた場合はその完了を待ち、結果を使う
+        force=Trueなら内容が変わっていなくても生成し直す
         """
         if self.deadline > timezone.now():
             raise ValueError("締切が終了していないため、詠草一覧を生成できません。")
+        path = settings.MEDIA_ROOT / "events" / Path(str(self.pk))
+        with EventLease.hold(self, "generate_files", lock_dir=path):
+            # 待っている間に他の呼び出しが生成していれば、その結果を読み込む
+            self.refresh_from_db()
+            if force:
+                # 記録済みのフィンガープリントは生成後に上書きされるまでそのまま残す
+                self.eisou_fingerprint = ""
+            return self._generate_files(path)
+
+    def _generate_files(self, path):
+        participants_and_organizer = self.get_eisou_participants()
+        fingerprint = self.compute_eisou_fingerprint(participants_and_organizer)
+        if self.eisou_files_exist and self.eisou_fingerprint == fingerprint:
+            return Path(self.eisou_doc.path), Path(self.eisou_pdf.path)
+
+        title = self.title
+
+        # 作業用のdirを保存先のdir内に作る
+        with tempfile.TemporaryDirectory(dir=path, prefix=".generate-") as work_dir:
+            work_dir = Path(work_dir)
+
+            # ドキュメントの作成と保存(詠草はストリーミングで書き出す)
+            doc_path = work_dir / f"{title}.docx"
+            with doc_path.open(mode="wb") as f:
+                self.write_eisou_docx(f, participants_and_organizer)
+
+            # PDFの生成
+            pdf_path = work_dir / f"{title}.pdf"
+
+            if getattr(settings, "EISOU_PDF_RENDERER", "converter") == "reportlab":
+                # docxを経由せず、ReportLabで直接描画
+                with pdf_path.open(mode="wb") as f:
+                    self.render_eisou_pdf(f, participants_and_organizer)
+            else:
+                # 設定された変換エンジン(settings.EISOU_PDF_CONVERTER)でpdfへ変換
+                get_converter().convert(doc_path, pdf_path)
+
+            # pandocを使ってpdfへ変換
+            # pypandoc.convert_file(
+            #     doc_path,
+            #     'pdf',
+            #     outputfile=pdf_path,
+            #     extra_args=[
+            #         "--pdf-engine=lualatex",
+            #         "-V", "documentclass=ltjsarticle",
+            #         "-V", "luatexjapresetoptions=hiragino-pron"
+            #     ]
+            # )
+
+            # 版番を原子的に1つ進め、版番に応じてファイル名を決定
+            Event.objects.filter(pk=self.pk).update(
+                eisou_number=models.F("eisou_number") + 1
+            )
+            self.refresh_from_db(fields=["eisou_number"])
+            if self.eisou_number == 1:
+                file_name = title
+            else:
+                file_name = f"{title}_ver{self.eisou_number}"
+
+            # eisou_doc,eisou_pdfに保存
+            self.eisou_fingerprint = fingerprint
+            with doc_path.open(mode="rb") as f:
+                self.eisou_doc.save(f"{file_name}.docx", File(f), save=False)
+            with pdf_path.open(mode="rb") as f:
+                self.eisou_pdf.save(f"{file_name}.pdf", File(f), save=False)
+            self.save(update_fields=["eisou_doc", "eisou_pdf", "eisou_fingerprint"])
+
+        return Path(self.eisou_doc.path), Path(self.eisou_pdf.path)
+
+    def eisou_sample_path(self):
+        """詠草一覧の雛形となるdocxのパス"""
+        return docx_templates.registry.path(self.eisou_template)
+
+    def get_eisou_participants(self):
+        """詠草一覧に載せる参加者(司会者を含む)を、ユーザーと詠草ごと1クエリで取得する"""
+        return list(
+            Participant.objects.filter(event=self)
+            .select_related("user", "tanka")
+            .order_by("pk")
+        )
+
+    def compute_eisou_fingerprint(self, participants=None):
+        """
+        詠草一覧の出力に影響するものすべてから計算したハッシュ値
+        タイトル・日付・司会者・参加者名・詠草(ルビを含む)・雛形のハッシュ・シャッフルのシード
+        """
+        if participants is None:
+            participants = self.get_eisou_participants()
+        sample_path = self.eisou_sample_path()
+        data = {
+            "layout": EISOU_LAYOUT_VERSION,
+            "title": self.title,
+            "start_time": timezone.localtime(self.start_time).isoformat(),
+            "organizer": self.organizer.name if self.organizer else "",
+            "organizer_id": self.organizer_id,
+            "participants": [
+                [participant.user_id, participant.name] for participant in participants
+            ],
+            "tankas": [
+                participant.tanka.content if participant.tanka else None
+                for participant in participants
+            ],
+            "template_name": self.eisou_template,
+            "template": file_sha256(sample_path) if sample_path.is_file() else "",
+            "seed": self.eisou_seed,
+            "pdf_renderer": getattr(settings, "EISOU_PDF_RENDERER", "converter"),
+        }
+        serialized = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    @property
+    def eisou_files_exist(self):
+        """DBにdocx,pdfのパスが記録されているか(ファイルシステムは見ない)"""
+        return bool(self.eisou_doc) and bool(self.eisou_pdf)
+
+    def eisou_is_fresh(self):
+        """記録済みの詠草一覧が現在の内容と一致しているか"""
+        if not self.eisou_files_exist or not self.eisou_fingerprint:
+            return False
+        return self.eisou_fingerprint == self.compute_eisou_fingerprint()
+
+    def get_eisou_content(self, participants_and_organizer):
+        """詠草一覧に載せるタイトル・日付・司会者・参加者(司会者を除く)・詠草"""
         title = self.title
         organizer = self.organizer.name
         date = japanese_strftime(
             timezone.localtime(self.start_time), "%Y年%m月%d日（%a）"
         )  # 例: イベント日が含まれる場合
-        participants = Participant.objects.filter(event=self).exclude(
-            user=self.organizer
-        )
-        participants_and_organizer = Participant.objects.filter(event=self)
+        participants = [
+            participant
+            for participant in participants_and_organizer
+            if participant.user_id != self.organizer_id
+        ]
         tankas = [
             f"{participant.tanka.content}"
             for participant in participants_and_organizer
             if participant.tanka
         ]
+        return title, date, organizer, participants, tankas
+
+    def build_eisou_document(self, participants_and_organizer=None):
+        """
+        詠草一覧のdocxをpython-docxで組み立てて返す
+        write_eisou_docxと同じ内容になる。比較のための基準の実装
+        """
+        if participants_and_organizer is None:
+            participants_and_organizer = self.get_eisou_participants()
+        title, date, organizer, participants, tankas = self.get_eisou_content(
+            participants_and_organizer
+        )
 
         # ドキュメントの作成
-        sample_path = settings.MEDIA_ROOT / "events" / "samples" / "utakai_sample.docx"
-        doc = Document(sample_path)
+        doc = docx_templates.get_template(self.eisou_template)
 
         # タイトルの追加
         doc = self.add_title(doc, title)
@@ -182,78 +433,115 @@ class Event(models.Model):
         doc = self.add_info(doc, date, organizer, participants)
 
         # 詠草の追加
-        # 行間の設定．8首以下なら等間隔に，9首以上なら4.0．
-        line_spacing = 8.0  # float(32 / len(tankas)) if len(tankas) <= 8 else 4.0
         doc = self.add_tankas(
-            doc, tankas, basePoint=11.0, rubyPoint=6.0, line_spacing=line_spacing
+            doc,
+            tankas,
+            basePoint=self.eisou_base_point,
+            rubyPoint=self.eisou_ruby_point,
+            line_spacing=self.eisou_line_spacing,
+            seed=self.eisou_seed,
         )
 
-        # 保存先のdir作成
-        path = settings.MEDIA_ROOT / "events" / Path(str(self.pk))
-        path.mkdir(parents=True, exist_ok=True)
-
-        # ドキュメントの保存
-        doc_path = path / f"{title}.docx"
-        doc.save(doc_path)
-
-        # PDFの生成
-        pdf_path = path / f"{title}.pdf"
-
-        # LibreOfficeを使ってpdfへ変換
-        # subprocess.run(
-        #     ["/Applications/LibreOffice.app/Contents/MacOS/soffice",
-        #      "--headless",
-        #      "--convert-to", "pdf",
-        #      doc_path,
-        #      "--outdir", path],
-        # )
-
-        # doc2pdfを使ってpdfへ変換
-        convert(doc_path, pdf_path)
-
-        # pandocを使ってpdfへ変換
-        # pypandoc.convert_file(
-        #     doc_path,
-        #     'pdf',
-        #     outputfile=pdf_path,
-        #     extra_args=[
-        #         "--pdf-engine=lualatex",
-        #         "-V", "documentclass=ltjsarticle",
-        #         "-V", "luatexjapresetoptions=hiragino-pron"
-        #     ]
-        # )
-
-        # 版番に応じてファイル名を決定
-        if self.eisou_number == 0:
-            file_name = title
-        else:
-            file_name = f"{title}_ver{self.eisou_number + 1}"
+        return doc
+
+    def write_eisou_docx(self, out, participants_and_organizer=None):
+        """
+        詠草一覧のdocxをoutにストリーミングで書き出す
+        タイトルと参加者情報はpython-docxで、詠草はdocx_streamで1首ずつ書く
+        """
+        if participants_and_organizer is None:
+            participants_and_organizer = self.get_eisou_participants()
+        title, date, organizer, participants, tankas = self.get_eisou_content(
+            participants_and_organizer
+        )
+        head = docx_templates.get_template(self.eisou_template)
+        head = self.add_title(head, title)
+        head = self.add_info(head, date, organizer, participants)
+        self.shuffle_tankas(tankas, self.eisou_seed)
+        return write_eisou_docx(
+            out,
+            self.eisou_sample_path(),
+            head,
+            tankas,
+            basePoint=self.eisou_base_point,
+            rubyPoint=self.eisou_ruby_point,
+            line_spacing=self.eisou_line_spacing,
+        )
 
-        # eisou_doc,eisou_pdfに保存
-        with doc_path.open(mode="rb") as f:
-            self.eisou_doc.save(f"{file_name}.docx", File(f), save=True)
-        with pdf_path.open(mode="rb") as f:
-            self.eisou_pdf.save(f"{file_name}.pdf", File(f), save=True)
-        self.eisou_number += 1
-        self.save()
+    def render_eisou_pdf(self, out, participants_and_organizer=None):
+        """
+        docxを経由せず、詠草一覧のpdfをReportLabで直接outに書き出す
+        詠草の並び順はadd_tankasと同じシードで決める
+        """
+        if participants_and_organizer is None:
+            participants_and_organizer = self.get_eisou_participants()
+        title, date, organizer, participants, tankas = self.get_eisou_content(
+            participants_and_organizer
+        )
+        self.shuffle_tankas(tankas, self.eisou_seed)
+        return render_eisou_pdf(
+            out,
+            self.get_head_title(title),
+            date,
+            organizer,
+            [participant.name for participant in participants],
+            tankas,
+            basePoint=self.eisou_base_point,
+            rubyPoint=self.eisou_ruby_point,
+            line_spacing=self.eisou_line_spacing,
+        )
 
-        # djangoの動作で名前が変更された時,元のファイルを削除
-        if Path(self.eisou_doc.path) != doc_path:
-            doc_path.unlink()
-        if Path(self.eisou_pdf.path) != pdf_path:
-            pdf_path.unlink()
+    def get_rendered_eisou_pdf(self):
+        """
+        ReportLabで直接描画した詠草一覧のpdfのパスを返す(eisou.pdfの配信用)
+        内容(フィンガープリントとフォント)ごとにMEDIA_ROOT/events/<id>/rendered/に保存し、
+        同じ内容なら描画しない。古いファイルはgc_eisouが猶予をおいて消す
+        """
+        participants_and_organizer = self.get_eisou_participants()
+        key = hashlib.sha256(
+            "\n".join(
+                [
+                    self.compute_eisou_fingerprint(participants_and_organizer),
+                    str(getattr(settings, "EISOU_PDF_FONT", None)),
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+        directory = (
+            settings.MEDIA_ROOT / "events" / str(self.pk) / self.eisou_rendered_dir
+        )
+        path = directory / f"{key}.pdf"
+        if path.is_file():
+            return path
+        with file_lock(directory / ".render.lock"):
+            if path.is_file():
+                return path
+            with tempfile.TemporaryDirectory(
+                dir=directory, prefix=".render-"
+            ) as work_dir:
+                work_path = Path(work_dir) / path.name
+                with work_path.open(mode="wb") as f:
+                    self.render_eisou_pdf(f, participants_and_organizer)
+                os.replace(work_path, path)
+        return path
+
+    def get_head_title(self, title):
+        """詠草一覧の見出し。タイトルが既定のものなら共通の見出しにする"""
+        if title == japanese_strftime(
+            timezone.localtime(self.start_time), self.default_title
+        ):
+            return "京大短歌歌会　詠草一覧"
+        return title
 
-        return doc_path, pdf_path
+    @staticmethod
+    def shuffle_tankas(tankas, seed=None):
+        """詠草をシャッフルする。seedを指定すると同じ並び順になる"""
+        random.Random(seed).shuffle(tankas)
+        return tankas
 
     def add_title(self, doc, title):
         """タイトルを追加する"""
         head = doc.paragraphs[0]
-        if title == japanese_strftime(
-            timezone.localtime(self.start_time), self.default_title
-        ):
-            head_title = "京大短歌歌会　詠草一覧"
-        else:
-            head_title = title
+        head_title = self.get_head_title(title)
         title_run = head.add_run(head_title)
         title_run.font.size = Pt(14)
         head.paragraph_format.line_spacing = 1.0
@@ -273,10 +561,18 @@ class Event(models.Model):
 
         return doc
 
-    def add_tankas(self, doc, tankas, basePoint=11.0, rubyPoint=6.0, line_spacing=4.0):
-        """詠草を追加する"""
+    def add_tankas(
+        self,
+        doc,
+        tankas,
+        basePoint=11.0,
+        rubyPoint=6.0,
+        line_spacing=4.0,
+        seed=None,
+    ):
+        """詠草を追加する。seedを指定すると同じ並び順になる"""
         body = doc.add_paragraph()
-        random.shuffle(tankas)
+        self.shuffle_tankas(tankas, seed)
         for i, tanka in enumerate(tankas):
             # 最初以外改行する
             if i != 0:
@@ -322,12 +618,29 @@ class Event(models.Model):
             super().save(*args, **kwargs)
             self.eisou_pdf = uploaded_file
 
+        self.content_updated_at = timezone.now()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {
+                *update_fields,
+                "updated_at",
+                "content_updated_at",
+            }
         super().save(*args, **kwargs)
 
     def __str__(self):
         return self.title
 
 
+class TankaQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """userが見られる詠草。自分の詠草は公開設定によらず見られる"""
+        condition = Q(status__in=visible_statuses(user))
+        if user is not None and user.is_authenticated:
+            condition |= Q(author=user)
+        return self.filter(condition)
+
+
 class Tanka(models.Model):
     content = models.TextField(
         verbose_name="詠草",
@@ -357,6 +670,39 @@ class Tanka(models.Model):
         verbose_name="作成日時",
         auto_now_add=True,
     )
+    # contentのルビのマークアップを保存時に解釈したもの。表示のたびに解釈しないようにする
+    content_html = models.TextField(
+        verbose_name="詠草(HTML)",
+        blank=True,
+        editable=False,
+    )
+    content_text = models.TextField(
+        verbose_name="詠草(ルビなし)",
+        blank=True,
+        editable=False,
+    )
+    # 本文をルビに置き換えてひらがなにそろえたもの。読みによる検索(search.search_by_reading)に使う
+    reading = models.TextField(
+        verbose_name="読み",
+        blank=True,
+        editable=False,
+    )
+    # 本文のMinHashの署名。よく似た詠草の検出(similarity)に使う。本文に文字がなければNULL
+    minhash = models.BinaryField(
+        verbose_name="MinHash",
+        null=True,
+        editable=False,
+    )
+
+    objects = TankaQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "created_at"], name="tanka_status_created"
+            ),
+            models.Index(fields=["reading"], name="tanka_reading"),
+        ]
 
     def clean(self):
         if not self.author and self.guest_author == "":
@@ -369,8 +715,26 @@ class Tanka(models.Model):
     def save(self, *args, **kwargs):
         if self.author:
             self.guest_author = ""
+        self.render_content()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "content" in update_fields:
+            kwargs["update_fields"] = {
+                *update_fields,
+                "content_html",
+                "content_text",
+                "reading",
+                "minhash",
+            }
         super().save(*args, **kwargs)
 
+    def render_content(self):
+        """contentからcontent_html,content_text,reading,minhashを作る"""
+        tokens = tokenize_ruby(self.content)
+        self.content_html = ruby_tokens_to_html(tokens)
+        self.content_text = ruby_tokens_to_text(tokens)
+        self.reading = normalize_reading(ruby_tokens_to_reading(tokens))
+        self.minhash = similarity.pack(similarity.signature(self.content_text))
+
     @property
     def is_public(self):
         return self.status == "public"
@@ -387,6 +751,24 @@ class Tanka(models.Model):
         return self.content if self.content else ""
 
 
+class TankaBucket(models.Model):
+    """詠草のMinHashの署名の帯ごとのバケット(similarity)。同じバケットの詠草がよく似た詠草の候補になる"""
+
+    tanka = models.ForeignKey(
+        Tanka, on_delete=models.CASCADE, related_name="lsh_buckets"
+    )
+    band = models.PositiveSmallIntegerField()
+    bucket = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["band", "bucket"], name="tankabucket_band_bucket"),
+        ]
+        constraints = [
+            UniqueConstraint(fields=["tanka", "band"], name="unique_tankabucket_band"),
+        ]
+
+
 class Participant(models.Model):
     user = models.ForeignKey(
         User,
@@ -503,26 +885,250 @@ class TankaList(models.Model):
     )
 
     def add_tanka(self, tanka):
-        if not self.tankalistitem_set.filter(tanka=tanka).exists():
-            last_order = self.tankalistitem_set.aggregate(
-                max_order=models.Max("order")
-            )["max_order"]
-            new_order = (last_order or 0) + 1
-            TankaListItem.objects.create(tanka_list=self, tanka=tanka, order=new_order)
-        else:
+        try:
+            with transaction.atomic():
+                TankaListItem.objects.create(
+                    tanka_list=self, tanka=tanka, order=self._next_order()
+                )
+        except IntegrityError:
             raise ValueError("この短歌は既に追加されています。")
 
+    def add_tankas(self, tankas):
+        """
+        tankasを末尾に順に追加する。既に追加されている短歌は無視する(unique_tanka_in_list)
+        件数によらず、最後の順序の取得と1回のINSERTで行う
+        """
+        start = self._next_order()
+        gap = TankaListItem.ORDER_GAP
+        TankaListItem.objects.bulk_create(
+            [
+                TankaListItem(tanka_list=self, tanka=tanka, order=start + gap * i)
+                for i, tanka in enumerate(tankas)
+            ],
+            ignore_conflicts=True,
+        )
+
+    anthology_base_point = 11.0
+    anthology_ruby_point = 6.0
+    anthology_line_spacing = 4.0
+    # 短歌リストごとに形式ごとに残す書き出しのファイル数(gc_eisouが使う)
+    # 閲覧者の区分ごとに別のファイルになる
+    anthology_keep_files = 6
+
+    @staticmethod
+    def anthology_file_types():
+        """
+        書き出せる形式。書き出しはリクエストの中で行うため、
+        LibreOfficeでの変換が要るpdfは、ReportLabで描画する場合(EISOU_PDF_RENDERER)のみ
+        """
+        if getattr(settings, "EISOU_PDF_RENDERER", "converter") == "reportlab":
+            return ("docx", "pdf")
+        return ("docx",)
+
+    def export_anthology(self, file_type, user=None):
+        """
+        短歌リストをanthology_file_types()の形式に書き出し、ファイルのパスを返す
+        userが見られる短歌だけを、リストの順に載せる。ルビは詠草一覧と同じ処理で付ける
+        ファイルは内容(フィンガープリント)ごとにMEDIA_ROOT/lists/<id>/に保存し、同じ内容なら書き出さない
+        古いファイルはgc_eisouが猶予をおいて消す(配信中のファイルを消さないよう、ここでは消さない)
+        """
+        if file_type not in self.anthology_file_types():
+            raise ValueError(f"{file_type}の形式には書き出せません。")
+        items = self.get_anthology_items(user)
+        fingerprint = self.compute_anthology_fingerprint(items)
+        directory = settings.MEDIA_ROOT / "lists" / str(self.pk)
+        path = directory / f"{fingerprint}.{file_type}"
+        if path.is_file():
+            return path
+        # 同じリストの書き出しは同時に1つしか行わない。待っている間に書き出されていればそれを使う
+        with file_lock(directory / ".export.lock"):
+            if path.is_file():
+                return path
+            with tempfile.TemporaryDirectory(
+                dir=directory, prefix=".export-"
+            ) as work_dir:
+                work_path = Path(work_dir) / path.name
+                self._write_anthology(work_path, file_type, items)
+                os.replace(work_path, path)
+        return path
+
+    def _write_anthology(self, path, file_type, items):
+        with path.open(mode="wb") as f:
+            if file_type == "docx":
+                self.write_anthology_docx(f, items)
+            else:
+                self.render_anthology_pdf(f, items)
+
+    def get_anthology_items(self, user=None):
+        """書き出す項目(userが見られる短歌のみ)をリストの順に返す。userがNoneならすべて"""
+        items = self.tankalistitem_set.select_related("tanka", "tanka__author")
+        if user is not None:
+            items = items.filter(tanka__in=Tanka.objects.visible_to(user))
+        return items.order_by("order", "pk")
+
+    def iter_anthology_tankas(self, items, chunk_size=200):
+        """
+        書き出す短歌(ルビのマークアップを含む)と筆名を1首ずつ返す
+        chunk_size件ずつ取得するので、リストが長くても全件を保持しない
+        """
+        for item in items.iterator(chunk_size=chunk_size):
+            tanka = item.tanka
+            author = tanka.author.name if tanka.author else tanka.guest_author
+            yield f"{tanka.content}　{author}" if author else tanka.content
+
+    def get_anthology_info(self):
+        info = f"【編者】{self.owner.name}"
+        if self.description:
+            info += f"\n{self.description}"
+        return info
+
+    def compute_anthology_fingerprint(self, items):
+        """書き出しに影響するものすべて(短歌は1首ずつ読んで足していく)から計算したハッシュ値"""
+        sample_path = docx_templates.registry.path()
+        header = {
+            "layout": ANTHOLOGY_LAYOUT_VERSION,
+            "title": self.title,
+            "info": self.get_anthology_info(),
+            "template": file_sha256(sample_path) if sample_path.is_file() else "",
+            "pdf_renderer": getattr(settings, "EISOU_PDF_RENDERER", "converter"),
+        }
+        h = hashlib.sha256(
+            json.dumps(header, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        )
+        for tanka in self.iter_anthology_tankas(items):
+            h.update(b"\0" + tanka.encode("utf-8"))
+        return h.hexdigest()
+
+    def write_anthology_docx(self, out, items):
+        """短歌リストのdocxをoutにストリーミングで書き出す(詠草一覧と同じdocx_streamを使う)"""
+        head = docx_templates.get_template()
+        title = head.paragraphs[0]
+        title.add_run(self.title).font.size = Pt(14)
+        title.paragraph_format.line_spacing = 1.0
+        info = head.add_paragraph(self.get_anthology_info())
+        info.runs[0].font.size = Pt(12)
+        info.paragraph_format.space_after = Pt(20.0)
+        return write_eisou_docx(
+            out,
+            docx_templates.registry.path(),
+            head,
+            self.iter_anthology_tankas(items),
+            basePoint=self.anthology_base_point,
+            rubyPoint=self.anthology_ruby_point,
+            line_spacing=self.anthology_line_spacing,
+        )
+
+    def render_anthology_pdf(self, out, items):
+        """docxを経由せず、短歌リストのpdfをReportLabで直接outに書き出す"""
+        return render_tankas_pdf(
+            out,
+            self.title,
+            self.get_anthology_info(),
+            self.iter_anthology_tankas(items),
+            basePoint=self.anthology_base_point,
+            rubyPoint=self.anthology_ruby_point,
+            line_spacing=self.anthology_line_spacing,
+        )
+
+    def _next_order(self):
+        last_order = self.tankalistitem_set.aggregate(max_order=models.Max("order"))[
+            "max_order"
+        ]
+        return (last_order or 0) + TankaListItem.ORDER_GAP
+
+    def reorder(self, tanka_ids):
+        """
+        短歌をtanka_ids(リストの短歌のidをすべて、新しい順に並べたもの)の順に並べ替え、更新した件数を返す
+        今の順序のまま並んでいる最長の部分(最長増加部分列)は動かさず、残りだけに間の順序を付ける
+        1首を動かすだけなら1行の更新ですむ。間が足りなければrebalanceで付け直す
+        """
+        items = {item.tanka_id: item for item in self.tankalistitem_set.all()}
+        tanka_ids = list(tanka_ids)
+        if len(tanka_ids) != len(items) or set(tanka_ids) != set(items):
+            raise ValueError("リストの短歌をすべて1回ずつ指定してください。")
+        ordered = [items[tanka_id] for tanka_id in tanka_ids]
+        kept = _longest_increasing([item.order for item in ordered])
+
+        changed = []
+        lower = 0  # 直前の短歌の順序
+        run = []  # 直前の動かさない短歌より後の、動かす短歌
+        for i, item in enumerate([*ordered, None]):
+            if item is not None and i not in kept:
+                run.append(item)
+                continue
+            if run:
+                if item is None:
+                    upper = lower + TankaListItem.ORDER_GAP * (len(run) + 1)
+                else:
+                    upper = item.order
+                step = (upper - lower) // (len(run) + 1)
+                if step == 0:
+                    return self.rebalance(ordered)
+                for j, moved in enumerate(run, start=1):
+                    moved.order = lower + step * j
+                    changed.append(moved)
+                run = []
+            if item is not None:
+                lower = item.order
+        TankaListItem.objects.bulk_update(changed, ["order"])
+        return len(changed)
+
+    def rebalance(self, items=None):
+        """
+        順序をORDER_GAPおきに付け直し、更新した件数を返す
+        items: 並べる順のTankaListItem(省略すると今の順)
+        """
+        if items is None:
+            items = list(self.tankalistitem_set.order_by("order", "pk"))
+        changed = []
+        for i, item in enumerate(items, start=1):
+            order = TankaListItem.ORDER_GAP * i
+            if item.order != order:
+                item.order = order
+                changed.append(item)
+        TankaListItem.objects.bulk_update(changed, ["order"])
+        return len(changed)
+
     def __str__(self):
         return self.title
 
 
+def _longest_increasing(values):
+    """valuesの最長増加部分列の位置の集合(O(n log n))"""
+    tails = []  # 長さk+1の増加部分列の末尾の位置(値が最小のもの)
+    tail_values = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tail_values, value)
+        if k > 0:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+    kept = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+    return kept
+
+
 class TankaListItem(models.Model):
+    # 順序の間隔。間に入れる・動かすときは前後の間の値を使い、1行の更新ですませる
+    ORDER_GAP = 1024
+
     tanka_list = models.ForeignKey(TankaList, on_delete=models.CASCADE)
     tanka = models.ForeignKey(Tanka, on_delete=models.CASCADE)
     order = models.PositiveIntegerField()  # 順序を表すフィールド
 
     class Meta:
         ordering = ["order"]  # orderフィールドに基づいて順序を並べ替え
+        indexes = [
+            models.Index(fields=["tanka_list", "order"], name="tankalistitem_order"),
+        ]
         constraints = [
             models.UniqueConstraint(
                 fields=["tanka_list", "tanka"], name="unique_tanka_in_list"
@@ -531,3 +1137,252 @@ class TankaListItem(models.Model):
 
     def __str__(self):
         return f"({self.order}){self.tanka.content[:5]}"
+
+
+class EventJob(models.Model):
+    """
+    Eventのメソッドをバックグラウンドで実行するためのジョブ
+    manage.py run_eisou_worker で起動したワーカーが順に処理する
+    """
+
+    STATUS_CHOICES = [
+        ("queued", "待機中"),
+        ("running", "実行中"),
+        ("done", "完了"),
+        ("failed", "失敗"),
+    ]
+    event = models.ForeignKey(
+        Event,
+        verbose_name="対象イベント",
+        on_delete=models.CASCADE,
+        related_name="jobs",
+    )
+    method_name = models.CharField(
+        verbose_name="実行メソッド",
+        max_length=63,
+        default="generate_files",
+    )
+    status = models.CharField(
+        verbose_name="状態",
+        max_length=7,
+        choices=STATUS_CHOICES,
+        default="queued",
+    )
+    error = models.TextField(
+        verbose_name="エラー内容",
+        default="",
+        blank=True,
+    )
+    created_at = models.DateTimeField(
+        verbose_name="作成日時",
+        auto_now_add=True,
+    )
+    started_at = models.DateTimeField(
+        verbose_name="開始日時",
+        null=True,
+        blank=True,
+    )
+    finished_at = models.DateTimeField(
+        verbose_name="終了日時",
+        null=True,
+        blank=True,
+    )
+
+    @property
+    def is_pending(self):
+        return self.status in ("queued", "running")
+
+    @property
+    def is_failed(self):
+        return self.status == "failed"
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="eventjob_status_created"),
+        ]
+        constraints = [
+            # 同じ歌会・メソッドの待機中のジョブは1つまで
+            UniqueConstraint(
+                fields=["event", "method_name"],
+                condition=models.Q(status="queued"),
+                name="unique_queued_eventjob",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.event}:{self.method_name}({self.status})"
+
+
+class EventLease(models.Model):
+    """
+    Eventごとの処理を同時に1つだけ実行するための貸出行
+    (event, name)ごとに1行しか作れないことを排他に使う
+    """
+
+    event = models.ForeignKey(
+        Event,
+        verbose_name="対象イベント",
+        on_delete=models.CASCADE,
+        related_name="leases",
+    )
+    name = models.CharField(
+        verbose_name="処理名",
+        max_length=63,
+    )
+    owner = models.CharField(
+        verbose_name="保持者",
+        max_length=32,
+    )
+    expires_at = models.DateTimeField(
+        verbose_name="期限",
+    )
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["event", "name"], name="unique_event_lease")
+        ]
+
+    @classmethod
+    @contextmanager
+    def hold(
+        cls,
+        event,
+        name,
+        lock_dir=None,
+        lease_seconds=600,
+        wait_seconds=900,
+        poll_interval=0.2,
+    ):
+        """
+        貸出を受けている間だけ処理を行うためのコンテキストマネージャ
+        他が保持していれば、解放されるか期限が切れるまで待つ
+        lock_dirを指定すると、その中のロックファイルでも排他する(同じホストのプロセス間)
+        """
+        owner = uuid.uuid4().hex
+        give_up_at = time.monotonic() + wait_seconds
+        while True:
+            now = timezone.now()
+            # 保持したまま落ちたプロセスの貸出は期限切れで回収する
+            cls.objects.filter(event=event, name=name, expires_at__lt=now).delete()
+            try:
+                with transaction.atomic():
+                    cls.objects.create(
+                        event=event,
+                        name=name,
+                        owner=owner,
+                        expires_at=now + timedelta(seconds=lease_seconds),
+                    )
+                break
+            except IntegrityError:
+                if time.monotonic() > give_up_at:
+                    raise TimeoutError(f"{event}の{name}の完了を待てませんでした。")
+                time.sleep(poll_interval)
+        try:
+            if lock_dir is None:
+                yield
+            else:
+                with file_lock(Path(lock_dir) / f".{name}.lock"):
+                    yield
+        finally:
+            cls.objects.filter(event=event, name=name, owner=owner).delete()
+
+    def __str__(self):
+        return f"{self.event}:{self.name}"
+
+
+class UserTankaSummary(models.Model):
+    """
+    ユーザーごとの詠草・参加の集計(プロフィールに表示する)
+    詠草・参加の追加・削除のたびにsignalsで差分だけ更新する
+    行がなければsummary_forで集計し直して作る
+    """
+
+    user = models.OneToOneField(
+        User,
+        verbose_name="ユーザー",
+        on_delete=models.CASCADE,
+        related_name="tanka_summary",
+    )
+    tanka_count = models.PositiveIntegerField(
+        verbose_name="詠草数",
+        default=0,
+    )
+    event_count = models.PositiveIntegerField(
+        verbose_name="参加した歌会の数",
+        default=0,
+    )
+    first_activity_at = models.DateTimeField(
+        verbose_name="最初の詠草の作成日時",
+        null=True,
+        blank=True,
+    )
+    last_activity_at = models.DateTimeField(
+        verbose_name="最後の詠草の作成日時",
+        null=True,
+        blank=True,
+    )
+
+    @classmethod
+    def summary_for(cls, user):
+        """userの集計を返す。まだなければ集計して作る"""
+        try:
+            return cls.objects.get(user=user)
+        except cls.DoesNotExist:
+            pass
+        summary = cls(user=user, **cls.aggregate(user))
+        try:
+            with transaction.atomic():
+                summary.save()
+        except IntegrityError:
+            # 同時に作られた
+            return cls.objects.get(user=user)
+        return summary
+
+    @staticmethod
+    def aggregate(user):
+        tankas = Tanka.objects.filter(author=user).aggregate(
+            tanka_count=models.Count("pk"),
+            first_activity_at=models.Min("created_at"),
+            last_activity_at=models.Max("created_at"),
+        )
+        tankas["event_count"] = Participant.objects.filter(user=user).count()
+        return tankas
+
+    @classmethod
+    def tanka_added(cls, tanka):
+        cls.objects.filter(user_id=tanka.author_id).update(
+            tanka_count=models.F("tanka_count") + 1,
+            first_activity_at=Coalesce("first_activity_at", Value(tanka.created_at)),
+            last_activity_at=Greatest(
+                Coalesce("last_activity_at", Value(tanka.created_at)),
+                Value(tanka.created_at),
+            ),
+        )
+
+    @classmethod
+    def tanka_removed(cls, tanka):
+        summaries = cls.objects.filter(user_id=tanka.author_id)
+        summaries.filter(tanka_count__gt=0).update(
+            tanka_count=models.F("tanka_count") - 1
+        )
+        # 最初・最後の詠草が削除された場合だけ、日時を集計し直す
+        for summary in summaries.filter(
+            Q(first_activity_at=tanka.created_at) | Q(last_activity_at=tanka.created_at)
+        ):
+            dates = Tanka.objects.filter(author_id=tanka.author_id).aggregate(
+                first=models.Min("created_at"), last=models.Max("created_at")
+            )
+            summary.first_activity_at = dates["first"]
+            summary.last_activity_at = dates["last"]
+            summary.save(update_fields=["first_activity_at", "last_activity_at"])
+
+    @classmethod
+    def participation_changed(cls, user_id, delta):
+        summaries = cls.objects.filter(user_id=user_id)
+        if delta < 0:
+            summaries = summaries.filter(event_count__gt=0)
+        summaries.update(event_count=models.F("event_count") + delta)
+
+    def __str__(self):
+        return f"{self.user}の集計"
@@ -0,0 +1,63 @@
+"""
+キーセット(カーソル)によるページ送り
+OFFSETを使わず、前のページの最後の行の(並び順のキー, id)より後ろを取得する
+テーブルが大きくなっても、1ページの取得にかかる時間は変わらない
+"""
+
+import base64
+from dataclasses import dataclass
+from datetime import datetime
+
+from django.db.models import Q
+
+
+@dataclass
+class KeysetPage:
+    object_list: list
+    next_cursor: str | None  # 次のページがなければNone
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(value, pk):
+    raw = f"{value.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """カーソルを(日時, id)に戻す。不正なカーソルならValueErrorを送出する"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, pk = base64.urlsafe_b64decode(padded).decode("utf-8").split("|")
+        return datetime.fromisoformat(value), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"不正なカーソルです: {cursor}") from e
+
+
+def keyset_page(queryset, field, cursor=None, per_page=20, descending=False):
+    """
+    querysetを(field, pk)の順に並べ、cursorの次からper_page件を返す
+    fieldとpkの組で順序が一意に決まるため、同じ日時の行があっても重複・欠落しない
+    """
+    if descending:
+        ordering = (f"-{field}", "-pk")
+        lookup = "lt"
+    else:
+        ordering = (field, "pk")
+        lookup = "gt"
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f"{field}__{lookup}": value}) | Q(**{field: value, f"pk__{lookup}": pk})
+        )
+    # 1件多く取得して、次のページがあるかを判定する
+    rows = list(queryset.order_by(*ordering)[: per_page + 1])
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, field), last.pk)
+    else:
+        next_cursor = None
+    return KeysetPage(rows, next_cursor)
@@ -0,0 +1,256 @@
+"""
+ReportLabで詠草一覧のpdfを直接描画する
+雛形(utakai_sample.docx)と同じA4横・縦書き(行は右から左へ進む)で、
+Event.add_title/add_info/add_tankasと同じ内容を描く
+短歌リストの書き出し(TankaList.export_anthology)にも使う
+"""
+
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from poegrass.utils import tokenize_ruby
+
+# 雛形の余白(pt)と行送りの基準(docGridのlinePitch)
+MARGIN_TOP = 72.0
+MARGIN_BOTTOM = 72.0
+MARGIN_LEFT = 54.0
+MARGIN_RIGHT = 54.0
+LINE_PITCH = 18.0
+
+# 縦書きで右上に寄せる文字、90度回転させる文字
+SHIFTED_CHARS = set("、。，．,.")
+ROTATED_CHARS = set("ー－―〜～…‥（）()「」『』【】［］〔〕＜＞<>＝=")
+
+_font_lock = threading.Lock()
+_registered_fonts = {}  # フォントのパス → 登録した名前
+
+
+def get_font_name():
+    """
+    詠草一覧に使うフォントを登録して名前を返す
+    settings.EISOU_PDF_FONTのTrueTypeフォント(.ttf/.ttc)のサブセットを埋め込む
+    埋め込まないフォントでは閲覧環境によって表示が変わるため、未設定ならImproperlyConfiguredを送出する
+    """
+    font_path = getattr(settings, "EISOU_PDF_FONT", None)
+    if not font_path:
+        raise ImproperlyConfigured(
+            "ReportLabで描画するには、EISOU_PDF_FONTに"
+            "埋め込む日本語のTrueTypeフォントを設定してください。"
+        )
+    font_path = str(font_path)
+    with _font_lock:
+        if font_path not in _registered_fonts:
+            try:
+                font = TTFont(f"EisouFont{len(_registered_fonts)}", font_path)
+            except Exception as e:
+                raise ImproperlyConfigured(
+                    f"EISOU_PDF_FONTのフォントを読み込めません: {font_path}"
+                ) from e
+            pdfmetrics.registerFont(font)
+            _registered_fonts[font_path] = font.fontName
+        return _registered_fonts[font_path]
+
+
+def font_configured():
+    """EISOU_PDF_FONTにフォントのファイルが設定されているか"""
+    font_path = getattr(settings, "EISOU_PDF_FONT", None)
+    return bool(font_path) and Path(font_path).is_file()
+
+
+@checks.register()
+def check_font(app_configs, **kwargs):
+    """EISOU_PDF_RENDERER = "reportlab"なのにフォントがなければ、起動時に知らせる"""
+    if getattr(settings, "EISOU_PDF_RENDERER", "converter") != "reportlab":
+        return []
+    if font_configured():
+        return []
+    return [
+        checks.Error(
+            "EISOU_PDF_FONTに埋め込む日本語のTrueTypeフォントがありません。",
+            hint="EISOU_PDF_FONTにフォント(.ttf/.ttc)のパスを設定してください。",
+            id="utakais.E001",
+        )
+    ]
+
+
+@checks.register(deploy=True)
+def check_rendered_pdf_font(app_configs, **kwargs):
+    """その場で描画するpdf(eisou.pdf)はフォントがなければ404になるため、本番では知らせる"""
+    if font_configured():
+        return []
+    return [
+        checks.Warning(
+            "EISOU_PDF_FONTがないため、eisou.pdfは配信されません(404)。",
+            hint="EISOU_PDF_FONTにフォント(.ttf/.ttc)のパスを設定してください。",
+            id="utakais.W001",
+        )
+    ]
+
+
+class VerticalPdfWriter:
+    """縦書きで1行ずつ(右から左へ)描画していくpdfの書き手"""
+
+    def __init__(self, out, font_name=None, pagesize=landscape(A4)):
+        self.font_name = font_name or get_font_name()
+        self.canvas = canvas.Canvas(out, pagesize=pagesize)
+        self.width, self.height = pagesize
+        self.top = self.height - MARGIN_TOP
+        self.bottom = MARGIN_BOTTOM
+        self.left = MARGIN_LEFT
+        self.right = self.width - MARGIN_RIGHT
+        self.x = self.right  # 次の行の右端
+        self.y = self.top  # 現在の行で次に書く文字の上端
+        self.pitch = 0.0  # 現在の行の幅
+        self.has_content = False
+
+    def _begin_column(self, pitch):
+        if self.has_content and self.x - pitch < self.left:
+            self.canvas.showPage()
+            self.x = self.right
+        self.pitch = pitch
+        self.y = self.top
+        self.has_content = True
+
+    def _end_column(self):
+        self.x -= self.pitch
+
+    def _next_column(self):
+        pitch = self.pitch
+        self._end_column()
+        self._begin_column(pitch)
+
+    def _draw_char(self, ch, center_x, top, size):
+        c = self.canvas
+        c.setFont(self.font_name, size)
+        baseline = top - size * 0.88
+        if ch in SHIFTED_CHARS:
+            c.drawCentredString(center_x + size * 0.6, baseline + size * 0.6, ch)
+        elif ch in ROTATED_CHARS:
+            c.saveState()
+            c.translate(center_x, top - size / 2)
+            c.rotate(-90)
+            c.drawCentredString(0, -size * 0.38, ch)
+            c.restoreState()
+        else:
+            c.drawCentredString(center_x, baseline, ch)
+
+    def write_line(self, pieces, size, ruby_size=None, line_spacing=1.0):
+        """
+        (本文, ルビ)のリストを1段落として縦書きで描く
+        本文中の改行で次の行へ移り、下端に達したら折り返す
+        """
+        pitch = max(LINE_PITCH * line_spacing, size * 1.2)
+        self._begin_column(pitch)
+        for base, ruby in pieces:
+            if ruby is None:
+                for ch in base:
+                    if ch == "\n":
+                        self._next_column()
+                        continue
+                    if self.y - size < self.bottom:
+                        self._next_column()
+                    self._draw_char(ch, self.x - pitch / 2, self.y, size)
+                    self.y -= size
+            else:
+                # ルビの付く本文は同じ行に収める
+                span = len(base) * size
+                if self.y - span < self.bottom and self.y != self.top:
+                    self._next_column()
+                self._draw_ruby(base, ruby, size, ruby_size or size / 2)
+                self.y -= span
+        self._end_column()
+
+    def _draw_ruby(self, base, ruby, size, ruby_size):
+        """本文を描き、その右側にルビを本文の範囲の中央揃えで描く"""
+        center_x = self.x - self.pitch / 2
+        top = self.y
+        for i, ch in enumerate(base):
+            self._draw_char(ch, center_x, top - i * size, size)
+        if not ruby:
+            return
+        span = len(base) * size
+        ruby_top = top - (span - len(ruby) * ruby_size) / 2
+        ruby_x = center_x + size / 2 + ruby_size / 2
+        for i, ch in enumerate(ruby):
+            self._draw_char(ch, ruby_x, ruby_top - i * ruby_size, ruby_size)
+
+    def add_space(self, space):
+        """行間を空ける"""
+        self.x -= space
+
+    def save(self):
+        self.canvas.save()
+
+
+def render_eisou_pdf(
+    out,
+    head_title,
+    date,
+    organizer,
+    participant_names,
+    tankas,
+    basePoint=11.0,
+    rubyPoint=6.0,
+    line_spacing=4.0,
+    font_name=None,
+):
+    """
+    詠草一覧のpdfをoutに書き出す
+    tankasはシャッフル済みの詠草(ルビのマークアップを含む)のイテラブル
+    """
+    info = f"【日付】{date}\n【司会】{organizer}\n【参加者】{'、'.join(participant_names)}"
+    return render_tankas_pdf(
+        out,
+        head_title,
+        info,
+        tankas,
+        basePoint=basePoint,
+        rubyPoint=rubyPoint,
+        line_spacing=line_spacing,
+        font_name=font_name,
+    )
+
+
+def render_tankas_pdf(
+    out,
+    head_title,
+    info,
+    tankas,
+    basePoint=11.0,
+    rubyPoint=6.0,
+    line_spacing=4.0,
+    font_name=None,
+):
+    """
+    見出し・情報・番号付きの詠草を並べたpdfをoutに書き出す(詠草一覧・短歌リストの書き出し)
+    tankasは1首ずつ読むので、ジェネレーターでよい
+    """
+    writer = VerticalPdfWriter(out, font_name=font_name)
+
+    # タイトル
+    writer.write_line([(head_title, None)], 14.0)
+
+    # 情報
+    writer.write_line([(info, None)], 12.0)
+    writer.add_space(20.0)
+
+    # 詠草
+    writer.write_line(_tanka_pieces(tankas), basePoint, rubyPoint, line_spacing)
+
+    writer.save()
+    return out
+
+
+def _tanka_pieces(tankas):
+    for i, tanka in enumerate(tankas):
+        if i != 0:
+            yield ("\n", None)
+        yield from tokenize_ruby(f"{i + 1}．{tanka}")
@@ -0,0 +1,58 @@
+"""
+歌会記録のページに載せる詠草
+参加者・詠草・ユーザーを1クエリで取得して公開設定ごとにまとめ、歌会の版ごとにキャッシュする
+参加者・詠草が変更されるとsignalsで歌会の版が上がり、作り直される
+"""
+
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import get_event_version
+from .models import Participant
+
+RECORD_STATUSES = ("public", "limited")
+
+
+@dataclass(frozen=True)
+class RecordTanka:
+    tanka_id: int
+    content_html: str
+    author_name: str
+
+
+def record_cache_key(event_id):
+    return f"utakais:record:{event_id}:{get_event_version(event_id)}"
+
+
+def build_record_groups(event_id):
+    """公開設定ごとの詠草のリストの辞書({"public": [...], "limited": [...]})を作る"""
+    groups = {status: [] for status in RECORD_STATUSES}
+    participants = (
+        Participant.objects.filter(event_id=event_id, tanka__status__in=RECORD_STATUSES)
+        .select_related("tanka", "user")
+        .order_by("pk")
+    )
+    for participant in participants:
+        groups[participant.tanka.status].append(
+            RecordTanka(
+                tanka_id=participant.tanka_id,
+                content_html=participant.tanka.content_html,
+                author_name=participant.name,
+            )
+        )
+    return groups
+
+
+def get_record_groups(event_id, use_cache=True):
+    """キャッシュがあればそれを、なければ作ってキャッシュしたものを返す"""
+    if not use_cache:
+        return build_record_groups(event_id)
+    key = record_cache_key(event_id)
+    groups = cache.get(key)
+    if groups is None:
+        groups = build_record_groups(event_id)
+        cache.set(key, groups, getattr(settings, "RECORD_CACHE_TIMEOUT", 60 * 60 * 24))
+    return groups
+
@@ -0,0 +1,97 @@
+"""
+過去の歌会の詠草一覧をまとめて作り直す(regenerate_eisou)
+歌会ごとの生成をプロセスプールに振り分ける
+子プロセスはそれぞれ1件ずつ変換するので、変換エンジンのプロセス(soffice)は子プロセスごとに1つにする
+"""
+
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass
+from multiprocessing.util import Finalize
+
+import django
+from django.db import close_old_connections, connections
+
+from . import converters
+
+
+@dataclass
+class RegenerateResult:
+    event_id: int
+    status: str  # "generated" / "unchanged" / "failed"
+    seconds: float
+    eisou_number: int = 0
+    doc: str = ""
+    pdf: str = ""
+    error: str = ""
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def _init_worker():
+    # spawnで起動された場合に備えてDjangoを初期化する(forkなら何もしない)
+    django.setup()
+    # 親の変換エンジンを引き継がず、sofficeを1つだけ持つものを作り直させる
+    converters.reset_converter(workers=1)
+    # 子プロセスではatexitが呼ばれないため、終了時にsofficeを落とす
+    Finalize(None, converters.close_converter, exitpriority=10)
+
+
+def regenerate_event(pk, force=False):
+    """
+    1つの歌会の詠草一覧を生成し、RegenerateResultを返す。例外は送出しない
+    force=Trueなら内容が変わっていなくても生成し直す
+    """
+    from .models import Event
+
+    close_old_connections()
+    started = time.perf_counter()
+    try:
+        event = Event.objects.get(pk=pk)
+        number = event.eisou_number
+        doc_path, pdf_path = event.generate_files(force=force)
+    except Exception:
+        return RegenerateResult(
+            event_id=pk,
+            status="failed",
+            seconds=time.perf_counter() - started,
+            error=traceback.format_exc(),
+        )
+    return RegenerateResult(
+        event_id=pk,
+        status="generated" if event.eisou_number != number else "unchanged",
+        seconds=time.perf_counter() - started,
+        eisou_number=event.eisou_number,
+        doc=str(doc_path),
+        pdf=str(pdf_path),
+    )
+
+
+def regenerate_events(pks, workers=None, force=False):
+    """
+    歌会ごとの生成をworkersプロセスで行い、終わった順にRegenerateResultを返すジェネレーター
+    workers=1ならこのプロセスで順に行う
+    """
+    if workers == 1:
+        for pk in pks:
+            yield regenerate_event(pk, force)
+        return
+
+    # 親プロセスのDB接続を子プロセスに引き継がないよう閉じておく
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = {pool.submit(regenerate_event, pk, force): pk for pk in pks}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                # 子プロセスが異常終了すると、残りの歌会もすべてこの例外になる
+                yield RegenerateResult(
+                    event_id=futures[future],
+                    status="failed",
+                    seconds=0.0,
+                    error=traceback.format_exc(),
+                )
@@ -0,0 +1,243 @@
+"""
+生成した詠草一覧の古い版と、不要になったメディアの掃除
+    - 歌会ごとに新しい版をkeep個と、eisou_doc/eisou_pdfが参照している版を残して削除する
+    - 削除された歌会のディレクトリを削除する
+    - その場で描画したpdf(Event.get_rendered_eisou_pdf)は、最新のもの以外を削除する
+    - 短歌リストの書き出し(TankaList.export_anthology)は、形式ごとに新しいものから
+      TankaList.anthology_keep_files個を残して削除し、削除された短歌リストのディレクトリを削除する
+    - 生成・描画・書き出しが中断されて残った作業用のディレクトリ(.generate-*など)を削除する
+    - 中身が同じファイルはハードリンクにまとめる
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from django.conf import settings
+
+from .models import Event, TankaList
+
+# 雛形などを置いている、歌会ではないディレクトリ
+RESERVED_DIRS = {"samples"}
+
+# generate_files・get_rendered_eisou_pdf・export_anthologyが作る作業用のディレクトリ
+WORK_DIR_PREFIXES = (".generate-", ".render-", ".export-")
+
+# generate_filesが付ける版番(拡張子を除いた名前の末尾)。版番のないファイルは第1版
+# 同名のファイルがあるとストレージが末尾に"_"と7文字を足すため、それも許す
+VERSION_PATTERN = re.compile(r"_ver(\d+)(?:_[0-9A-Za-z]{7})?$")
+
+
+@dataclass
+class GarbageReport:
+    deleted: list = field(default_factory=list)  # (パス, バイト数, 理由)
+    linked: list = field(default_factory=list)  # (パス, リンク先, バイト数)
+
+    @property
+    def reclaimed_bytes(self):
+        return sum(size for _, size, _ in self.deleted) + sum(
+            size for _, _, size in self.linked
+        )
+
+
+def _dir_size(path):
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with path.open(mode="rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def version_number(path):
+    """ファイル名から版番を読む。タイトルが変わっても、版番が同じなら同じ版とみなす"""
+    match = VERSION_PATTERN.search(Path(path).stem)
+    return int(match.group(1)) if match else 1
+
+
+def _referenced_versions(event):
+    return {
+        version_number(file_field.name)
+        for file_field in (event.eisou_doc, event.eisou_pdf)
+        if file_field
+    }
+
+
+def _newest_mtime(path):
+    """ディレクトリとその中身のうち、最も新しい更新時刻"""
+    return max(
+        [path.stat().st_mtime, *(child.stat().st_mtime for child in path.rglob("*"))]
+    )
+
+
+def _collect_work_dirs(directory, threshold, report, dry_run):
+    """
+    プロセスが落ちるなどして残った作業用のディレクトリを削除する
+    生成中のものを消さないよう、中身がthreshold(時刻)より新しいものには触れない
+    """
+    for path in directory.iterdir():
+        if not path.is_dir() or not path.name.startswith(WORK_DIR_PREFIXES):
+            continue
+        if _newest_mtime(path) > threshold:
+            continue
+        report.deleted.append((path, _dir_size(path), "stale work dir"))
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _collect_cached_files(
+    directory, keep, threshold, report, dry_run, reason, pattern="*"
+):
+    """
+    内容ごとに保存したファイル(patternに合うもの)を、新しいものからkeep個を残して削除する
+    配信中・生成中のファイルを消さないよう、threshold(時刻)より新しいファイルには触れない
+    """
+    paths = sorted(
+        (
+            (path, path.stat())
+            for path in directory.glob(pattern)
+            if path.is_file() and not path.name.startswith(".")
+        ),
+        key=lambda item: item[1].st_mtime,
+        reverse=True,
+    )
+    for path, stat in paths[keep:]:
+        if stat.st_mtime > threshold:
+            continue
+        report.deleted.append((path, stat.st_size, reason))
+        if not dry_run:
+            path.unlink(missing_ok=True)
+
+
+def _collect_anthology_garbage(threshold, report, dry_run):
+    """lists/以下(短歌リストの書き出し)を掃除する"""
+    root = Path(settings.MEDIA_ROOT) / "lists"
+    if not root.is_dir():
+        return
+    list_dirs = {
+        int(path.name): path
+        for path in root.iterdir()
+        if path.is_dir() and path.name.isdigit()
+    }
+    existing = set(
+        TankaList.objects.filter(pk__in=list(list_dirs)).values_list("pk", flat=True)
+    )
+    for pk, directory in sorted(list_dirs.items()):
+        if pk not in existing:
+            if _newest_mtime(directory) > threshold:
+                continue
+            report.deleted.append((directory, _dir_size(directory), "orphaned"))
+            if not dry_run:
+                shutil.rmtree(directory)
+            continue
+        _collect_work_dirs(directory, threshold, report, dry_run)
+        for file_type in ("docx", "pdf"):
+            _collect_cached_files(
+                directory,
+                TankaList.anthology_keep_files,
+                threshold,
+                report,
+                dry_run,
+                "old export",
+                pattern=f"*.{file_type}",
+            )
+
+
+def collect_eisou_garbage(keep=None, dry_run=False, grace_seconds=3600):
+    """
+    events/とlists/以下を掃除し、GarbageReportを返す
+    dry_run=Trueなら何も削除せず、削除されるものだけを報告する
+    grace_seconds: 生成中のファイルを消さないよう、これより新しいファイルには触れない
+    """
+    if keep is None:
+        keep = getattr(settings, "EISOU_KEEP_VERSIONS", 3)
+    report = GarbageReport()
+    threshold = time.time() - grace_seconds
+    _collect_anthology_garbage(threshold, report, dry_run)
+    root = Path(settings.MEDIA_ROOT) / "events"
+    if not root.is_dir():
+        return report
+
+    event_dirs = {
+        int(path.name): path
+        for path in root.iterdir()
+        if path.is_dir() and path.name not in RESERVED_DIRS and path.name.isdigit()
+    }
+    events = Event.objects.in_bulk(list(event_dirs))
+
+    kept_files = []
+    for pk, directory in sorted(event_dirs.items()):
+        event = events.get(pk)
+
+        # 削除された歌会のディレクトリ(削除直後・生成中のものには触れない)
+        if event is None:
+            if _newest_mtime(directory) > threshold:
+                continue
+            report.deleted.append((directory, _dir_size(directory), "orphaned"))
+            if not dry_run:
+                shutil.rmtree(directory)
+            continue
+
+        _collect_work_dirs(directory, threshold, report, dry_run)
+
+        # 版番ごとにまとめ、新しい順に並べる
+        versions = {}
+        for path in directory.iterdir():
+            if path.is_file() and not path.name.startswith("."):
+                versions.setdefault(version_number(path), []).append(path)
+        ordered = sorted(versions.items(), reverse=True)
+        referenced = _referenced_versions(event)
+        for index, (number, paths) in enumerate(ordered):
+            if index < keep or number in referenced:
+                kept_files.extend(paths)
+                continue
+            for path in paths:
+                stat = path.stat()
+                if stat.st_mtime > threshold:
+                    kept_files.append(path)
+                    continue
+                report.deleted.append((path, stat.st_size, "old version"))
+                if not dry_run:
+                    path.unlink()
+
+        rendered = directory / Event.eisou_rendered_dir
+        if rendered.is_dir():
+            _collect_work_dirs(rendered, threshold, report, dry_run)
+            _collect_cached_files(
+                rendered, 1, threshold, report, dry_run, "old rendering"
+            )
+
+    # 中身が同じファイルをハードリンクにまとめる
+    by_size = {}
+    for path in kept_files:
+        by_size.setdefault(path.stat().st_size, []).append(path)
+    for size, paths in by_size.items():
+        if len(paths) < 2 or size == 0:
+            continue
+        by_hash = {}
+        for path in paths:
+            by_hash.setdefault(_sha256(path), []).append(path)
+        for same in by_hash.values():
+            original = same[0]
+            original_stat = original.stat()
+            for path in same[1:]:
+                stat = path.stat()
+                if (stat.st_dev, stat.st_ino) == (
+                    original_stat.st_dev,
+                    original_stat.st_ino,
+                ):
+                    continue
+                report.linked.append((path, original, size))
+                if not dry_run:
+                    tmp_path = path.with_name(f".{path.name}.link")
+                    os.link(original, tmp_path)
+                    os.replace(tmp_path, path)
+
+    return report
@@ -0,0 +1,109 @@
+"""
+締切を過ぎた歌会の詠草一覧を、ページが開かれる前に生成しておくためのスケジューラ
+    - これから来る締切を索引(ヒープ)に持ち、締切を過ぎたらEventJobを積む
+    - 起動時に、停止中に過ぎた締切を拾い直す
+    - 続けて来る締切は、まとめて1度に積む
+生成そのものはワーカー(run_eisou_worker)が行う
+"""
+
+import heapq
+import logging
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from . import jobs
+from .models import Event
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_if_stale(event):
+    """
+    詠草一覧が古ければ生成のジョブを積み、そのジョブを返す。積まなければNone
+    前回のジョブが失敗している場合は、閲覧時と同じく自動では積み直さない
+    """
+    if event.eisou_is_fresh():
+        return None
+    job = jobs.latest_job(event)
+    if job is not None and job.is_failed:
+        return None
+    return jobs.enqueue(event)
+
+
+class DeadlineScheduler:
+    """
+    締切の索引
+    coalesce: 積んでからこの時間内に来る締切は、次にまとめて積む(続けて起きないようにする)
+    horizon: 索引に載せる締切の範囲(現在からの時間)。refreshのたびに載せ直す
+    """
+
+    def __init__(
+        self,
+        coalesce=timedelta(seconds=60),
+        horizon=timedelta(days=1),
+    ):
+        self.coalesce = coalesce
+        self.horizon = horizon
+        self.heap = []  # (締切, pk)
+        self.checked_until = None  # この時刻までの締切は処理済み
+        self.refreshed_at = None  # この時刻より後に変更された歌会は、処理済みの範囲も見直す
+        self.last_run = None  # 最後にジョブを積んだ時刻
+
+    def catch_up(self, since, now=None):
+        """sinceからnowまでの締切のうち、詠草一覧が古いものを積む"""
+        now = now or timezone.now()
+        events = Event.objects.filter(deadline__gt=since, deadline__lte=now).order_by(
+            "deadline"
+        )
+        enqueued = [job for job in map(enqueue_if_stale, events) if job is not None]
+        self.checked_until = now
+        self.refreshed_at = now
+        return enqueued
+
+    def refresh(self, now=None):
+        """
+        未処理の締切を、horizonの範囲で索引に載せ直す(締切の変更・歌会の追加を反映する)
+        前回から変更された歌会は、締切が処理済みの時刻より前に早められていても載せる
+        """
+        now = now or timezone.now()
+        if self.checked_until is None:
+            self.checked_until = now
+        condition = Q(deadline__gt=self.checked_until)
+        if self.refreshed_at is not None:
+            condition |= Q(updated_at__gt=self.refreshed_at)
+        events = Event.objects.filter(condition, deadline__lte=now + self.horizon)
+        self.heap = list(events.values_list("deadline", "pk"))
+        heapq.heapify(self.heap)
+        self.refreshed_at = now
+
+    def next_wakeup(self):
+        """
+        次に起きる時刻。索引が空ならNone
+        最初の締切(heap[0])。ただし前回積んでからcoalesceの間は起きず、その間の締切はまとめて積む
+        """
+        if not self.heap:
+            return None
+        first = self.heap[0][0]
+        if self.last_run is not None:
+            return max(first, self.last_run + self.coalesce)
+        return first
+
+    def run_due(self, now=None):
+        """締切を過ぎた歌会の詠草一覧のジョブを積み、積んだジョブを返す"""
+        now = now or timezone.now()
+        pks = []
+        while self.heap and self.heap[0][0] <= now:
+            pks.append(heapq.heappop(self.heap)[1])
+        self.checked_until = now
+        enqueued = []
+        # 索引に載せた後に締切が延びていれば、refreshで載せ直される
+        for event in Event.objects.filter(pk__in=pks, deadline__lte=now):
+            job = enqueue_if_stale(event)
+            if job is not None:
+                enqueued.append(job)
+        if enqueued:
+            self.last_run = now
+            logger.info("%d件の詠草一覧の生成を積みました。", len(enqueued))
+        return enqueued
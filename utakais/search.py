@@ -0,0 +1,169 @@
+"""
+詠草の全文検索(SQLiteのFTS5)
+日本語は単語の区切りがないため、本文(ルビなし)を2文字ずつのトークン(bigram)に分けて索引する
+    例: 「春の風」→「春の の風 風」(末尾の1文字は1文字の検索のため)
+検索語も同じように分け、連続するトークンの並び(フレーズ)として探す
+本文・検索語はmojimojiで全角英数字を半角に、半角カナを全角にそろえ、文字以外(空白・句読点など)を除く
+索引は詠草の保存・削除時にsignalsで更新する。QuerySet.updateなどで変えた場合はrebuild_tanka_searchで作り直す
+
+読み(ルビを本文の代わりにしたもの、Tanka.reading)による前方一致の検索もここで行う
+読みはひらがなにそろえて索引付きの列に保存し、範囲(>= 検索語 かつ < 検索語の次)で探す
+"""
+
+import unicodedata
+
+import mojimoji
+from django.db import connection, transaction
+
+TABLE = "utakais_tanka_fts"
+
+CREATE_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} "
+    "USING fts5(body, tokenize = 'unicode61 remove_diacritics 0')"
+)
+DROP_TABLE_SQL = f"DROP TABLE IF EXISTS {TABLE}"
+
+
+def search_available(using=None):
+    """FTS5の索引を使えるか(SQLiteのときのみ)"""
+    return (using or connection).vendor == "sqlite"
+
+
+def normalize(text):
+    """全角英数字を半角に、半角カナを全角にし、小文字にそろえ、文字・数字以外を除く"""
+    text = mojimoji.zen_to_han(text, kana=False)
+    text = mojimoji.han_to_zen(text, ascii=False, digit=False)
+    return "".join(
+        char for char in text.lower() if unicodedata.category(char)[0] in "LN"
+    )
+
+
+def normalize_reading(text):
+    """normalizeに加えて、カタカナをひらがなにそろえる"""
+    return normalize(text).translate(_katakana_to_hiragana)
+
+
+# ァ(U+30A1)～ヶ(U+30F6)をぁ(U+3041)～ゖ(U+3096)に
+_katakana_to_hiragana = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+
+def bigrams(chars):
+    return [chars[i : i + 2] for i in range(len(chars) - 1)]
+
+
+def index_text(text):
+    """索引に入れる文字列(bigramを空白で区切ったもの)"""
+    chars = normalize(text)
+    if not chars:
+        return ""
+    return " ".join([*bigrams(chars), chars[-1]])
+
+
+def match_expression(query):
+    """
+    検索語をFTS5のMATCHの式にする。空白で区切った語はすべて含むもの(AND)を探す
+    1文字の語は、その文字で始まるトークンの前方一致で探す
+    検索できる文字がなければNone
+    """
+    phrases = []
+    for term in query.split():
+        chars = normalize(term)
+        if len(chars) == 1:
+            phrases.append(f'"{chars}"*')
+        elif chars:
+            phrases.append('"' + " ".join(bigrams(chars)) + '"')
+    return " AND ".join(phrases) or None
+
+
+def index_tankas(rows, using=None, replace=True):
+    """
+    rows: (id, content_text)の組。索引の行を置き換える
+    replace=False: 索引にまだない詠草として、削除せずに追加する
+    """
+    rows = [(pk, index_text(text)) for pk, text in rows]
+    if not rows or not search_available(using):
+        return
+    with (using or connection).cursor() as cursor:
+        if replace:
+            cursor.executemany(
+                f"DELETE FROM {TABLE} WHERE rowid = %s", [(pk,) for pk, _ in rows]
+            )
+        cursor.executemany(f"INSERT INTO {TABLE} (rowid, body) VALUES (%s, %s)", rows)
+
+
+def remove_tankas(pks, using=None):
+    if not pks or not search_available(using):
+        return
+    with (using or connection).cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {TABLE} WHERE rowid = %s", [(pk,) for pk in pks]
+        )
+
+
+def rebuild_index(queryset, batch_size=1000, progress=None, using=None):
+    """
+    索引を空にし、querysetの詠草(id, content_text)をbatch_size件ずつ入れ直す。入れた件数を返す
+    progress: 1バッチごとに件数を渡して呼ぶ関数
+    """
+    using = using or connection
+    # 作り直している間も、ほかの接続からは前の索引が見えるようにする
+    with transaction.atomic(using=using.alias):
+        with using.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE}")
+        count = 0
+        batch = []
+        rows = queryset.order_by("pk").values_list("pk", "content_text")
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                index_tankas(batch, using, replace=False)
+                count += len(batch)
+                if progress:
+                    progress(len(batch))
+                batch = []
+        if batch:
+            index_tankas(batch, using, replace=False)
+            count += len(batch)
+            if progress:
+                progress(len(batch))
+        with using.cursor() as cursor:
+            # 追加を重ねて分かれた索引のb-treeを1つにまとめる
+            cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return count
+
+
+def search_tankas(queryset, query):
+    """
+    querysetの詠草からqueryを含むものを、関連の高い順(bm25)に返す
+    公開設定による絞り込みは、呼び出し側でTanka.objects.visible_toを渡して行う
+    """
+    match = match_expression(query)
+    if match is None:
+        return queryset.none()
+    if not search_available():
+        # FTS5がなければ、本文の部分一致で探す(順位はつけない)
+        for term in query.split():
+            queryset = queryset.filter(content_text__icontains=term)
+        return queryset.order_by("-created_at", "-pk")
+    table = queryset.model._meta.db_table
+    return queryset.extra(
+        select={"rank": f"bm25({TABLE})"},
+        tables=[TABLE],
+        where=[f"{TABLE}.rowid = {table}.id", f"{TABLE} MATCH %s"],
+        params=[match],
+    ).order_by("rank", "-created_at", "-pk")
+
+
+def search_by_reading(queryset, query):
+    """
+    querysetの詠草から、読みがqueryで始まるものを読みの順に返す
+    LIKEはESCAPEを付けると索引を使えないため、範囲で比べて索引(tanka_reading)を使う
+    """
+    prefix = normalize_reading(query)
+    if not prefix:
+        return queryset.none()
+    # 前方一致する文字列は、prefix以上かつ、prefixの最後の文字を1つ進めたもの未満
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return queryset.filter(reading__gte=prefix, reading__lt=upper).order_by(
+        "reading", "pk"
+    )
@@ -0,0 +1,79 @@
+"""
+モデルの変更に応じて歌会の版を上げ、キャッシュを使われなくする
+参加者・詠草の変更は、歌会の内容の更新日時(Event.content_updated_at)にも反映する
+詠草・参加の追加・削除は、ユーザーごとの集計(UserTankaSummary)にも反映する
+詠草の保存・削除は、全文検索の索引(search)とよく似た詠草のバケット(similarity)にも反映する
+(バケットは詠草の削除時にCASCADEで削除される)
+"""
+
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import search, similarity
+from .caching import bump_event_versions
+from .models import Event, Participant, Tanka, UserTankaSummary
+
+
+def touch_events(*event_ids):
+    """歌会の内容の更新日時を進め、版を上げる"""
+    event_ids = [event_id for event_id in event_ids if event_id is not None]
+    if not event_ids:
+        return
+    Event.objects.filter(pk__in=event_ids).update(content_updated_at=timezone.now())
+    bump_event_versions(*event_ids)
+
+
+@receiver([post_save, post_delete], sender=Event)
+def event_changed(sender, instance, **kwargs):
+    # content_updated_atはEvent.saveで更新される
+    bump_event_versions(instance.pk)
+
+
+@receiver(post_save, sender=Participant)
+def participant_saved(sender, instance, created, **kwargs):
+    touch_events(instance.event_id)
+    if created and instance.user_id:
+        UserTankaSummary.participation_changed(instance.user_id, 1)
+
+
+@receiver(post_delete, sender=Participant)
+def participant_deleted(sender, instance, **kwargs):
+    touch_events(instance.event_id)
+    if instance.user_id:
+        UserTankaSummary.participation_changed(instance.user_id, -1)
+
+
+@receiver(post_save, sender=Tanka)
+def tanka_saved(sender, instance, created, **kwargs):
+    if created:
+        # 新しい詠草はまだ参加者に結び付いていない
+        if instance.author_id:
+            UserTankaSummary.tanka_added(instance)
+        return
+    touch_events(*instance.participant_set.values_list("event_id", flat=True))
+
+
+@receiver(pre_delete, sender=Tanka)
+def tanka_deleted(sender, instance, **kwargs):
+    # 削除後は参加者のtankaがNULLになり、歌会を辿れなくなるため削除前に反映する
+    touch_events(*instance.participant_set.values_list("event_id", flat=True))
+
+
+@receiver(post_delete, sender=Tanka)
+def tanka_removed(sender, instance, **kwargs):
+    if instance.author_id:
+        UserTankaSummary.tanka_removed(instance)
+
+
+@receiver(post_save, sender=Tanka)
+def tanka_indexed(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and "content" not in update_fields:
+        return
+    search.index_tankas([(instance.pk, instance.content_text)], replace=not created)
+    similarity.index_tankas([instance], replace=not created)
+
+
+@receiver(post_delete, sender=Tanka)
+def tanka_unindexed(sender, instance, **kwargs):
+    search.remove_tankas([instance.pk])
@@ -0,0 +1,214 @@
+"""
+よく似た詠草(再提出など)の検出(MinHash/LSH)
+本文(ルビなし)をsearch.normalizeでそろえ、3文字ずつの集合(shingle)のJaccard係数で似ているかを測る
+    - MinHash: NUM_PERM個のハッシュ関数それぞれの最小値の並び(署名)。一致する割合がJaccard係数の推定値になる
+    - LSH: 署名をBANDS個の帯に分け、帯ごとのハッシュ値(バケット)をTankaBucketに保存する
+      どれかの帯のバケットが一致する詠草だけを候補にするため、全件と比べずにすむ
+      BANDS=16, ROWS=4では、Jaccard係数が0.5で約6割、0.8で約100%が候補になる
+署名は詠草の保存時(Tanka.render_content)に、バケットはsignalsで更新する
+"""
+
+import hashlib
+import random
+import struct
+from collections import defaultdict
+from dataclasses import dataclass
+
+from django.db.models import OuterRef, Q, Subquery
+
+from .search import normalize
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+# 既定で似ているとみなすJaccard係数(推定値)
+THRESHOLD = 0.5
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(20241018)
+# 署名の互換性のため、係数は固定の乱数で作る(変えたらindex_tanka_similarityで作り直す)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)
+]
+_format = struct.Struct(f"<{NUM_PERM}I")
+
+
+def shingles(text):
+    chars = normalize(text)
+    if len(chars) <= SHINGLE_SIZE:
+        return {chars} if chars else set()
+    return {chars[i : i + SHINGLE_SIZE] for i in range(len(chars) - SHINGLE_SIZE + 1)}
+
+
+def _permuted(shingle):
+    value = int.from_bytes(
+        hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little"
+    )
+    return [(a * value + b) % _PRIME & _MAX_HASH for a, b in _PERMUTATIONS]
+
+
+def signatures(texts):
+    """
+    textsそれぞれの署名(NUM_PERM個の整数のタプル)のリストを返す。文字がなければNone
+    同じshingleのハッシュ値はまとめて1度だけ計算する
+    """
+    permuted = {}
+    results = []
+    for text in texts:
+        rows = []
+        for shingle in shingles(text):
+            row = permuted.get(shingle)
+            if row is None:
+                row = permuted[shingle] = _permuted(shingle)
+            rows.append(row)
+        results.append(tuple(map(min, zip(*rows))) if rows else None)
+    return results
+
+
+def signature(text):
+    return signatures([text])[0]
+
+
+def pack(signature):
+    return None if signature is None else _format.pack(*signature)
+
+
+def unpack(data):
+    return None if data is None else _format.unpack(bytes(data))
+
+
+def band_buckets(signature):
+    """(帯の番号, バケット)のリスト。バケットは帯の値のハッシュ(符号付き64bit)"""
+    data = _format.pack(*signature)
+    size = ROWS * 4
+    buckets = []
+    for band in range(BANDS):
+        digest = hashlib.blake2b(data[band * size : (band + 1) * size], digest_size=8)
+        buckets.append((band, int.from_bytes(digest.digest(), "little", signed=True)))
+    return buckets
+
+
+def estimate(signature_a, signature_b):
+    """署名からJaccard係数を推定する"""
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / NUM_PERM
+
+
+def index_tankas(tankas, bucket_model=None, replace=True):
+    """
+    詠草(minhashを計算済み)のバケットを保存し直す
+    replace=False: バケットがまだない詠草として、削除せずに追加する
+    bucket_model: マイグレーションから呼ぶ場合の、その時点のTankaBucket
+    """
+    if bucket_model is None:
+        from .models import TankaBucket as bucket_model
+    tankas = list(tankas)
+    if replace:
+        bucket_model.objects.filter(tanka__in=[tanka.pk for tanka in tankas]).delete()
+    bucket_model.objects.bulk_create(
+        [
+            bucket_model(tanka_id=tanka.pk, band=band, bucket=bucket)
+            for tanka in tankas
+            if tanka.minhash is not None
+            for band, bucket in band_buckets(unpack(tanka.minhash))
+        ]
+    )
+
+
+def backfill(queryset, bucket_model=None, batch_size=500, progress=None):
+    """
+    querysetの詠草の署名とバケットを、batch_size件ずつ計算して保存し直す。件数を返す
+    progress: 1バッチごとに件数を渡して呼ぶ関数
+    """
+    count = 0
+    batch = []
+
+    def flush():
+        for tanka, sig in zip(batch, signatures(t.content_text for t in batch)):
+            tanka.minhash = pack(sig)
+        queryset.model.objects.bulk_update(batch, ["minhash"])
+        index_tankas(batch, bucket_model)
+        if progress:
+            progress(len(batch))
+
+    for tanka in queryset.only("pk", "content_text").order_by("pk").iterator(
+        chunk_size=batch_size
+    ):
+        batch.append(tanka)
+        if len(batch) >= batch_size:
+            flush()
+            count += len(batch)
+            batch = []
+    if batch:
+        flush()
+        count += len(batch)
+    return count
+
+
+@dataclass(frozen=True)
+class SimilarTanka:
+    tanka: object  # Tanka。歌会の名前(event_title)を注釈してある
+    score: float  # Jaccard係数の推定値
+
+
+def find_similar(tankas, threshold=THRESHOLD, user=None):
+    """
+    tankasの詠草それぞれについて、よく似たほかの詠草を探す
+    {詠草のid: [SimilarTanka, ...](似ている順)}を返す。よく似たものがない詠草は含めない
+    user: 指定すれば、userが見られる詠草・歌会だけを候補・歌会の名前にする
+    バケットの検索と候補の取得の2クエリで行う
+    """
+    from .models import Event, Tanka, TankaBucket
+
+    signatures_by_pk = {
+        tanka.pk: unpack(tanka.minhash) for tanka in tankas if tanka.minhash is not None
+    }
+    sources = defaultdict(set)  # (帯, バケット) → そのバケットに入るtankasのid
+    for pk, sig in signatures_by_pk.items():
+        for key in band_buckets(sig):
+            sources[key].add(pk)
+    if not sources:
+        return {}
+    by_band = defaultdict(list)
+    for band, bucket in sources:
+        by_band[band].append(bucket)
+    condition = Q()
+    for band, buckets in by_band.items():
+        condition |= Q(band=band, bucket__in=buckets)
+
+    candidates = defaultdict(set)  # 候補のid → 候補と同じバケットに入るtankasのid
+    for tanka_id, band, bucket in TankaBucket.objects.filter(condition).values_list(
+        "tanka_id", "band", "bucket"
+    ):
+        for pk in sources[(band, bucket)]:
+            if pk != tanka_id:
+                candidates[tanka_id].add(pk)
+    if not candidates:
+        return {}
+
+    tanka_queryset = Tanka.objects.all()
+    event_queryset = Event.objects.all()
+    if user is not None:
+        tanka_queryset = Tanka.objects.visible_to(user)
+        event_queryset = Event.objects.visible_to(user)
+    events = event_queryset.filter(participant__tanka=OuterRef("pk"))
+    similar = defaultdict(list)
+    for candidate in (
+        tanka_queryset.filter(pk__in=candidates)
+        .select_related("author")
+        .annotate(
+            event_pk=Subquery(events.values("pk")[:1]),
+            event_title=Subquery(events.values("title")[:1]),
+        )
+    ):
+        candidate_signature = unpack(candidate.minhash)
+        if candidate_signature is None:
+            continue
+        for pk in candidates[candidate.pk]:
+            score = estimate(signatures_by_pk[pk], candidate_signature)
+            if score >= threshold:
+                similar[pk].append(SimilarTanka(candidate, score))
+    for matches in similar.values():
+        matches.sort(key=lambda match: (-match.score, -match.tanka.pk))
+    return dict(similar)
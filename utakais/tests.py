@@ -1,3 +1,1821 @@
-from django.test import TestCase
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+from urllib.parse import quote
 
-# Create your tests here.
+import reportlab
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import (
+    Client,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from docx import Document
+from docx.oxml.ns import qn
+from lxml import etree
+
+from accounts.models import User
+from benchmarks.corpus import legacy_make_ruby_whole_sentence, make_corpus
+from poegrass import utils
+from poegrass.utils import file_sha256, make_ruby_whole_sentence, tokenize_ruby
+
+from . import caching, converters, jobs, views
+from .converters import ConversionError, LibreOfficePoolConverter
+from .docx_templates import registry
+from .models import (
+    Event,
+    EventJob,
+    EventLease,
+    Participant,
+    Tanka,
+    TankaBucket,
+    TankaList,
+    TankaListItem,
+    UserTankaSummary,
+)
+from .pdf import check_font, check_rendered_pdf_font, get_font_name
+from .regenerate import regenerate_event, regenerate_events
+from .retention import collect_eisou_garbage
+from .scheduler import DeadlineScheduler
+from .search import match_expression, normalize, search_by_reading
+from .similarity import backfill, estimate, find_similar, shingles, signature
+
+
+def create_past_event(participant_count, organizer=None, **kwargs):
+    """締切を過ぎた歌会を、詠草を提出した参加者付きで作る"""
+    if organizer is None:
+        organizer = User.objects.create_memberuser(
+            email="organizer@example.com",
+            account_id="organizer",
+            password="password",
+            name="司会者",
+        )
+    now = timezone.now()
+    event = Event.objects.create(
+        organizer=organizer,
+        start_time=now - timedelta(hours=1),
+        deadline=now - timedelta(hours=2),
+        **kwargs,
+    )
+    tankas = make_corpus(participant_count)
+    for i in range(participant_count):
+        user = User.objects.create_memberuser(
+            email=f"member{event.pk}_{i}@example.com",
+            account_id=f"member{event.pk}_{i}",
+            password="password",
+            name=f"歌人{i}",
+        )
+        tanka = Tanka.objects.create(content=tankas[i], author=user, status="public")
+        Participant.objects.create(user=user, event=event, tanka=tanka)
+    return event
+
+
+class FakeConverter:
+    """pdfへの変換の代わりに空のpdfを書く"""
+
+    def convert(self, doc_path, pdf_path):
+        Path(pdf_path).write_bytes(b"%PDF-1.4\n")
+
+
+class MediaRootMixin:
+    """一時的なMEDIA_ROOTに雛形を置いてテストする"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        samples = media_root / "events" / "samples"
+        samples.mkdir(parents=True)
+        shutil.copy(
+            settings.MEDIA_ROOT / "events" / "samples" / "utakai_sample.docx", samples
+        )
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        patcher = mock.patch(
+            "utakais.models.get_converter", return_value=FakeConverter()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def run_concurrently(func, count):
+    """countスレッドでfuncを同時に実行し、例外があれば送出する"""
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def target():
+        try:
+            barrier.wait()
+            func()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class RubyTest(SimpleTestCase):
+    cases = [
+        "あ<ruby>雨<rt>あめ</rt></ruby>のふる",
+        "<ruby>春<rt>はる</rt>雨<rt>さめ</rt></ruby><ruby>君<rt>きみ</rt></ruby>",
+        "ルビなし",
+        "<ruby>改\n行<rt>x</rt></ruby>あと<ruby>c<rt>y</rt></ruby>",
+        "<ruby>閉じていない",
+        "",
+    ]
+
+    def test_tokenize_ruby(self):
+        self.assertEqual(
+            tokenize_ruby("1．<ruby>春雨<rt>はるさめ</rt></ruby>の日"),
+            [("1．", None), ("春雨", "はるさめ"), ("の日", None)],
+        )
+
+    def test_same_xml_as_legacy_without_empty_runs(self):
+        for text in self.cases + make_corpus(50):
+            with self.subTest(text=text):
+                legacy = Document().add_paragraph()
+                legacy_make_ruby_whole_sentence(legacy, text)
+                # 置き換え前に出力されていた空の通常runを除く
+                for run in list(legacy._p):
+                    inner = run[0]
+                    if inner.find(qn("w:ruby")) is None and not inner.find(qn("w:t")).text:
+                        legacy._p.remove(run)
+
+                current = Document().add_paragraph()
+                make_ruby_whole_sentence(current, text)
+                self.assertEqual(etree.tostring(current._p), etree.tostring(legacy._p))
+
+
+class FakeSofficeWorker:
+    """
+    _SofficeWorkerの代わり。sofficeを起動せず、変換の開始・終了と起動・停止の回数を記録する
+    hang=Trueなら、stopされるまで変換が終わらない
+    """
+
+    def __init__(self, soffice, name, startup_timeout):
+        self.name = name
+        self.started = 0
+        self.stopped = 0
+        self.running = False
+        self.jobs = 0
+        self.hang = False
+        self.fail = False
+        self.active = 0
+        self.killed = threading.Event()
+
+    @property
+    def alive(self):
+        return self.running
+
+    def start(self):
+        self.started += 1
+        self.running = True
+        self.jobs = 0
+        self.killed.clear()
+
+    def stop(self):
+        if self.running:
+            self.stopped += 1
+        self.running = False
+        self.killed.set()
+
+    def convert(self, doc_path, pdf_path):
+        self.active += 1
+        try:
+            if self.active > 1:
+                raise AssertionError(f"{self.name}が同時に使われました。")
+            if self.hang:
+                self.killed.wait()
+                raise RuntimeError("killed")
+            if self.fail:
+                raise RuntimeError("broken document")
+            time.sleep(0.01)
+            Path(pdf_path).write_bytes(b"%PDF-1.4\n")
+            self.jobs += 1
+        finally:
+            self.active -= 1
+
+
+class LibreOfficePoolConverterTest(SimpleTestCase):
+    def setUp(self):
+        # python-unoがなくても、sofficeの代わりのFakeSofficeWorkerで試す
+        for patcher in [
+            mock.patch.dict("sys.modules", {"uno": mock.Mock()}),
+            mock.patch("utakais.converters._SofficeWorker", FakeSofficeWorker),
+            mock.patch("utakais.converters.atexit"),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def make_pool(self, **options):
+        return LibreOfficePoolConverter(**options)
+
+    def convert(self, pool, name="doc"):
+        pool.convert(self.tmp / f"{name}.docx", self.tmp / f"{name}.pdf")
+
+    def test_lifo_checkout_and_recycle(self):
+        pool = self.make_pool(workers=2, max_jobs=2)
+        for i in range(3):
+            self.convert(pool, f"doc{i}")
+        # 最後に返したプロセスを使い回すので、1つしか起動しない
+        used = [worker for worker in pool._workers if worker.started]
+        self.assertEqual(len(used), 1)
+        # max_jobs回変換したら作り直す
+        self.assertEqual((used[0].started, used[0].stopped), (2, 1))
+        self.assertTrue((self.tmp / "doc2.pdf").exists())
+
+    def test_timeout_kills_hung_worker(self):
+        pool = self.make_pool(workers=1, timeout=0.2)
+        (worker,) = pool._workers
+        self.convert(pool)
+        worker.hang = True
+        with self.assertRaisesMessage(ConversionError, "変換が終わりませんでした"):
+            self.convert(pool)
+        self.assertTrue(worker.killed.is_set())
+        self.assertFalse(worker.alive)
+        # 落としたプロセスはプールに戻り、次の変換で起動し直す
+        worker.hang = False
+        self.convert(pool)
+        self.assertEqual(worker.started, 2)
+
+    def test_failure_stops_worker(self):
+        pool = self.make_pool(workers=1)
+        (worker,) = pool._workers
+        worker.fail = True
+        with self.assertRaises(ConversionError):
+            self.convert(pool)
+        self.assertFalse(worker.alive)
+        self.assertEqual(pool._idle.qsize(), 1)
+
+    def test_concurrent_checkout(self):
+        pool = self.make_pool(workers=2)
+        count = itertools.count()
+        run_concurrently(lambda: self.convert(pool, f"doc{next(count)}"), 8)
+        # FakeSofficeWorkerは同時に使われると失敗する
+        self.assertEqual(sum(worker.jobs for worker in pool._workers), 8)
+        self.assertEqual(pool._idle.qsize(), 2)
+
+    def test_acquire_timeout(self):
+        pool = self.make_pool(workers=1, timeout=5, acquire_timeout=0.1)
+        (worker,) = pool._workers
+        worker.start()
+        worker.hang = True
+        errors = []
+
+        def convert_hung():
+            try:
+                self.convert(pool, "hung")
+            except ConversionError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=convert_hung)
+        thread.start()
+        try:
+            while not worker.active:
+                time.sleep(0.01)
+            with self.assertRaisesMessage(ConversionError, "空いているLibreOffice"):
+                self.convert(pool)
+        finally:
+            worker.stop()
+            thread.join()
+        self.assertEqual(len(errors), 1)
+
+
+class StreamingDocxTest(TestCase):
+    def test_same_document_as_python_docx(self):
+        event = create_past_event(30)
+        guest_tanka = Tanka.objects.create(
+            content="<ruby>&<rt><></rt></ruby> & <b>", guest_author="ゲスト"
+        )
+        Participant.objects.create(guest_user="ゲスト", event=event, tanka=guest_tanka)
+
+        expected = io.BytesIO()
+        event.build_eisou_document().save(expected)
+        streamed = io.BytesIO()
+        event.write_eisou_docx(streamed)
+
+        with zipfile.ZipFile(expected) as a, zipfile.ZipFile(streamed) as b:
+            self.assertEqual(
+                a.read("word/document.xml"), b.read("word/document.xml")
+            )
+            self.assertEqual(sorted(a.namelist()), sorted(b.namelist()))
+
+
+class EventJobTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # TestCaseのトランザクション中の接続を閉じさせない
+        patcher = mock.patch("utakais.jobs.close_old_connections")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.event = create_past_event(3)
+
+    def test_enqueue_and_run(self):
+        job = jobs.enqueue(self.event)
+        self.assertEqual(jobs.enqueue(self.event), job)
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "done")
+        self.assertIsNotNone(job.finished_at)
+        self.event.refresh_from_db()
+        self.assertTrue(self.event.eisou_is_fresh())
+        # 終わったジョブは使い回さない
+        self.assertNotEqual(jobs.enqueue(self.event), job)
+
+    def test_failed_job_not_requeued_by_page(self):
+        with mock.patch.object(
+            Event, "generate_files", side_effect=RuntimeError("変換できません")
+        ):
+            self.client.get(f"/events/{self.event.pk}/")
+            with self.assertLogs("utakais.jobs", "ERROR"):
+                self.assertEqual(jobs.run_pending(), 1)
+        job = jobs.latest_job(self.event)
+        self.assertEqual(job.status, "failed")
+        self.assertIn("変換できません", job.error)
+        response = self.client.get(f"/events/{self.event.pk}/")
+        self.assertEqual(response.context["job"], job)
+        self.assertEqual(EventJob.objects.filter(event=self.event).count(), 1)
+
+    def test_execute_method_defers_generation(self):
+        self.client.force_login(self.event.organizer)
+        with mock.patch.object(Event, "write_eisou_docx") as write:
+            response = self.client.get(
+                f"/events/{self.event.pk}/execute_method/generate_files/"
+            )
+        self.assertEqual(response.status_code, 302)
+        write.assert_not_called()
+        self.assertEqual(jobs.latest_job(self.event).status, "queued")
+
+
+class EisouFingerprintTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.event = create_past_event(3)
+
+    def fingerprint(self):
+        return Event.objects.get(pk=self.event.pk).compute_eisou_fingerprint()
+
+    def test_changes_with_content(self):
+        original = self.fingerprint()
+        self.assertEqual(self.fingerprint(), original)
+        changes = [
+            lambda: Event.objects.filter(pk=self.event.pk).update(title="改題"),
+            lambda: Event.objects.filter(pk=self.event.pk).update(eisou_seed=1),
+            lambda: Tanka.objects.filter(
+                pk=self.event.participant_set.first().tanka_id
+            ).update(content="<ruby>歌<rt>うた</rt></ruby>"),
+            lambda: self.event.eisou_sample_path().write_bytes(b"changed"),
+        ]
+        seen = {original}
+        for change in changes:
+            change()
+            fingerprint = self.fingerprint()
+            self.assertNotIn(fingerprint, seen)
+            seen.add(fingerprint)
+
+    def test_generates_only_when_changed(self):
+        doc_path, pdf_path = self.event.generate_files()
+        self.assertEqual(self.event.generate_files(), (doc_path, pdf_path))
+        self.assertEqual(self.event.eisou_number, 1)
+
+        tanka = self.event.participant_set.first().tanka
+        tanka.content = "書き直した歌"
+        tanka.save()
+        self.event.refresh_from_db()
+        self.assertFalse(self.event.eisou_is_fresh())
+        doc_path, pdf_path = self.event.generate_files()
+        self.assertEqual(self.event.eisou_number, 2)
+        self.assertTrue(doc_path.name.endswith("_ver2.docx"))
+        self.assertTrue(self.event.eisou_is_fresh())
+
+
+class TemplateRegistryTest(MediaRootMixin, TestCase):
+    def test_unknown_template_falls_back_to_default(self):
+        with self.assertLogs("utakais.docx_templates", "WARNING") as logs:
+            self.assertEqual(registry.path("removed"), registry.path())
+        self.assertIn("removed", logs.output[0])
+
+        event = create_past_event(1)
+        Event.objects.filter(pk=event.pk).update(eisou_template="removed")
+        event.refresh_from_db()
+        with self.assertLogs("utakais.docx_templates", "WARNING"):
+            doc_path, pdf_path = event.generate_files()
+        self.assertTrue(doc_path.is_file())
+
+
+class SingleFlightGenerationTest(MediaRootMixin, TransactionTestCase):
+    def test_concurrent_requests_enqueue_one_job(self):
+        event = create_past_event(5, ann_status="public")
+        run_concurrently(lambda: Client().get(f"/events/{event.pk}/"), 20)
+        self.assertEqual(EventJob.objects.filter(event=event).count(), 1)
+
+    def test_concurrent_generation_runs_once(self):
+        event = create_past_event(5)
+        generations = []
+        write_eisou_docx = Event.write_eisou_docx
+
+        def counting_write(self, *args, **kwargs):
+            generations.append(self.pk)
+            return write_eisou_docx(self, *args, **kwargs)
+
+        with mock.patch.object(Event, "write_eisou_docx", counting_write):
+            run_concurrently(
+                lambda: Event.objects.get(pk=event.pk).generate_files(), 20
+            )
+
+        self.assertEqual(len(generations), 1)
+        event.refresh_from_db()
+        self.assertEqual(event.eisou_number, 1)
+        self.assertTrue(event.eisou_is_fresh())
+        self.assertFalse(event.leases.exists())
+
+
+def crash_worker(pk, force):
+    """子プロセスを異常終了させ、プロセスプールを壊す"""
+    os._exit(1)
+
+
+class RegenerateTest(MediaRootMixin, TestCase):
+    def test_force_inside_lease(self):
+        event = create_past_event(2)
+        event.generate_files()
+        fingerprint = Event.objects.get(pk=event.pk).eisou_fingerprint
+        fingerprints = []
+        hold = EventLease.hold
+
+        @contextmanager
+        def recording_hold(*args, **kwargs):
+            with hold(*args, **kwargs):
+                fingerprints.append(Event.objects.get(pk=event.pk).eisou_fingerprint)
+                yield
+
+        # TestCaseのトランザクション中の接続を閉じさせない
+        patcher = mock.patch("utakais.regenerate.close_old_connections")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(EventLease, "hold", recording_hold):
+            result = regenerate_event(event.pk, force=True)
+        self.assertEqual(result.status, "generated", result.error)
+        self.assertEqual(result.eisou_number, 2)
+        # 貸出を受けるまで、記録済みのフィンガープリントは消さない
+        self.assertEqual(fingerprints, [fingerprint])
+        self.assertEqual(Event.objects.get(pk=event.pk).eisou_fingerprint, fingerprint)
+        self.assertEqual(regenerate_event(event.pk).status, "unchanged")
+
+
+class RegeneratePoolTest(SimpleTestCase):
+    def test_broken_pool_recorded_per_event(self):
+        with mock.patch("utakais.regenerate.regenerate_event", crash_worker):
+            results = list(regenerate_events([1, 2, 3], workers=2))
+        self.assertEqual(sorted(result.event_id for result in results), [1, 2, 3])
+        for result in results:
+            self.assertEqual(result.status, "failed")
+            self.assertIn("BrokenProcessPool", result.error)
+
+    @override_settings(
+        EISOU_PDF_CONVERTER={
+            "BACKEND": "utakais.converters.LibreOfficeConverter",
+            "OPTIONS": {"workers": 4, "timeout": 10},
+        }
+    )
+    def test_child_converter_has_one_worker(self):
+        self.addCleanup(converters.reset_converter)
+        inherited = mock.Mock()
+        converters._converter = inherited
+        converters.reset_converter(workers=1)
+        converter = converters.get_converter()
+        self.assertEqual(converter.options, {"workers": 1})
+        self.assertEqual(converter.timeout, 10)
+        # 親から引き継いだものは閉じない(親のsofficeを落とさない)
+        inherited.close.assert_not_called()
+
+
+class DeadlineSchedulerTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.organizer = User.objects.create_memberuser(
+            email="organizer@example.com",
+            account_id="organizer",
+            password="password",
+            name="司会者",
+        )
+
+    def create_event(self, deadline):
+        return Event.objects.create(
+            organizer=self.organizer,
+            start_time=deadline + timedelta(hours=3),
+            deadline=deadline,
+        )
+
+    def after(self, **kwargs):
+        return self.now + timedelta(**kwargs)
+
+    def enqueued_events(self, jobs):
+        return [job.event_id for job in jobs]
+
+    def test_wakes_at_earliest_deadline(self):
+        late = self.create_event(self.after(minutes=30))
+        early = self.create_event(self.after(minutes=10))
+        middle = self.create_event(self.after(minutes=20))
+        scheduler = DeadlineScheduler(coalesce=timedelta(0))
+        scheduler.refresh(now=self.now)
+        self.assertEqual(scheduler.next_wakeup(), early.deadline)
+
+        jobs = scheduler.run_due(now=self.after(minutes=15))
+        self.assertEqual(self.enqueued_events(jobs), [early.pk])
+        self.assertEqual(scheduler.next_wakeup(), middle.deadline)
+        jobs = scheduler.run_due(now=self.after(minutes=30))
+        self.assertCountEqual(self.enqueued_events(jobs), [middle.pk, late.pk])
+        self.assertIsNone(scheduler.next_wakeup())
+
+    def test_coalesce(self):
+        first = self.create_event(self.after(seconds=10))
+        second = self.create_event(self.after(seconds=20))
+        third = self.create_event(self.after(seconds=30))
+        lone = self.create_event(self.after(seconds=300))
+        scheduler = DeadlineScheduler(coalesce=timedelta(seconds=60))
+        scheduler.refresh(now=self.now)
+        # 最初の締切は遅らせない
+        self.assertEqual(scheduler.next_wakeup(), first.deadline)
+        jobs = scheduler.run_due(now=first.deadline)
+        self.assertEqual(self.enqueued_events(jobs), [first.pk])
+        # 続く締切は、前回からcoalesceの間待ってまとめて積む
+        self.assertEqual(scheduler.next_wakeup(), self.after(seconds=70))
+        jobs = scheduler.run_due(now=self.after(seconds=70))
+        self.assertCountEqual(self.enqueued_events(jobs), [second.pk, third.pk])
+        self.assertEqual(scheduler.next_wakeup(), lone.deadline)
+
+    def test_refresh_picks_up_changes(self):
+        event = self.create_event(self.after(minutes=30))
+        scheduler = DeadlineScheduler(horizon=timedelta(hours=1))
+        scheduler.refresh(now=self.now)
+        added = self.create_event(self.after(minutes=10))
+        beyond = self.create_event(self.after(hours=2))
+        event.deadline = self.after(minutes=40)
+        event.save()
+        scheduler.refresh(now=self.now)
+        self.assertEqual(
+            sorted(scheduler.heap),
+            [(added.deadline, added.pk), (event.deadline, event.pk)],
+        )
+        self.assertNotIn(beyond.pk, [pk for _, pk in scheduler.heap])
+
+    def test_deadline_moved_before_checked_until(self):
+        event = self.create_event(self.after(hours=1))
+        scheduler = DeadlineScheduler(horizon=timedelta(hours=2))
+        scheduler.refresh(now=self.now)
+        self.assertEqual(scheduler.run_due(now=self.after(minutes=5)), [])
+        # 処理済みの時刻より前に締切を早めても、次のrefreshで拾う
+        event.deadline = self.after(minutes=1)
+        event.save()
+        scheduler.refresh(now=self.after(minutes=5))
+        self.assertEqual(scheduler.next_wakeup(), event.deadline)
+        jobs = scheduler.run_due(now=self.after(minutes=5))
+        self.assertEqual(self.enqueued_events(jobs), [event.pk])
+        # 変更のない歌会は、処理済みの範囲から載せ直さない
+        scheduler.refresh(now=self.after(minutes=6))
+        self.assertEqual(scheduler.heap, [])
+
+    def test_postponed_deadline_not_run_early(self):
+        event = self.create_event(self.after(minutes=10))
+        scheduler = DeadlineScheduler()
+        scheduler.refresh(now=self.now)
+        Event.objects.filter(pk=event.pk).update(deadline=self.after(minutes=30))
+        self.assertEqual(scheduler.run_due(now=self.after(minutes=15)), [])
+
+
+class EventQueryCountTest(MediaRootMixin, TestCase):
+    """歌会ページの各段階のクエリ数。歌会と参加者は1リクエストにつき1クエリで取得する"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.event = create_past_event(5)
+        self.member = self.event.participant_set.first().user
+        self.client.force_login(self.member)
+        self.url = f"/events/{self.event.pk}/"
+
+    def set_before_deadline(self):
+        now = timezone.now()
+        Event.objects.filter(pk=self.event.pk).update(
+            deadline=now + timedelta(days=1), start_time=now + timedelta(days=2)
+        )
+
+    def test_detail(self):
+        self.set_before_deadline()
+        # セッション、ユーザー、歌会(司会者・参加・詠草)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["joined"])
+
+    def test_detail_post(self):
+        self.set_before_deadline()
+        data = {
+            "content": "<ruby>再<rt>さい</rt></ruby>提出",
+            "message": "",
+            "user": self.member.pk,
+            "author": self.member.pk,
+            "guest_user": "x",
+            "guest_author": "x",
+        }
+        # セッション、ユーザー、歌会、フォームの検証(3フォーム×2)、詠草の保存、
+        # 前の詠草の削除(歌会の取得と内容の更新日時の更新を含めて6)、
+        # 参加の更新と内容の更新日時の更新、
+        # 投稿者の集計の更新(追加で1、削除で最初・最後の投稿日時の再計算を含めて3)、
+        # 検索の索引とよく似た詠草のバケットの更新(追加と削除で1ずつ)
+        with self.assertNumQueries(24):
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, 302)
+        participant = Participant.objects.get(user=self.member, event=self.event)
+        self.assertEqual(participant.tanka.content_text, "再提出")
+
+    def test_ongoing(self):
+        self.event.generate_files()
+        # セッション、ユーザー、歌会、フィンガープリントのための参加者
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        self.assertTrue(response.context["files_ready"])
+
+    def test_record(self):
+        Event.objects.filter(pk=self.event.pk).update(rec_status="public")
+        # セッション、ユーザー、歌会、参加者(詠草・ユーザーを含む)
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        # 2回目は参加者をキャッシュから読む
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]
+)
+class DoubleSubmitTest(MediaRootMixin, TestCase):
+    def test_concurrent_first_submission_is_resubmission(self):
+        now = timezone.now()
+        event = create_past_event(0)
+        Event.objects.filter(pk=event.pk).update(
+            deadline=now + timedelta(days=1), start_time=now + timedelta(days=2)
+        )
+        user = User.objects.create_memberuser(
+            email="poet@example.com",
+            account_id="poet",
+            password="password",
+            name="歌人",
+        )
+        self.client.force_login(user)
+        # 参加していないユーザーにもフォームを表示する
+        self.assertEqual(self.client.get(f"/events/{event.pk}/").status_code, 200)
+        resolve = views.get_event_for_request
+
+        def resolve_after_other_request(request, pk):
+            # 参加がない状態で歌会を取得した直後に、先の送信が参加を作る
+            resolved = resolve(request, pk)
+            if request.method == "POST":
+                tanka = Tanka.objects.create(content="先の歌", author=user)
+                Participant.objects.create(user=user, event=event, tanka=tanka)
+            return resolved
+
+        with mock.patch.object(
+            views, "get_event_for_request", resolve_after_other_request
+        ):
+            response = self.client.post(
+                f"/events/{event.pk}/",
+                {
+                    "content": "後の歌",
+                    "message": "よろしく",
+                    "user": user.pk,
+                    "author": user.pk,
+                    "guest_user": "x",
+                    "guest_author": "x",
+                },
+            )
+        self.assertEqual(response.status_code, 302)
+        participant = Participant.objects.get(user=user, event=event)
+        self.assertEqual(participant.tanka.content, "後の歌")
+        self.assertEqual(participant.message, "よろしく")
+        self.assertFalse(Tanka.objects.filter(content="先の歌").exists())
+
+
+class VisibilityTest(TestCase):
+    """公開設定(告知×記録)と閲覧者(匿名・非会員・会員)の組み合わせごとに、歌会を開けるか"""
+
+    statuses = ["public", "limited", "private"]
+
+    def setUp(self):
+        cache.clear()
+        organizer = User.objects.create_memberuser(
+            email="organizer@example.com",
+            account_id="organizer",
+            password="password",
+            name="司会者",
+        )
+        self.viewers = {
+            "anonymous": None,
+            "non_member": User.objects.create_user(
+                email="guest@example.com",
+                account_id="guest",
+                password="password",
+                name="非会員",
+            ),
+            "member": User.objects.create_memberuser(
+                email="member@example.com",
+                account_id="member",
+                password="password",
+                name="会員",
+            ),
+        }
+        now = timezone.now()
+        self.events = {}
+        for ann_status in self.statuses:
+            for rec_status in self.statuses:
+                event = Event.objects.create(
+                    organizer=organizer,
+                    start_time=now + timedelta(days=2),
+                    deadline=now + timedelta(days=1),
+                )
+                # saveは記録の公開時に告知を非公開にするため、組み合わせはupdateで作る
+                Event.objects.filter(pk=event.pk).update(
+                    ann_status=ann_status, rec_status=rec_status
+                )
+                self.events[ann_status, rec_status] = event
+
+    @staticmethod
+    def can_open(ann_status, rec_status, viewer):
+        status = ann_status if rec_status == "private" else rec_status
+        return status == "public" or (status == "limited" and viewer == "member")
+
+    def login(self, viewer):
+        user = self.viewers[viewer]
+        if user is None:
+            self.client.logout()
+        else:
+            self.client.force_login(user)
+
+    def test_event_pages(self):
+        for viewer in self.viewers:
+            self.login(viewer)
+            for (ann_status, rec_status), event in self.events.items():
+                with self.subTest(ann=ann_status, rec=rec_status, viewer=viewer):
+                    response = self.client.get(f"/events/{event.pk}/")
+                    visible = self.can_open(ann_status, rec_status, viewer)
+                    self.assertEqual(response.status_code, 200 if visible else 404)
+
+    def test_index(self):
+        for viewer in self.viewers:
+            self.login(viewer)
+            with self.subTest(viewer=viewer):
+                listed = self.client.get("/").context["upcoming"].object_list
+                self.assertCountEqual(
+                    [event.pk for event in listed],
+                    [
+                        event.pk
+                        for (ann_status, rec_status), event in self.events.items()
+                        if self.can_open(ann_status, rec_status, viewer)
+                    ],
+                )
+
+    def test_tankas(self):
+        author = self.viewers["non_member"]
+        tankas = {
+            status: Tanka.objects.create(content=status, author=author, status=status)
+            for status in self.statuses
+        }
+        expected = {
+            "anonymous": ["public"],
+            "non_member": ["public", "limited", "private"],  # 自分の詠草
+            "member": ["public", "limited"],
+        }
+        for viewer, user in self.viewers.items():
+            with self.subTest(viewer=viewer):
+                self.assertCountEqual(
+                    Tanka.objects.visible_to(user).filter(author=author),
+                    [tankas[status] for status in expected[viewer]],
+                )
+
+
+class EventIndexTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now()
+        self.organizers = [
+            User.objects.create_memberuser(
+                email=f"organizer{i}@example.com",
+                account_id=f"organizer{i}",
+                password="password",
+                name=f"司会者{i}",
+            )
+            for i in range(3)
+        ]
+
+    def create_events(self, count, days):
+        """開始時刻が同じ歌会を2つずつ含めて、countの歌会を作る"""
+        return [
+            Event.objects.create(
+                organizer=self.organizers[i % 3],
+                start_time=self.now + timedelta(days=days * (i // 2 + 1)),
+                deadline=self.now + timedelta(days=days * (i // 2 + 1), hours=-3),
+            )
+            for i in range(count)
+        ]
+
+    def expected_order(self, events, descending):
+        return [
+            event.pk
+            for event in sorted(
+                events,
+                key=lambda event: (event.start_time, event.pk),
+                reverse=descending,
+            )
+        ]
+
+    def test_sections_and_pages(self):
+        upcoming = self.create_events(25, 1)
+        past = self.create_events(25, -1)
+
+        response = self.client.get("/")
+        first_upcoming = response.context["upcoming"]
+        first_past = response.context["past"]
+        self.assertEqual(len(first_upcoming.object_list), 20)
+        self.assertEqual(len(first_past.object_list), 20)
+
+        # 続きは指定した側だけを表示する
+        response = self.client.get("/", {"upcoming": first_upcoming.next_cursor})
+        self.assertNotIn("past", response.context)
+        rest = response.context["upcoming"]
+        self.assertFalse(rest.has_next)
+        self.assertEqual(
+            [event.pk for event in first_upcoming.object_list + rest.object_list],
+            self.expected_order(upcoming, descending=False),
+        )
+
+        response = self.client.get(
+            "/", {"format": "json", "section": "past", "past": first_past.next_cursor}
+        )
+        data = response.json()
+        self.assertIsNone(data["next_cursor"])
+        self.assertEqual(
+            [event.pk for event in first_past.object_list]
+            + [event["id"] for event in data["events"]],
+            self.expected_order(past, descending=True),
+        )
+        organizer = Event.objects.get(pk=data["events"][0]["id"]).organizer
+        self.assertEqual(data["events"][0]["organizer"], organizer.name)
+
+        self.assertEqual(self.client.get("/", {"past": "x"}).status_code, 404)
+        self.assertEqual(
+            self.client.get("/", {"format": "json", "section": "x"}).status_code, 404
+        )
+
+    def test_constant_queries(self):
+        self.create_events(5, 1)
+        self.create_events(5, -1)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get("/")
+        self.create_events(40, 1)
+        self.create_events(40, -1)
+        cache.clear()
+        # 司会者はselect_relatedで取得するので、歌会が増えてもクエリ数は変わらない
+        with self.assertNumQueries(len(small)):
+            response = self.client.get("/")
+        self.assertContains(response, "司会者2")
+
+
+class TankaContentTest(TestCase):
+    content = "<ruby>春雨<rt>ハルサメ</rt></ruby>の<script>x</script>\n日"
+
+    def setUp(self):
+        cache.clear()
+        self.event = create_past_event(1, rec_status="public")
+        self.tanka = self.event.participant_set.get().tanka
+
+    def test_save_renders_content(self):
+        self.tanka.content = self.content
+        self.tanka.save()
+        tanka = Tanka.objects.get(pk=self.tanka.pk)
+        self.assertEqual(
+            tanka.content_html,
+            "<ruby>春雨<rt>ハルサメ</rt></ruby>の&lt;script&gt;x&lt;/script&gt;<br>日",
+        )
+        self.assertEqual(tanka.content_text, "春雨の<script>x</script>\n日")
+        self.assertEqual(tanka.reading, "はるさめのscriptxscript日")
+
+    def test_update_fields_includes_rendered_fields(self):
+        self.tanka.content = self.content
+        self.tanka.save(update_fields=["content"])
+        tanka = Tanka.objects.get(pk=self.tanka.pk)
+        self.assertEqual(tanka.content_text, "春雨の<script>x</script>\n日")
+        self.assertEqual(tanka.reading, "はるさめのscriptxscript日")
+
+    def test_record_uses_rendered_html(self):
+        self.tanka.content = self.content
+        self.tanka.save()
+        response = self.client.get(f"/events/{self.event.pk}/")
+        self.assertContains(response, "<ruby>春雨<rt>ハルサメ</rt></ruby>の")
+        self.assertContains(response, "&lt;script&gt;x&lt;/script&gt;<br>日")
+        self.assertNotContains(response, "<script>x</script>")
+
+
+class RecordPageTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_record(self, participant_count):
+        event = create_past_event(
+            participant_count,
+            organizer=User.objects.create_memberuser(
+                email=f"organizer{participant_count}@example.com",
+                account_id=f"organizer{participant_count}",
+                password="password",
+                name="司会者",
+            ),
+            rec_status="public",
+        )
+        # 歌会、参加者(詠草・ユーザーを含む)
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/events/{event.pk}/")
+        return event, response
+
+    def test_constant_queries(self):
+        _, response = self.get_record(5)
+        self.assertEqual(len(response.context["public_tankas"]), 5)
+        _, response = self.get_record(200)
+        self.assertEqual(len(response.context["public_tankas"]), 200)
+        self.assertNotIn("limited_tankas", response.context)
+
+    def test_anonymous_served_from_cache(self):
+        event, response = self.get_record(3)
+        with self.assertNumQueries(0):
+            cached = self.client.get(f"/events/{event.pk}/")
+        self.assertEqual(cached.content, response.content)
+
+    def test_invalidated_when_tanka_changes(self):
+        event, response = self.get_record(3)
+        tanka = event.participant_set.first().tanka
+        tanka.content = "<ruby>新<rt>あら</rt></ruby>た"
+        tanka.save()
+        response = self.client.get(f"/events/{event.pk}/")
+        self.assertContains(response, "<ruby>新<rt>あら</rt></ruby>た", html=False)
+        tanka.status = "private"
+        tanka.save()
+        response = self.client.get(f"/events/{event.pk}/")
+        self.assertEqual(len(response.context["public_tankas"]), 2)
+
+
+class CacheBackendCheckTest(SimpleTestCase):
+    def test_locmem_is_rejected_for_deploy(self):
+        locmem = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        with override_settings(CACHES={"default": locmem}):
+            self.assertEqual(
+                [error.id for error in caching.check_cache_backend(None)],
+                ["utakais.E002"],
+            )
+        with override_settings(CACHES={"default": settings.CACHE_BACKENDS["file"]}):
+            self.assertEqual(caching.check_cache_backend(None), [])
+        errors = checks.run_checks(include_deployment_checks=True)
+        self.assertIn("utakais.E002", [error.id for error in errors])
+
+
+class ConditionalGetTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.event = create_past_event(3)
+        self.member = self.event.participant_set.first().user
+        self.client.force_login(self.member)
+        self.url = f"/events/{self.event.pk}/"
+        now = timezone.now()
+        Event.objects.filter(pk=self.event.pk).update(
+            deadline=now + timedelta(days=1), start_time=now + timedelta(days=2)
+        )
+
+    def test_not_modified_until_content_changes(self):
+        # 1回目でCSRFのCookieが設定され、ETagはそのCookieを含めて決まる
+        self.client.get(self.url)
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        self.assertIn("Last-Modified", response)
+
+        # セッション、ユーザー、歌会だけで、描画せずに304を返す
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        tanka = self.event.participant_set.last().tanka
+        tanka.content = "書き換え"
+        tanka.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_ongoing_checks_freshness_before_not_modified(self):
+        Event.objects.filter(pk=self.event.pk).update(
+            deadline=timezone.now() - timedelta(hours=1)
+        )
+        Event.objects.get(pk=self.event.pk).generate_files()
+        self.client.get(self.url)
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # 歌会の保存なしに変わる入力(参加者の名前)も、304を返す前に確かめる
+        self.member.name = "改名"
+        self.member.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context["files_ready"])
+        self.assertNotIn("ETag", response)
+        self.assertEqual(jobs.latest_job(self.event).status, "queued")
+
+        # 作り直せば、新しいETagで304に答える
+        Event.objects.get(pk=self.event.pk).generate_files()
+        response = self.client.get(self.url)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(
+            self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code,
+            304,
+        )
+
+    def test_index(self):
+        response = self.client.get("/")
+        etag = response["ETag"]
+        self.assertEqual(
+            self.client.get("/", HTTP_IF_NONE_MATCH=etag).status_code, 304
+        )
+        Event.objects.get(pk=self.event.pk).save()
+        response = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # 304は歌会の件数によらず、セッション・ユーザーと開始時刻の索引の検索で返す
+        etag = response["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 3)
+        (sql,) = [q["sql"] for q in queries if q["sql"].startswith("SELECT \"utakais")]
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            self.assertIn("event_start_time", str(cursor.fetchall()))
+
+        # 歌会が始まれば(保存されなくても)「過去の歌会」に移るので、ETagが変わる
+        Event.objects.filter(pk=self.event.pk).update(start_time=timezone.now())
+        self.assertEqual(
+            self.client.get("/", HTTP_IF_NONE_MATCH=etag).status_code, 200
+        )
+
+
+class RetentionTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.event = create_past_event(0)
+        self.directory = settings.MEDIA_ROOT / "events" / str(self.event.pk)
+        self.old = time.time() - 2 * 3600
+
+    def write(self, name, content, directory=None, old=True):
+        path = (directory or self.directory) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        if old:
+            os.utime(path, (self.old, self.old))
+        return path
+
+    def snapshot(self):
+        root = settings.MEDIA_ROOT / "events"
+        return {
+            path: (path.read_bytes(), path.stat().st_ino)
+            for path in sorted(root.rglob("*"))
+            if path.is_file()
+        }
+
+    def remaining(self):
+        return sorted(path.name for path in self.directory.iterdir())
+
+    def test_keep_versions_and_referenced(self):
+        self.write("歌会.docx", b"d1")
+        self.write("歌会.pdf", b"p1")
+        self.write("歌会_ver2.docx", b"d2")
+        self.write("歌会_ver2.pdf", b"p2")
+        # タイトルの変更やストレージの付けた接尾辞があっても、版番で1つの版とみなす
+        self.write("改題_ver3.docx", b"d3")
+        self.write("改題_ver3_AbC12de.pdf", b"p3")
+        self.write("改題_ver4.docx", b"d4")
+        self.write("改題_ver4.pdf", b"p4")
+        Event.objects.filter(pk=self.event.pk).update(
+            eisou_doc=f"events/{self.event.pk}/歌会_ver2.docx",
+            eisou_pdf=f"events/{self.event.pk}/歌会_ver2.pdf",
+        )
+
+        report = collect_eisou_garbage(keep=1)
+        self.assertEqual(
+            self.remaining(),
+            ["改題_ver4.docx", "改題_ver4.pdf", "歌会_ver2.docx", "歌会_ver2.pdf"],
+        )
+        self.assertEqual(len(report.deleted), 4)
+        self.assertEqual(report.reclaimed_bytes, 8)
+
+    def test_grace_period(self):
+        self.write("歌会.pdf", b"v1")
+        self.write("歌会_ver2.pdf", b"v2", old=False)
+        self.write("歌会_ver3.pdf", b"v3")
+        collect_eisou_garbage(keep=1)
+        self.assertEqual(self.remaining(), ["歌会_ver2.pdf", "歌会_ver3.pdf"])
+
+    def test_orphaned_directories(self):
+        root = settings.MEDIA_ROOT / "events"
+        old_dir = root / "999998"
+        self.write("歌会.pdf", b"old", directory=old_dir)
+        os.utime(old_dir, (self.old, self.old))
+        # 削除されたばかりの歌会のディレクトリは猶予の間残す
+        new_dir = root / "999999"
+        self.write("歌会.pdf", b"new", directory=new_dir)
+
+        report = collect_eisou_garbage()
+        self.assertEqual([path for path, _, _ in report.deleted], [old_dir])
+        self.assertFalse(old_dir.exists())
+        self.assertTrue(new_dir.exists())
+        self.assertTrue((root / "samples" / "utakai_sample.docx").exists())
+
+    def test_anthology_exports(self):
+        tanka_list = TankaList.objects.create(
+            title="選集", owner=self.event.organizer, description=""
+        )
+        root = settings.MEDIA_ROOT / "lists"
+        directory = root / str(tanka_list.pk)
+        keep = TankaList.anthology_keep_files
+        for i in range(keep + 1):
+            path = self.write(f"{i}.docx", b"docx%d" % i, directory=directory)
+            os.utime(path, (self.old - i, self.old - i))
+        self.write("0.pdf", b"pdf", directory=directory)
+        # 書き出したばかりのファイルは数に入れるが、猶予の間は消さない
+        self.write("new.docx", b"new", directory=directory, old=False)
+        old_dir = root / "999998"
+        self.write("0.docx", b"old", directory=old_dir)
+        os.utime(old_dir, (self.old, self.old))
+        new_dir = root / "999999"
+        self.write("0.docx", b"new", directory=new_dir)
+
+        report = collect_eisou_garbage()
+        self.assertEqual(
+            sorted(path.name for path in directory.iterdir()),
+            ["0.docx", "0.pdf", "1.docx", "2.docx", "3.docx", "4.docx", "new.docx"],
+        )
+        self.assertEqual(
+            [(path, reason) for path, _, reason in report.deleted],
+            [
+                (directory / "5.docx", "old export"),
+                (directory / "6.docx", "old export"),
+                (old_dir, "orphaned"),
+            ],
+        )
+        self.assertTrue(new_dir.exists())
+
+    def test_stale_work_dirs(self):
+        tanka_list = TankaList.objects.create(
+            title="選集", owner=self.event.organizer, description=""
+        )
+        list_dir = settings.MEDIA_ROOT / "lists" / str(tanka_list.pk)
+        stale = [
+            self.directory / ".generate-abc",
+            self.directory / Event.eisou_rendered_dir / ".render-abc",
+            list_dir / ".export-abc",
+        ]
+        for work_dir in stale:
+            self.write("歌会.docx", b"partial", directory=work_dir)
+            os.utime(work_dir, (self.old, self.old))
+        # 生成中の作業用ディレクトリには触れない
+        running = self.directory / ".generate-new"
+        self.write("歌会.docx", b"partial", directory=running, old=False)
+
+        report = collect_eisou_garbage()
+        self.assertEqual(
+            sorted(
+                (str(path), reason)
+                for path, _, reason in report.deleted
+                if path.name.startswith(".")
+            ),
+            sorted((str(path), "stale work dir") for path in stale),
+        )
+        for work_dir in stale:
+            self.assertFalse(work_dir.exists())
+        self.assertTrue(running.exists())
+
+    def test_hard_link_duplicates(self):
+        first = self.write("歌会.pdf", b"same")
+        second = self.write("改題_ver2.pdf", b"same")
+        report = collect_eisou_garbage(keep=2)
+        self.assertEqual(len(report.linked), 1)
+        self.assertEqual(report.reclaimed_bytes, 4)
+        self.assertEqual(first.stat().st_ino, second.stat().st_ino)
+        self.assertEqual(first.read_bytes(), b"same")
+        self.assertEqual(second.read_bytes(), b"same")
+        # 2回目はすでにリンクされている
+        self.assertEqual(collect_eisou_garbage(keep=2).linked, [])
+
+    def test_dry_run_leaves_tree_unchanged(self):
+        self.write("歌会.pdf", b"v1")
+        self.write("歌会_ver2.pdf", b"same")
+        self.write("歌会_ver3.pdf", b"same")
+        self.write("歌会.pdf", b"orphan", directory=self.directory.parent / "999999")
+        os.utime(self.directory.parent / "999999", (self.old, self.old))
+        before = self.snapshot()
+
+        dry_report = collect_eisou_garbage(keep=2, dry_run=True)
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(dry_report.reclaimed_bytes, 2 + 6 + 4)
+
+        report = collect_eisou_garbage(keep=2)
+        self.assertEqual(report.reclaimed_bytes, dry_report.reclaimed_bytes)
+        self.assertEqual(report.deleted, dry_report.deleted)
+        self.assertNotEqual(self.snapshot(), before)
+
+
+class DeliveryTest(MediaRootMixin, TestCase):
+    content = b"0123456789" * 10
+
+    def setUp(self):
+        super().setUp()
+        self.event = create_past_event(0)
+        directory = settings.MEDIA_ROOT / "events" / str(self.event.pk)
+        directory.mkdir(parents=True)
+        (directory / "歌会.pdf").write_bytes(self.content)
+        Event.objects.filter(pk=self.event.pk).update(
+            eisou_pdf=f"events/{self.event.pk}/歌会.pdf", eisou_number=1
+        )
+        self.url = f"/events/{self.event.pk}/download/eisou_pdf/"
+
+    def get(self, **headers):
+        return self.client.get(self.url, headers=headers)
+
+    def body(self, response):
+        return b"".join(response.streaming_content)
+
+    def test_full_and_conditional(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        etag = response["ETag"]
+        self.assertEqual(self.get(**{"If-None-Match": etag}).status_code, 304)
+        self.assertEqual(self.get(**{"If-None-Match": '"other"'}).status_code, 200)
+
+    def test_range(self):
+        response = self.get(Range="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(self.body(response), self.content[10:20])
+        # 末尾のNバイト、末尾を越える終了
+        self.assertEqual(self.body(self.get(Range="bytes=-5")), self.content[-5:])
+        self.assertEqual(self.body(self.get(Range="bytes=95-200")), self.content[95:])
+        # 構文として不正な範囲は無視して全体を返す
+        response = self.get(Range="bytes=20-10")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        # 満たせない範囲
+        response = self.get(Range="bytes=100-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */100")
+
+    def test_if_range(self):
+        etag = self.get()["ETag"]
+        response = self.get(Range="bytes=0-9", **{"If-Range": etag})
+        self.assertEqual(response.status_code, 206)
+        # ファイルが変わっていれば、Rangeを無視して全体を返す
+        response = self.get(Range="bytes=0-9", **{"If-Range": '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        response = self.get(Range="bytes=500-", **{"If-Range": '"other"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_immutable_only_for_current_version(self):
+        response = self.client.get(self.url, {"v": 1})
+        self.assertIn("immutable", response["Cache-Control"])
+        response = self.client.get(self.url, {"v": 0})
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+    def test_offload(self):
+        with override_settings(EISOU_FILE_DELIVERY="x-accel-redirect"):
+            response = self.get()
+            self.assertEqual(
+                response["X-Accel-Redirect"],
+                quote(f"/protected/events/{self.event.pk}/歌会.pdf"),
+            )
+            self.assertEqual(response.content, b"")
+            self.assertEqual(response["Content-Type"], "application/pdf")
+            self.assertIn("ETag", response)
+            # 条件付きリクエストはDjangoが304を返す
+            etag = response["ETag"]
+            response = self.get(**{"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertNotIn("X-Accel-Redirect", response)
+        with override_settings(EISOU_FILE_DELIVERY="x-sendfile"):
+            response = self.get()
+            path = settings.MEDIA_ROOT / "events" / str(self.event.pk) / "歌会.pdf"
+            self.assertEqual(response["X-Sendfile"], quote(str(path)))
+
+    def test_hash_cache_bounded(self):
+        path = settings.MEDIA_ROOT / "events" / str(self.event.pk) / "歌会.pdf"
+        first = file_sha256(path)
+        self.assertEqual(file_sha256(path), first)
+        # 版を重ねたファイルごとに覚えても、上限を超えて増えない
+        maxsize = utils._cached_sha256.cache_info().maxsize
+        for i in range(maxsize + 10):
+            path.write_bytes(b"%d" % i)
+            os.utime(path, ns=(i * 10**9, i * 10**9))
+            file_sha256(path)
+        self.assertEqual(utils._cached_sha256.cache_info().currsize, maxsize)
+        self.assertNotEqual(file_sha256(path), first)
+
+    def test_visibility(self):
+        Event.objects.filter(pk=self.event.pk).update(ann_status="private")
+        self.assertEqual(self.get().status_code, 404)
+
+    def test_upload_changes_version(self):
+        self.client.force_login(self.event.organizer)
+        data = {
+            field: getattr(self.event, field) or ""
+            for field in [
+                "title",
+                "location",
+                "ann_status",
+                "ann_desc",
+                "rec_status",
+                "rec_desc",
+            ]
+        }
+        for field in ["start_time", "end_time", "deadline"]:
+            data[field] = timezone.localtime(getattr(self.event, field)).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+        data.update(
+            {
+                "participant_set-TOTAL_FORMS": 0,
+                "participant_set-INITIAL_FORMS": 0,
+                "eisou_pdf": SimpleUploadedFile("差し替え.pdf", b"%PDF-1.4\n"),
+            }
+        )
+        response = self.client.post(f"/events/{self.event.pk}/admin/", data)
+        self.assertEqual(response.status_code, 302)
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.eisou_number, 2)
+        # 以前の版のURLは長期間キャッシュさせない
+        response = self.client.get(self.url, {"v": 1})
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        self.assertEqual(self.body(response), b"%PDF-1.4\n")
+
+
+class ProfileTest(TestCase):
+    def setUp(self):
+        self.event = create_past_event(1)
+        self.author = self.event.participant_set.get().user
+        for i in range(24):
+            Tanka.objects.create(content=f"歌{i}", author=self.author, status="public")
+        Tanka.objects.create(content="非公開", author=self.author, status="private")
+
+    def test_summary_updated_incrementally(self):
+        summary = UserTankaSummary.summary_for(self.author)
+        self.assertEqual((summary.tanka_count, summary.event_count), (26, 1))
+        event = create_past_event(0, organizer=self.event.organizer)
+        tanka = Tanka.objects.create(content="新作", author=self.author, status="public")
+        Participant.objects.create(user=self.author, event=event, tanka=tanka)
+        summary.refresh_from_db()
+        self.assertEqual((summary.tanka_count, summary.event_count), (27, 2))
+        self.assertEqual(summary.last_activity_at, tanka.created_at)
+
+        tanka.delete()
+        summary.refresh_from_db()
+        expected = UserTankaSummary.aggregate(self.author)
+        for field, value in expected.items():
+            self.assertEqual(getattr(summary, field), value)
+
+    def test_keyset_pagination(self):
+        url = f"/@{self.author.account_id}/"
+        response = self.client.get(url)
+        first = response.context["tankas"]
+        self.assertEqual(len(first), 20)
+        cursor = response.context["page"].next_cursor
+        second = self.client.get(url, {"cursor": cursor}).context["tankas"]
+        # 匿名の閲覧者には非公開の詠草は見えない
+        self.assertEqual(len(second), 5)
+        self.assertEqual(second[-1].event_pk, self.event.pk)
+        self.assertIsNone(second[0].event_pk)
+        self.assertFalse({t.pk for t in first} & {t.pk for t in second})
+        self.assertEqual(self.client.get(url, {"cursor": "x"}).status_code, 404)
+        self.assertEqual(self.client.get("/@nobody/").status_code, 404)
+
+    def test_summary_only_for_owner(self):
+        url = f"/@{self.author.account_id}/"
+        response = self.client.get(url)
+        self.assertNotIn("summary", response.context)
+        self.assertNotContains(response, "詠草数")
+        self.client.force_login(self.event.organizer)
+        self.assertNotIn("summary", self.client.get(url).context)
+        self.client.force_login(self.author)
+        response = self.client.get(url)
+        self.assertEqual(response.context["summary"].tanka_count, 26)
+        self.assertContains(response, "詠草数：26")
+
+
+class TankaSearchTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_memberuser(
+            email="author@example.com",
+            account_id="author",
+            password="password",
+            name="歌人",
+        )
+
+        def create(content, status="public"):
+            return Tanka.objects.create(
+                content=content, author=self.author, status=status
+            )
+
+        self.ruby = create("<ruby>紫陽花<rt>あじさい</rt></ruby>の色うつろふ")
+        self.kana = create("ｶﾞﾗｽ越しに見るＡＢＣ")
+        self.private = create("紫陽花の庭", status="private")
+        self.url = "/tankas/search/"
+
+    def search(self, query):
+        response = self.client.get(self.url, {"q": query})
+        return [tanka.pk for tanka in response.context["tankas"]]
+
+    def test_normalize(self):
+        self.assertEqual(normalize("ｶﾞﾗｽ、ＡＢＣ　１"), "ガラスabc1")
+        self.assertEqual(match_expression("春の風 君"), '"春の の風" AND "君"*')
+        self.assertIsNone(match_expression("、 。"))
+
+    def test_search(self):
+        # ルビは除いて索引し、全角・半角の違いはそろえる
+        self.assertEqual(self.search("紫陽花"), [self.ruby.pk])
+        self.assertEqual(self.search("あじさい"), [])
+        self.assertEqual(self.search("ガラス abc"), [self.kana.pk])
+        self.assertEqual(self.search("色"), [self.ruby.pk])
+        self.assertEqual(self.search("ふ"), [self.ruby.pk])
+
+    def test_visibility_and_index_updates(self):
+        self.client.force_login(self.author)
+        self.assertEqual(set(self.search("紫陽花")), {self.ruby.pk, self.private.pk})
+        self.client.logout()
+
+        self.ruby.content = "夏の雨"
+        self.ruby.save()
+        self.private.delete()
+        self.assertEqual(self.search("紫陽花"), [])
+        self.assertEqual(self.search("夏の雨"), [self.ruby.pk])
+
+    def test_search_by_reading(self):
+        self.assertEqual(self.ruby.reading, "あじさいの色うつろふ")
+        self.assertEqual(self.kana.reading, "がらす越しに見るabc")
+        response = self.client.get(self.url, {"q": "アジサイノ", "by": "reading"})
+        self.assertEqual([t.pk for t in response.context["tankas"]], [self.ruby.pk])
+        response = self.client.get(self.url, {"q": "じさい", "by": "reading"})
+        self.assertFalse(response.context["tankas"])
+
+        # 前方一致は読みの索引の範囲検索で答える
+        tankas = search_by_reading(Tanka.objects.all(), "がら")
+        self.assertEqual([t.pk for t in tankas], [self.kana.pk])
+        self.assertIn("tanka_reading", tankas.explain())
+
+
+class SimilarTankaTest(TestCase):
+    original = "<ruby>紫陽花<rt>あじさい</rt></ruby>の色うつろへる庭に立ち君の言の葉ひとつ思へり"
+
+    def setUp(self):
+        self.past = create_past_event(3, title="前回")
+        self.organizer = self.past.organizer
+        self.tanka = self.past.participant_set.first().tanka
+        self.tanka.content = self.original
+        self.tanka.save()
+
+    def test_signature(self):
+        self.assertEqual(shingles("ＡＢ、ｃｄ"), {"abc", "bcd"})
+        a = signature("紫陽花の色うつろへる庭に立ち")
+        self.assertEqual(estimate(a, signature("紫陽花の色うつろへる庭に立ち")), 1.0)
+        self.assertLess(estimate(a, signature("鴨川の硝子の向日葵")), 0.2)
+        self.assertIsNone(signature("、。"))
+
+    def test_find_similar(self):
+        # ゲストの筆名で、表記を少し変えて再提出したもの
+        resubmitted = Tanka.objects.create(
+            content="紫陽花の色うつろへる庭に立ち君の言の葉ひとつ思ふ",
+            guest_author="別名",
+        )
+        similar = find_similar([resubmitted])
+        self.assertEqual(
+            [match.tanka.pk for match in similar[resubmitted.pk]], [self.tanka.pk]
+        )
+        self.assertEqual(similar[resubmitted.pk][0].tanka.event_pk, self.past.pk)
+        self.assertGreater(similar[resubmitted.pk][0].score, 0.5)
+
+        self.tanka.content = "まったく別の歌"
+        self.tanka.save()
+        self.assertEqual(find_similar([resubmitted]), {})
+
+    def test_backfill(self):
+        TankaBucket.objects.all().delete()
+        Tanka.objects.update(minhash=None)
+        self.assertEqual(backfill(Tanka.objects.all(), batch_size=2), 3)
+        self.assertEqual(TankaBucket.objects.count(), 3 * 16)
+        copy = Tanka.objects.create(content=self.original, guest_author="別名")
+        self.assertEqual(find_similar([copy])[copy.pk][0].score, 1.0)
+
+    def test_report(self):
+        event = create_past_event(0, organizer=self.organizer, title="今回")
+        guest = Participant.objects.create(
+            event=event,
+            guest_user="別名",
+            tanka=Tanka.objects.create(content=self.original, guest_author="別名"),
+        )
+        url = f"/events/{event.pk}/admin/similar/"
+        self.client.force_login(self.past.participant_set.last().user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        # 司会者が見られない詠草は、筆名・歌会の名前も含めて報告に載せない
+        hidden = create_past_event(
+            1,
+            organizer=self.past.participant_set.last().user,
+            title="非公開の歌会",
+            ann_status="private",
+            rec_status="private",
+        ).participant_set.get().tanka
+        hidden.content = self.original
+        hidden.status = "private"
+        hidden.save()
+
+        self.client.force_login(self.organizer)
+        response = self.client.get(url)
+        ((participant, matches),) = response.context["report"]
+        self.assertEqual(participant, guest)
+        self.assertEqual([match.tanka.pk for match in matches], [self.tanka.pk])
+        self.assertContains(response, "前回")
+        self.assertNotContains(response, "非公開の歌会")
+
+    def test_no_notice_to_submitter(self):
+        event = create_past_event(0, organizer=self.organizer)
+        now = timezone.now()
+        Event.objects.filter(pk=event.pk).update(
+            deadline=now + timedelta(days=1), start_time=now + timedelta(days=2)
+        )
+        response = self.client.post(
+            f"/events/{event.pk}/",
+            {
+                "content": self.original,
+                "message": "",
+                "user": "",
+                "author": "",
+                "guest_user": "別名",
+                "guest_author": "別名",
+            },
+            follow=True,
+        )
+        self.assertEqual(
+            [str(message) for message in response.context["messages"]], ["提出しました。"]
+        )
+
+
+class TankaListOrderTest(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_memberuser(
+            email="owner@example.com",
+            account_id="owner",
+            password="password",
+            name="選者",
+        )
+        self.tankas = [
+            Tanka.objects.create(content=f"歌{i}", author=self.owner) for i in range(5)
+        ]
+        self.tanka_list = TankaList.objects.create(
+            title="選集", owner=self.owner, description=""
+        )
+
+    def ordered_ids(self):
+        return list(self.tanka_list.tankalistitem_set.values_list("tanka_id", flat=True))
+
+    def test_add_tankas(self):
+        # 最後の順序の取得とINSERTの2クエリ
+        with self.assertNumQueries(2):
+            self.tanka_list.add_tankas(self.tankas[:3])
+        # 既にある短歌は無視する
+        self.tanka_list.add_tankas(self.tankas[1:])
+        self.assertEqual(self.ordered_ids(), [tanka.pk for tanka in self.tankas])
+        with self.assertRaises(ValueError):
+            self.tanka_list.add_tanka(self.tankas[0])
+
+    def test_move_updates_one_row(self):
+        self.tanka_list.add_tankas(self.tankas)
+        ids = [tanka.pk for tanka in self.tankas]
+        new_ids = [ids[3], *ids[:3], ids[4]]
+        # 並びの取得と1行の更新
+        with self.assertNumQueries(2):
+            self.assertEqual(self.tanka_list.reorder(new_ids), 1)
+        self.assertEqual(self.ordered_ids(), new_ids)
+
+        self.assertEqual(self.tanka_list.reorder(list(reversed(new_ids))), 4)
+        self.assertEqual(self.ordered_ids(), list(reversed(new_ids)))
+        with self.assertRaises(ValueError):
+            self.tanka_list.reorder(ids[:4])
+
+    def test_rebalance_when_gaps_run_out(self):
+        self.tanka_list.add_tankas(self.tankas)
+        for i, item in enumerate(self.tanka_list.tankalistitem_set.all(), start=1):
+            item.order = i
+            item.save()
+        ids = [tanka.pk for tanka in self.tankas]
+        new_ids = [ids[0], ids[4], *ids[1:4]]
+        self.tanka_list.reorder(new_ids)
+        self.assertEqual(self.ordered_ids(), new_ids)
+        self.assertEqual(
+            list(self.tanka_list.tankalistitem_set.values_list("order", flat=True)),
+            [TankaListItem.ORDER_GAP * i for i in range(1, 6)],
+        )
+
+    def test_reorder_endpoint(self):
+        self.tanka_list.add_tankas(self.tankas)
+        url = f"/lists/{self.tanka_list.pk}/reorder/"
+        new_ids = [tanka.pk for tanka in reversed(self.tankas)]
+        body = json.dumps({"tankas": new_ids})
+        self.assertEqual(
+            self.client.post(url, body, content_type="application/json").status_code,
+            403,
+        )
+        self.client.force_login(self.owner)
+        response = self.client.post(url, body, content_type="application/json")
+        self.assertEqual(response.json(), {"updated": 4})
+        self.assertEqual(self.ordered_ids(), new_ids)
+        response = self.client.post(
+            url, json.dumps({"tankas": new_ids[:2]}), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class TankaListExportTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_memberuser(
+            email="owner@example.com",
+            account_id="owner",
+            password="password",
+            name="選者",
+        )
+        other = User.objects.create_memberuser(
+            email="other@example.com",
+            account_id="other",
+            password="password",
+            name="歌人",
+        )
+        self.tankas = [
+            Tanka.objects.create(
+                content="<ruby>紫陽花<rt>あじさい</rt></ruby>の歌",
+                author=other,
+                status="public",
+            ),
+            Tanka.objects.create(content="限定公開の歌", author=other, status="limited"),
+            Tanka.objects.create(content="ゲストの歌", guest_author="客", status="public"),
+        ]
+        self.tanka_list = TankaList.objects.create(
+            title="選集", owner=self.owner, description="説明"
+        )
+        self.tanka_list.add_tankas(self.tankas)
+        self.url = f"/lists/{self.tanka_list.pk}/download/docx/"
+
+    def document_text(self, response):
+        content = b"".join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(content)) as docx:
+            xml = etree.fromstring(docx.read("word/document.xml"))
+        return "".join(xml.itertext())
+
+    def test_export_in_list_order_for_viewer(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(quote("選集.docx"), response["Content-Disposition"])
+        text = self.document_text(response)
+        self.assertIn("選集", text)
+        self.assertIn("【編者】選者", text)
+        # ルビは本文の前にある
+        self.assertIn("1．あじさい紫陽花の歌　歌人2．限定公開の歌　歌人3．ゲストの歌　客", text)
+
+        # 内容が変わらなければ同じファイル(304)、並べ替えれば書き出し直す
+        etag = response["ETag"]
+        self.assertEqual(
+            self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304
+        )
+        self.tanka_list.reorder([tanka.pk for tanka in reversed(self.tankas)])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("1．ゲストの歌　客", self.document_text(response))
+
+        # 非会員には限定公開の短歌を載せない
+        self.client.logout()
+        text = self.document_text(self.client.get(self.url))
+        self.assertNotIn("限定公開の歌", text)
+        self.assertIn("2．あじさい紫陽花の歌", text)
+
+    def test_pdf_and_private_list(self):
+        self.client.force_login(self.owner)
+        pdf_url = f"/lists/{self.tanka_list.pk}/download/pdf/"
+        # 変換(LibreOffice)が要るpdfは、リクエストの中では書き出さない
+        with mock.patch("utakais.models.get_converter") as get_converter:
+            self.assertEqual(self.client.get(pdf_url).status_code, 404)
+        get_converter.assert_not_called()
+        with override_settings(
+            EISOU_PDF_RENDERER="reportlab",
+            EISOU_PDF_FONT=Path(reportlab.__file__).parent / "fonts" / "Vera.ttf",
+        ):
+            response = self.client.get(pdf_url)
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+
+        self.tanka_list.is_public = False
+        self.tanka_list.save()
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+@override_settings(
+    EISOU_PDF_FONT=Path(reportlab.__file__).parent / "fonts" / "Vera.ttf"
+)
+class RenderedEisouPdfTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.event = create_past_event(2)
+        self.url = f"/events/{self.event.pk}/eisou.pdf"
+
+    def test_rendered_once_per_content(self):
+        with mock.patch.object(
+            Event, "render_eisou_pdf", autospec=True, side_effect=Event.render_eisou_pdf
+        ) as render:
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+            etag = response["ETag"]
+            self.assertEqual(
+                self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304
+            )
+            self.assertEqual(render.call_count, 1)
+
+            tanka = self.event.participant_set.exclude(tanka=None).first().tanka
+            tanka.content = "書き直した歌"
+            tanka.save()
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(render.call_count, 2)
+
+    def test_visibility(self):
+        self.event.ann_status = "limited"
+        self.event.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.force_login(self.event.organizer)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+        self.event.ann_status = "private"
+        self.event.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_font_required(self):
+        with override_settings(EISOU_PDF_FONT=None):
+            with self.assertRaises(ImproperlyConfigured):
+                get_font_name()
+            with override_settings(EISOU_PDF_RENDERER="reportlab"):
+                self.assertEqual(
+                    [error.id for error in check_font(None)], ["utakais.E001"]
+                )
+            # 変換でpdfを作る設定でも、eisou.pdfはフォントがなければ配信しない
+            self.assertEqual(check_font(None), [])
+            self.assertEqual(
+                [error.id for error in check_rendered_pdf_font(None)],
+                ["utakais.W001"],
+            )
+            self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(check_rendered_pdf_font(None), [])
@@ -7,11 +7,16 @@ app_name = "utakais"
 
 urlpatterns = [
     path('events/<int:pk>/admin/', views.EventAdminView.as_view(), name="event_admin"),
+    path('events/<int:pk>/admin/similar/', views.EventSimilarView.as_view(), name="event_similar"),
     path('events/<int:pk>/download/<str:file_type>/',views.download_eisou_file,name="download_eisou_file"),
+    path('events/<int:pk>/eisou.pdf',views.render_eisou_pdf_view,name="render_eisou_pdf"),
     path('events/<int:pk>/execute_method/<str:method_name>/', views.execute_method, {'app_name': 'utakais', 'model_name': 'Event'}, name='execute_method'),
     path('events/<int:pk>/',views.change_event_view,name="event_detail"),
     path('events/create/',views.EventCreateView.as_view(),name="event_create"),
 #    path('tankas/<int:pk>/edit',views.TankaEditView.as_view(),name="tanka_edit"),
+    path('lists/<int:pk>/download/<str:file_type>/',views.download_tanka_list,name="download_tanka_list"),
+    path('lists/<int:pk>/reorder/',views.reorder_tanka_list,name="tanka_list_reorder"),
+    path('tankas/search/',views.TankaSearchView.as_view(),name="tanka_search"),
     path('tankas/<int:pk>/',views.TankaDetailView.as_view(),name="tanka_detail"),
 #    path('tankas/create/',views.TankaCreateView.as_view(),name="tanka_create"),
 #    path('tankas/',views.TankaIndexView.as_view(),name="tanka_index"),
@@ -1,38 +1,128 @@
+import json
 from pathlib import Path
 
 from django import forms
-from django.apps import apps
 from django.conf import settings
+from django.apps import apps
 from django.contrib import messages
-from django.core.files.storage import default_storage
-from django.http import FileResponse, Http404, HttpResponseNotFound
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponseNotFound, JsonResponse
+from django.db import IntegrityError, transaction
+from django.db.models import F, FilteredRelation, Q
 from django.shortcuts import get_object_or_404, redirect
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.views.decorators.http import require_POST
 from django.views.generic import (
     CreateView,
     DetailView,
     FormView,
     ListView,
+    TemplateView,
 )
 from django.views.generic.edit import UpdateView
 
+from . import caching, delivery, jobs, pdf, records, search, similarity
 from .forms import EventForm, ParticipantForm, ParticipantFormSet, TankaForm
-from .models import Event, Participant, Tanka
+from .models import Event, Participant, Tanka, TankaList
+from .pagination import keyset_page
 
 
-class EventIndexView(ListView):
-    model = Event
+class EventIndexView(TemplateView):
+    """
+    歌会一覧。これからの歌会(開始の早い順)と過去の歌会(新しい順)を別々にキーセットでページ送りする
+    ?upcoming=,?past=にカーソルを渡すと、その続きを表示する
+    ?format=jsonなら、sectionで指定した側の続きをJSONで返す(無限スクロール用)
+    """
+
     template_name = "utakais/events/index.html"
-    context_object_name = "events"
+    paginate_by = 20
+    sections = {
+        # セクション名: (開始時刻の条件, 新しい順か)
+        "upcoming": ("start_time__gte", False),
+        "past": ("start_time__lt", True),
+    }
+
+    def get_page(self, section):
+        lookup, descending = self.sections[section]
+        queryset = (
+            Event.objects.visible_to(self.request.user)
+            .filter(**{lookup: timezone.now()})
+            .select_related("organizer")
+        )
+        try:
+            return keyset_page(
+                queryset,
+                "start_time",
+                cursor=self.request.GET.get(section),
+                per_page=self.paginate_by,
+                descending=descending,
+            )
+        except ValueError:
+            raise Http404("ページが見つかりません。")
 
-    def get_queryset(self):
+    def get_validators(self):
+        """
+        歌会一覧の版(いずれかの歌会が変わると上がる)と、最後に開始した歌会の開始時刻から作る
+        (ETag, None)。開始時刻を過ぎた歌会は「過去の歌会」に移るため、開始時刻も含める
+        歌会の件数によらず、キャッシュの読み出しと索引(event_start_time)の検索1回で済む
+        """
         user = self.request.user
-        if user.is_authenticated and user.is_member:
-            queryset = Event.objects.filter(ann_status__in=["public", "limited"])
-        else:
-            queryset = Event.objects.filter(ann_status="public")
-        return queryset
+        last_started = (
+            Event.objects.filter(start_time__lt=timezone.now())
+            .order_by("-start_time")
+            .values_list("start_time", flat=True)
+            .first()
+        )
+        etag = caching.make_etag(
+            "EventIndexView",
+            caching.get_index_version(),
+            last_started.isoformat() if last_started else "",
+            user.pk if user.is_authenticated else "",
+            self.request.GET.urlencode(),
+        )
+        return etag, None
+
+    def get(self, request, *args, **kwargs):
+        validators = self.get_validators()
+        response = caching.not_modified(request, *validators)
+        if response is None:
+            response = self.render_page(request, *args, **kwargs)
+            caching.set_validators(response, *validators)
+        return response
+
+    def render_page(self, request, *args, **kwargs):
+        if request.GET.get("format") == "json":
+            section = request.GET.get("section", "past")
+            if section not in self.sections:
+                raise Http404("ページが見つかりません。")
+            page = self.get_page(section)
+            return JsonResponse(
+                {
+                    "events": [self.event_as_json(event) for event in page.object_list],
+                    "next_cursor": page.next_cursor,
+                }
+            )
+        return super().get(request, *args, **kwargs)
+
+    @staticmethod
+    def event_as_json(event):
+        return {
+            "id": event.pk,
+            "title": event.title,
+            "start_time": event.start_time.isoformat(),
+            "organizer": event.organizer.name if event.organizer else "",
+            "url": reverse("utakais:event_detail", kwargs={"pk": event.pk}),
+        }
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # カーソルが指定された側だけを続きから表示し、他方は先頭から表示する
+        requested = [name for name in self.sections if name in self.request.GET]
+        for section in self.sections:
+            if not requested or section in requested:
+                context[section] = self.get_page(section)
+        return context
 
 
 class EventCreateView(CreateView):
@@ -49,6 +139,27 @@ class EventCreateView(CreateView):
     success_url = reverse_lazy("utakais:events_index")
 
 
+def get_event_for_request(request, pk):
+    """
+    userが開ける歌会を、司会者とログイン中のユーザーの参加(詠草を含む)とあわせて1クエリで取得する
+    参加していなければevent.current_participationはNone
+    """
+    user = request.user
+    queryset = Event.objects.visible_to(user).select_related("organizer")
+    if user.is_authenticated:
+        queryset = queryset.annotate(
+            current_participation=FilteredRelation(
+                "participant", condition=Q(participant__user=user)
+            )
+        ).select_related("current_participation__tanka")
+    event = get_object_or_404(queryset, pk=pk)
+    # 参加していなければ、select_relatedは属性を設定しない
+    event.current_participation = getattr(event, "current_participation", None)
+    if event.current_participation is not None:
+        event.current_participation.user = user
+    return event
+
+
 def change_event_view(request, pk):
     """
     歌会の公開非公開などによって表示するビューを変える。
@@ -56,39 +167,85 @@ def change_event_view(request, pk):
     告知公開中から締め切り前->短歌投稿フォーム(EventDetailView)
     締め切り後->締め切りましたor短歌一覧（EventOngoingView）
     記録公開後->記録用のビュー（EventRecordView）
+    公開設定による可否はEvent.objects.visible_toで判定し、取得した歌会はeventとして各ビューに渡す
+    非ログインの閲覧者には、キャッシュがあれば歌会を取得せずにそれを返す
     """
-    event = get_object_or_404(Event, pk=pk)
-    user = request.user
-    if event.rec_is_public:
-        return EventRecordView.as_view()(request, pk=pk)
-    elif event.rec_is_limited:
-        if user.is_authenticated and user.is_member:
-            return EventRecordView.as_view()(request, pk=pk)
-        else:
-            return event_not_found(request)
-    elif event.rec_is_private:
-        if event.ann_is_public:
-            if event.deadline > timezone.now():
-                return EventDetailView.as_view()(request, pk=pk)
-            else:
-                return EventOngoingView.as_view()(request, pk=pk)
-        elif event.ann_is_limited:
-            if user.is_authenticated and user.is_member:
-                if event.deadline > timezone.now():
-                    return EventDetailView.as_view()(request, pk=pk)
-                else:
-                    return EventOngoingView.as_view()(request, pk=pk)
-            else:
-                return event_not_found
-        elif event.ann_is_private:
-            return event_not_found(request)
+    response = caching.get_cached_page(request, pk)
+    if response is not None:
+        return caching.revalidate_cached_page(request, response)
+    try:
+        event = get_event_for_request(request, pk)
+    except Http404:
+        return event_not_found(request)
+    if not event.rec_is_private:
+        view = EventRecordView
+    elif event.deadline > timezone.now():
+        view = EventDetailView
+    else:
+        view = EventOngoingView
+    response = view.as_view()(request, pk=pk, event=event)
+    return caching.cache_page(request, pk, view, response)
 
 
 def event_not_found(request):
     return HttpResponseNotFound("<h1>歌会が見つかりません。</h1>")
 
 
-class EventDetailView(FormView):
+class ResolvedEventMixin:
+    """
+    change_event_viewで取得済みの歌会(kwargsのevent)を使う。なければ取得する
+    GETには歌会の内容の更新日時からETag,Last-Modifiedを付け、変わっていなければ描画せずに304を返す
+    """
+
+    def get_validators(self):
+        """(ETag, Last-Modified)を返す。Noneなら条件付きGETに答えない"""
+        event = self.get_event()
+        last_modified = event.content_updated_at
+        # 締切を過ぎると、保存されなくても表示が変わる
+        if event.deadline <= timezone.now():
+            last_modified = max(last_modified, event.deadline)
+        user = self.request.user
+        etag = caching.make_etag(
+            type(self).__name__,
+            event.pk,
+            last_modified.isoformat(),
+            user.pk if user.is_authenticated else "",
+            # フォームのCSRFトークンが変わらないようにする
+            self.request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""),
+        )
+        return etag, last_modified
+
+    def get(self, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return super().get(request, *args, **kwargs)
+        response = caching.not_modified(request, *validators)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+            caching.set_validators(response, *validators)
+        return response
+
+    def get_event(self):
+        if self.kwargs.get("event") is None:
+            self.kwargs["event"] = get_event_for_request(self.request, self.kwargs["pk"])
+        return self.kwargs["event"]
+
+    def get_object(self, queryset=None):
+        return self.get_event()
+
+    def get_context_data(self, **kwargs):
+        # テンプレートの断片キャッシュ({% cache %})のキーに使う
+        context = super().get_context_data(**kwargs)
+        event = self.get_event()
+        tier = caching.visibility_tier(self.request.user, event)
+        context["cache_tier"] = tier
+        context["cache_version"] = caching.get_event_version(event.pk)
+        # 司会者には常に最新の内容を表示する(0なら保存されない)
+        context["cache_timeout"] = 0 if tier == "organizer" else caching.page_timeout()
+        return context
+
+
+class EventDetailView(ResolvedEventMixin, FormView):
     template_name = "utakais/events/detail.html"
     form_class = ParticipantForm
 
@@ -105,19 +262,18 @@ class EventDetailView(FormView):
         tanka_form = TankaForm(self.request.POST)
         participant_form = ParticipantForm(self.request.POST)
         user = self.request.user
-        event = get_object_or_404(Event, pk=self.kwargs["pk"])
+        event = self.get_event()
+        current_participation = event.current_participation
 
         if "delete" in self.request.POST:
-            try:
-                participant = Participant.objects.get(user=user, event=event)
-                participant.delete()
-                if participant.tanka:
-                    participant.tanka.delete()
-                messages.success(self.request, "参加を取り消しました。")
-                return redirect("utakais:events_index")
-            except Participant.DoesNotExist:
+            if current_participation is None:
                 messages.error(self.request, "参加の取り消しに失敗しました。")
-                return self.request.path
+                return redirect(self.request.path)
+            current_participation.delete()
+            if current_participation.tanka:
+                current_participation.tanka.delete()
+            messages.success(self.request, "参加を取り消しました。")
+            return redirect("utakais:events_index")
 
         if tanka_form.is_valid() and participant_form.is_valid():
             empty = ""  # 詠草提出しない場合の詠草入力欄
@@ -132,16 +288,13 @@ class EventDetailView(FormView):
 
             # ---Participantを保存---
             if user.is_authenticated:
-                participant, created = Participant.objects.get_or_create(
-                    user=user,
-                    event=event,
-                )
-
-                if not created:
+                if current_participation is not None:
+                    participant = current_participation
                     messages.success(self.request, "再提出しました。")
                     if participant.tanka:
                         participant.tanka.delete()
                 else:
+                    participant = Participant(user=user, event=event)
                     messages.success(self.request, "提出しました。")
 
                 participant.message = participant_form.cleaned_data["message"]
@@ -153,7 +306,22 @@ class EventDetailView(FormView):
                 messages.success(self.request, "提出しました。")
 
             participant.tanka = tanka
-            participant.save()
+            if user.is_authenticated and participant.pk is None:
+                try:
+                    with transaction.atomic():
+                        participant.save()
+                except IntegrityError:
+                    # 二重送信などで同じ参加が先に作られていれば、再提出として扱う
+                    participant = Participant.objects.select_related("tanka").get(
+                        user=user, event=event
+                    )
+                    if participant.tanka:
+                        participant.tanka.delete()
+                    participant.message = participant_form.cleaned_data["message"]
+                    participant.tanka = tanka
+                    participant.save()
+            else:
+                participant.save()
 
         else:
             messages.error(self.request, "提出に失敗しました。")
@@ -172,7 +340,7 @@ class EventDetailView(FormView):
         """
         context = super().get_context_data(**kwargs)
         user = self.request.user
-        event = get_object_or_404(Event, pk=self.kwargs["pk"])
+        event = self.get_event()
         context["event"] = event
         context["joined"] = False
 
@@ -185,25 +353,16 @@ class EventDetailView(FormView):
             return context
 
         if user.is_authenticated:
-            # ---tanka_formの初期値を設定---
+            # ---tanka_form,participant_formの初期値を設定---
             tanka_initial = {}
-            try:
-                participant = Participant.objects.get(user=user, event=event)
+            participant_initial = {}
+            participant = event.current_participation
+            if participant is not None:
                 context["joined"] = True
                 if participant.tanka:
                     tanka_initial["content"] = participant.tanka.content
-            except Participant.DoesNotExist:
-                pass
-            context["tanka_form"] = TankaForm(initial=tanka_initial, author=user)
-
-            # ---participant_formの初期値,kwargsを設定---
-            participant_initial = {}
-            try:
-                participant = Participant.objects.get(user=user, event=event)
-                if participant.tanka:
                     participant_initial["message"] = participant.message
-            except Participant.DoesNotExist:
-                pass
+            context["tanka_form"] = TankaForm(initial=tanka_initial, author=user)
             context["participant_form"] = ParticipantForm(
                 initial=participant_initial,
                 user=user,
@@ -225,38 +384,58 @@ class EventDetailView(FormView):
         return success_url
 
 
-class EventOngoingView(DetailView):
+class EventOngoingView(ResolvedEventMixin, DetailView):
     model = Event
     template_name = "utakais/events/ongoing.html"
 
-    def get(request, *args, **kwargs):
-        event = get_object_or_404(Event, pk=kwargs["pk"])
-
-        # サニタイズ（ファイル名の安全な形式への変換）された名前
-        file_name = default_storage.get_valid_name(event.title)
-
-        doc_path = settings.MEDIA_ROOT / Path(
-            f"events/{event.pk}/{file_name}_ver{event.eisou_number}.docx"
-        )
-        pdf_path = settings.MEDIA_ROOT / Path(
-            f"events/{event.pk}/{file_name}_ver{event.eisou_number}.pdf"
-        )
-        if doc_path.is_file() and pdf_path.is_file():
-            pass
+    def get(self, request, *args, **kwargs):
+        event = self.get_event()
+
+        # DBに記録されたファイルが現在の内容と一致していればそのまま表示する(304を含む)
+        # 一致しなければ生成ジョブを積み、生成中として表示する
+        # 直前のジョブが失敗している場合は、司会者が再生成するまで積み直さない
+        # 雛形・描画方法・参加者の名前など、歌会の保存なしに変わる入力もあるため、
+        # 304を返す前にも必ず確かめる(フィンガープリントの計算のみで、生成はしない)
+        self.files_ready = event.eisou_is_fresh()
+        if self.files_ready:
+            self.job = None
         else:
-            event.generate_files()
+            self.job = jobs.latest_job(event)
+            if self.job is None or not self.job.is_failed:
+                self.job = jobs.enqueue(event)
         return super().get(request, *args, **kwargs)
 
+    def get_validators(self):
+        # 生成中・生成失敗の表示は歌会の保存なしに変わるため、生成済みのときだけ答える
+        # 最新であることを確かめた後なので、記録したフィンガープリントは現在の内容のもの
+        event = self.get_event()
+        if not self.files_ready:
+            return None
+        etag, last_modified = super().get_validators()
+        etag = caching.make_etag(etag, event.eisou_number, event.eisou_fingerprint)
+        return etag, last_modified
 
-class EventRecordView(DetailView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["files_ready"] = self.files_ready
+        context["job"] = self.job
+        return context
+
+
+class EventRecordView(ResolvedEventMixin, DetailView):
     model = Event
     template_name = "utakais/events/record.html"
 
     def get_context_data(self, **kwargs):
-        print("ここ")
         context = super().get_context_data(**kwargs)
-        context['public_participants'] = Participant.objects.filter(event=self.object, tanka__status="public")
-        context['limited_participants'] = Participant.objects.filter(event=self.object, tanka__status="limited")
+        # 司会者には常に最新の内容を表示する
+        groups = records.get_record_groups(
+            self.object.pk, use_cache=context["cache_tier"] != "organizer"
+        )
+        context["public_tankas"] = groups["public"]
+        user = self.request.user
+        if user.is_authenticated and user.is_member:
+            context["limited_tankas"] = groups["limited"]
         return context
 
 
@@ -299,31 +478,124 @@ class EventAdminView(UpdateView):
         context = self.get_context_data()
         participant_formset: forms.BaseInlineFormSet = context["participant_formset"]
 
+        if {"eisou_doc", "eisou_pdf"} & set(form.changed_data):
+            # 配信URLの版(?v=)を変え、ブラウザにキャッシュされた前のファイルを使わせない
+            form.instance.eisou_number = F("eisou_number") + 1
         self.object = form.save()
+        self.object.refresh_from_db(fields=["eisou_number"])
         participant_formset.save()
 
         return super().form_valid(form)
 
 
-def download_eisou_file(request, pk, file_type):
+class EventSimilarView(DetailView):
+    """歌会の詠草とよく似た詠草(ほかの歌会を含む)の一覧。司会者のみ"""
+
+    model = Event
+    template_name = "utakais/events/similar.html"
+
+    def get_object(self, queryset=None):
+        event = super().get_object(queryset)
+        if self.request.user != event.organizer:
+            raise PermissionDenied
+        return event
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        participants = list(
+            self.object.participant_set.filter(tanka__isnull=False)
+            .select_related("tanka", "user")
+            .order_by("pk")
+        )
+        try:
+            threshold = float(self.request.GET.get("threshold", similarity.THRESHOLD))
+        except ValueError:
+            threshold = similarity.THRESHOLD
+        # 司会者が見られない詠草・歌会は、あることも含めて表示しない
+        similar = similarity.find_similar(
+            [participant.tanka for participant in participants],
+            threshold,
+            user=self.request.user,
+        )
+        context["threshold"] = threshold
+        context["report"] = [
+            (participant, similar[participant.tanka_id])
+            for participant in participants
+            if participant.tanka_id in similar
+        ]
+        return context
+
+
+def download_tanka_list(request, pk, file_type):
+    """
+    短歌リストをdocx/pdfに書き出して配信する(詠草一覧と同じ配信方法・キャッシュのヘッダー)
+    非公開のリストは作成者のみ。閲覧者が見られる短歌だけを載せる
+    pdfはReportLabで描画する場合のみ(TankaList.anthology_file_types)
+    """
+    if file_type not in TankaList.anthology_file_types():
+        raise Http404(f"{file_type} is not a valid file type for TankaList.")
+    tanka_list = get_object_or_404(TankaList.objects.select_related("owner"), pk=pk)
+    if not tanka_list.is_public and request.user != tanka_list.owner:
+        raise Http404("短歌リストが見つかりません。")
+    path = tanka_list.export_anthology(file_type, request.user)
+    return delivery.serve_file(
+        request, path, filename=f"{tanka_list.title}.{file_type}"
+    )
+
+
+@require_POST
+def reorder_tanka_list(request, pk):
+    """
+    短歌リストを並べ替える。作成者のみ
+    本文のJSON({"tankas": [短歌のid, ...]})で、リストの短歌すべての新しい順序を受け取る
+    """
+    tanka_list = get_object_or_404(TankaList, pk=pk)
+    if request.user != tanka_list.owner:
+        raise PermissionDenied
     try:
-        event = Event.objects.get(pk=pk)
-
-        # file_typeに基づいて適切なFileFieldのパスを取得
-        if hasattr(event, file_type):  # file_typeがモデルに存在するか確認
-            file_field = getattr(event, file_type)
-            if file_field:  # FileFieldが空でないか確認
-                file_path = file_field.path
-                return FileResponse(
-                    open(file_path, "rb"), as_attachment=False, filename=file_field.name
-                )
-            else:
-                raise FileNotFoundError("File field is empty.")
-        else:
-            raise AttributeError(f"{file_type} is not a valid file type for Event.")
+        tanka_ids = [int(tanka_id) for tanka_id in json.loads(request.body)["tankas"]]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"error": "短歌のidのリストを指定してください。"}, status=400)
+    try:
+        with transaction.atomic():
+            updated = tanka_list.reorder(tanka_ids)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"updated": updated})
 
-    except Event.DoesNotExist:
+
+def download_eisou_file(request, pk, file_type):
+    """詠草一覧のファイルを配信する(配信方法はsettings.EISOU_FILE_DELIVERY)"""
+    if file_type not in ("eisou_doc", "eisou_pdf"):
+        raise Http404(f"{file_type} is not a valid file type for Event.")
+    event = get_object_or_404(Event.objects.visible_to(request.user), pk=pk)
+    file_field = getattr(event, file_type)
+    if not file_field:
         raise Http404("File does not exist")
+    return delivery.serve_file(
+        request,
+        file_field.path,
+        filename=Path(file_field.name).name,
+        version=event.eisou_number,
+    )
+
+
+def render_eisou_pdf_view(request, pk):
+    """
+    詠草一覧のpdfを、docxを介さずReportLabで描画して返す
+    描画結果は内容ごとに保存し(Event.get_rendered_eisou_pdf)、内容が変わるまで使い回す
+    埋め込むフォント(EISOU_PDF_FONT)がなければ404を返す
+    """
+    if not pdf.font_configured():
+        raise Http404("eisou.pdfは配信していません。")
+    event = get_object_or_404(
+        Event.objects.visible_to(request.user).select_related("organizer"), pk=pk
+    )
+    if event.deadline > timezone.now():
+        raise Http404("締切前のため詠草一覧はありません。")
+    return delivery.serve_file(
+        request, event.get_rendered_eisou_pdf(), filename="eisou.pdf"
+    )
 
 
 def execute_method(request, pk, app_name, model_name, method_name):
@@ -340,7 +612,12 @@ def execute_method(request, pk, app_name, model_name, method_name):
         method = getattr(obj, method_name)
 
         if callable(method):
-            method()  # 実行
+            if method_name in getattr(obj, "deferred_methods", []):
+                # 時間のかかる処理はジョブとして積み、ワーカーに実行させる
+                jobs.enqueue(obj, method_name)
+                messages.info(request, "処理を受け付けました。完了までしばらくお待ちください。")
+            else:
+                method()  # 実行
         else:
             raise AttributeError(
                 f"{method_name} is not a valid method for {obj.__class__.__name__}"
@@ -354,6 +631,30 @@ def execute_method(request, pk, app_name, model_name, method_name):
     return redirect(request.META.get("HTTP_REFERER", "/"))
 
 
+class TankaSearchView(ListView):
+    """
+    詠草の全文検索(?q=)。閲覧者が見られる詠草を関連の高い順に表示する
+    ?by=readingなら、読みがqで始まる詠草を読みの順に表示する
+    """
+
+    template_name = "utakais/tankas/search.html"
+    context_object_name = "tankas"
+    paginate_by = 20
+
+    def get_queryset(self):
+        tankas = Tanka.objects.visible_to(self.request.user).select_related("author")
+        query = self.request.GET.get("q", "")
+        if self.request.GET.get("by") == "reading":
+            return search.search_by_reading(tankas, query)
+        return search.search_tankas(tankas, query)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.request.GET.get("q", "")
+        context["by_reading"] = self.request.GET.get("by") == "reading"
+        return context
+
+
 class TankaDetailView(FormView):
     model = Tanka
     template_name = "utakais/tankas/detail.html"